@@ -1,17 +1,12 @@
-import os.path
 from flask import Flask, request
 from flask_login import LoginManager
-from flask_migrate import Migrate
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy import MetaData
 from config import Config
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
-from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
 
 
 class Base(DeclarativeBase):
@@ -25,31 +20,28 @@ class Base(DeclarativeBase):
 
 
 db = SQLAlchemy(model_class=Base)
-migrate = Migrate()
 login = LoginManager()
-mail = Mail()
 moment = Moment()
 babel = Babel()
 
 
-def create_app():
+def create_app(config_class=Config):
     app = Flask(__name__)
-    app.config.from_object(Config)
+    app.config.from_object(config_class)
+
+    # Trust X-Forwarded-For from this many proxies, so request.remote_addr is the client's
+    if app.config["PROXY_FIX_X_FOR"]:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["PROXY_FIX_X_FOR"])
 
     # Initialize Database
     db.init_app(app=app)
 
-    # Initialize Migration
-    migrate.init_app(app=app, db=db)
-
     # Initialize Login
     login.init_app(app=app)
     login.login_view = "auth.login"
     login.login_message = _l('Please log in to access this page.')
 
-    # Initialize mail
-    mail.init_app(app=app)
-
     # Initialize moment
     moment.init_app(app=app)
 
@@ -68,38 +60,47 @@ def create_app():
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix="/api/v1")
+
     from app.command.cli import bp as cli_bp
     app.register_blueprint(cli_bp)
 
-    app.elasticsearch = Elasticsearch([app.config["ELASTICSEARCH_URL"]]) if app.config["ELASTICSEARCH_URL"] else None
+    from app.templating import init_template_cache
+    init_template_cache(app)
+
+    from app.cache import init_fragment_cache, cached_fragment
+    app.fragment_cache = init_fragment_cache(app)
+    app.add_template_global(cached_fragment)
+
+    from app.cache import init_query_cache
+    app.query_cache = init_query_cache(app)
+
+    from app.passwords import init_password_hasher
+    app.password_hasher = init_password_hasher(app)
+
+    from app.graph import init_follow_graph
+    app.follow_graph = init_follow_graph(app)
+
+    from app.trending import init_trending
+    app.trending = init_trending(app)
+
+    from app.shards import init_shards
+    app.shards = init_shards(app)
+
+    from app.hot import init_hot_ranking
+    app.hot_ranking = init_hot_ranking(app)
+
+    from app.ratelimit import init_rate_limiter, rate_limit
+    app.rate_limiter = init_rate_limiter(app)
+    app.before_request(rate_limit)
+
+    from app.conditional import compress_response
+    app.after_request(compress_response)
 
     if not app.debug and not app.testing:
-        if app.config["MAIL_SERVER"]:
-            auth = None
-            if app.config["MAIL_USERNAME"] or app.config["MAIL_PASSWORD"]:
-                auth = (app.config["MAIL_USERNAME"] or app.config["MAIL_PASSWORD"])
-            secure = None
-            if app.config["MAIL_USER_TLS"]:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config["MAIL_SERVER"], app.config["MAIL_PORT"]),
-                fromaddr="noreply@" + app.config["MAIL_SERVER"],
-                toaddrs=app.config["ADMINS"], subject="Blog Log Failures",
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-        if app.config['LOG_TO_STDOUT']:
-            stream_handler = logging.StreamHandler()
-            stream_handler.setLevel(logging.INFO)
-            app.logger.addHandler(stream_handler)
-        else:
-            if not os.path.exists("logs"):
-                os.mkdir("logs")
-            filehandler = RotatingFileHandler("logs/blog.log", maxBytes=10240, backupCount=10)
-            filehandler.setFormatter(
-                logging.Formatter("%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]"))
-            filehandler.setLevel(logging.INFO)
-            app.logger.addHandler(filehandler)
+        from app.log import configure_logging
+        configure_logging(app)
 
         app.logger.setLevel(logging.INFO)
         app.logger.info("Blog startup")
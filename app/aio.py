@@ -0,0 +1,69 @@
+import asyncio
+import atexit
+import os
+import threading
+
+
+class BackgroundLoop(object):
+    """An event loop on a daemon thread that owns this process's pooled async clients.
+
+    Flask runs every async view in a short-lived loop of its own, and aiohttp-based clients are
+    bound to the loop that created them, so the clients live here and views await them through
+    ``run()``. The loop is started lazily and restarted after a fork.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.clients = {}
+
+    @property
+    def loop(self):
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._pid = os.getpid()
+                self.clients = {}
+                threading.Thread(target=self._loop.run_forever, name="background-loop", daemon=True).start()
+            return self._loop
+
+    def close(self):
+        if self._loop is None or self._pid != os.getpid():
+            return
+
+        async def close_clients():
+            for client in self.clients.values():
+                await client.close()
+            self.clients = {}
+
+        asyncio.run_coroutine_threadsafe(close_clients(), self._loop).result(timeout=5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+    async def run(self, coro, timeout):
+        """Run ``coro`` on the background loop, cancelling it if it takes longer than ``timeout`` seconds."""
+        future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(coro, timeout), self.loop)
+        return await asyncio.wrap_future(future)
+
+
+background = BackgroundLoop()
+atexit.register(background.close)
+
+
+def http_session(service, limit):
+    """The aiohttp session pooling connections to ``service``; only call this on the background loop."""
+    key = ("http", service)
+    if key not in background.clients:
+        import aiohttp
+        background.clients[key] = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=limit))
+    return background.clients[key]
+
+
+def async_elasticsearch(url, timeout, max_retries):
+    """The shared AsyncElasticsearch client for ``url``; only call this on the background loop."""
+    key = ("elasticsearch", url)
+    if key not in background.clients:
+        from elasticsearch import AsyncElasticsearch
+        background.clients[key] = AsyncElasticsearch([url], request_timeout=timeout, max_retries=max_retries,
+                                                     retry_on_timeout=False)
+    return background.clients[key]
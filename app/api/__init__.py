@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+bp = Blueprint("api", __name__)
+
+from app.api import errors, tokens, users, posts, messages, follows
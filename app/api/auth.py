@@ -0,0 +1,43 @@
+from functools import wraps
+from flask import request, g
+from sqlalchemy import select
+from app import db
+from app.models import User
+from app.api.errors import error_response
+
+
+def unauthorized(scheme):
+    return error_response(401, headers={"WWW-Authenticate": scheme})
+
+
+def basic_auth_required(f):
+    """Authenticate with a username and password; only used to obtain a token."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth = request.authorization
+        if auth is None or auth.type != "basic" or not auth.username:
+            return unauthorized('Basic realm="api"')
+        user = db.session.scalar(select(User).where(User.username == auth.username))
+        if user is None or not user.check_password(auth.password or ""):
+            return unauthorized('Basic realm="api"')
+        if user.password_needs_rehash():
+            user.set_password(auth.password)
+            db.session.commit()
+        g.current_user = user
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def token_auth_required(f):
+    """Authenticate with an ``Authorization: Bearer <token>`` header instead of the session cookie."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        auth = request.authorization
+        user = User.check_token(auth.token) if auth is not None and auth.type == "bearer" and auth.token else None
+        if user is None:
+            return unauthorized("Bearer")
+        g.current_user = user
+        return f(*args, **kwargs)
+
+    return decorated_function
@@ -0,0 +1,126 @@
+import json
+from datetime import timezone
+from flask import request, current_app, abort
+from app.pagination import encode_cursor, decode_cursor
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MIMETYPES = ["application/json", "application/msgpack"]
+
+
+def respond(payload, status=200, headers=None):
+    """``payload`` as compact JSON (through orjson when installed), or as msgpack when the client
+    prefers it and msgpack is installed."""
+    if msgpack is not None and request.accept_mimetypes.best_match(MIMETYPES) == "application/msgpack":
+        data, mimetype = msgpack.packb(payload), "application/msgpack"
+    elif orjson is not None:
+        data, mimetype = orjson.dumps(payload), "application/json"
+    else:
+        data, mimetype = json.dumps(payload, ensure_ascii=False, separators=(",", ":")), "application/json"
+    return current_app.response_class(data, status, headers, mimetype=mimetype)
+
+
+def timestamp(value):
+    """Datetimes are stored as naive UTC; send them with their offset."""
+    if value is None:
+        return None
+    return value.isoformat() + "+00:00" if value.tzinfo is None else value.astimezone(timezone.utc).isoformat()
+
+
+class Related(object):
+    """A nested resource in a field table: ``getter`` returns the related object, ``fields`` its own table."""
+    __slots__ = ["getter", "fields"]
+
+    def __init__(self, getter, fields):
+        self.getter = getter
+        self.fields = fields
+
+
+def select_fields(available, default, requested=None):
+    """Compile a ``?fields=`` value into ``(key, getter, nested)`` triples for ``serialize``.
+
+    Names are dotted through ``Related`` entries, e.g. ``author.username``; naming a related
+    resource on its own selects all of its fields. Raises ValueError for unknown fields.
+    """
+    names = [name.strip() for name in requested.split(",") if name.strip()] if requested else default
+    tree = {}
+    for name in names:
+        table, node = available, tree
+        parts = name.split(".")
+        for i, part in enumerate(parts):
+            if part not in table or (i < len(parts) - 1 and not isinstance(table[part], Related)):
+                raise ValueError("unknown field {!r}".format(name))
+            if isinstance(table[part], Related):
+                table = table[part].fields
+                node = node.setdefault(part, {})
+                if i == len(parts) - 1:
+                    node.update(dict.fromkeys(table, None))
+            else:
+                node[part] = None
+    return compile_fields(available, tree)
+
+
+def compile_fields(available, tree):
+    fields = []
+    for key, node in tree.items():
+        entry = available[key]
+        if isinstance(entry, Related):
+            fields.append((key, entry.getter, compile_fields(entry.fields, node)))
+        else:
+            fields.append((key, entry, None))
+    return fields
+
+
+def serialize(obj, fields, seen=None):
+    """A dict of the selected ``fields`` of ``obj``. ``seen`` memoizes related objects across a page,
+    so an author of many posts is serialized once."""
+    data = {}
+    for key, getter, nested in fields:
+        value = getter(obj)
+        if nested is not None and value is not None:
+            if seen is None:
+                value = serialize(value, nested)
+            else:
+                memo = (key, id(value))
+                if memo not in seen:
+                    seen[memo] = serialize(value, nested, seen)
+                value = seen[memo]
+        data[key] = value
+    return data
+
+
+def selected(fields, key):
+    return any(field[0] == key for field in fields)
+
+
+def fields_arg(available, default):
+    try:
+        return select_fields(available, default, request.args.get("fields"))
+    except ValueError as e:
+        abort(400, str(e))
+
+
+def page_args():
+    """The ``before`` cursor and ``limit`` of a collection request."""
+    before = request.args.get("before")
+    try:
+        before = decode_cursor(before) if before else None
+    except ValueError:
+        abort(400, "malformed cursor")
+    limit = request.args.get("limit", current_app.config["API_PAGE_SIZE"], type=int)
+    return before, min(max(limit, 1), current_app.config["API_MAX_PAGE_SIZE"])
+
+
+def collection(items, has_next, fields, key):
+    """A page of ``items`` with the cursor of the next page; ``key`` gives an item's ``(timestamp, id)``."""
+    seen = {}
+    return respond({"items": [serialize(item, fields, seen) for item in items],
+                    "next": encode_cursor(*key(items[-1])) if has_next else None})
@@ -0,0 +1,21 @@
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+from app.api import bp
+from app.api.encoding import respond
+
+
+def error_response(status, message=None, headers=None):
+    payload = {"error": HTTP_STATUS_CODES.get(status, "Unknown error")}
+    if message:
+        payload["message"] = message
+    return respond(payload, status, headers)
+
+
+def bad_request(message):
+    return error_response(400, message)
+
+
+@bp.errorhandler(HTTPException)
+def handle_exception(error):
+    headers = {key: value for key, value in error.get_headers() if key != "Content-Type"}
+    return error_response(error.code, error.description, headers)
@@ -0,0 +1,25 @@
+from flask import g, request, current_app
+from app import db
+from app.importer import follow_all, resolve_authors
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.encoding import respond
+from app.api.errors import bad_request
+
+
+@bp.route("/follows", methods=["POST"])
+@token_auth_required
+def follow_users():
+    """Follow every user in ``{"usernames": [...]}`` at once. Unknown names are reported back."""
+    data = request.get_json(silent=True) or {}
+    usernames = data.get("usernames")
+    if not isinstance(usernames, list) or not all(isinstance(name, str) for name in usernames):
+        return bad_request("usernames must be a list of strings")
+    if len(usernames) > current_app.config["API_MAX_FOLLOWS"]:
+        return bad_request("at most {} usernames per request".format(current_app.config["API_MAX_FOLLOWS"]))
+    users = {}
+    resolve_authors(usernames, users)
+    user = g.current_user
+    added = follow_all([(user.id, id) for id in users.values() if id is not None])
+    db.session.commit()
+    return respond({"followed": len(added), "unknown": sorted(name for name, id in users.items() if id is None)})
@@ -0,0 +1,71 @@
+from collections import namedtuple
+from datetime import datetime, timezone
+from flask import g
+from sqlalchemy import select
+from app import db
+from app.models import Message, Conversation
+from app.shards import scatter
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.encoding import Related, timestamp, fields_arg, page_args, collection, selected
+from app.api.users import get_user
+from app.api.posts import AUTHOR_FIELDS
+
+InboxEntry = namedtuple("InboxEntry", ["conversation", "user", "unread", "last_message"])
+
+MESSAGE_FIELDS = {
+    "id": lambda message: message.id,
+    "body": lambda message: message.body,
+    "timestamp": lambda message: timestamp(message.timestamp),
+    "sender": Related(lambda message: message.author, AUTHOR_FIELDS),
+    "recipient": Related(lambda message: message.recipient, AUTHOR_FIELDS),
+}
+
+CONVERSATION_FIELDS = {
+    "id": lambda entry: entry.conversation.id,
+    "user": Related(lambda entry: entry.user, AUTHOR_FIELDS),
+    "unread": lambda entry: entry.unread,
+    "last_message_at": lambda entry: timestamp(entry.conversation.last_message_at),
+    "last_message": Related(lambda entry: entry.last_message, {
+        "id": lambda message: message.id,
+        "body": lambda message: message.body,
+        "sender_id": lambda message: message.sender_id,
+    }),
+}
+
+
+@bp.route("/messages")
+@token_auth_required
+def get_inbox():
+    fields = fields_arg(CONVERSATION_FIELDS, list(CONVERSATION_FIELDS))
+    before, limit = page_args()
+    user = g.current_user
+    conversations, has_next = user.inbox(before, limit)
+    last_messages = {}
+    if selected(fields, "last_message"):
+        last_messages = {message.id: message for result in scatter(
+            select(Message).where(Message.id.in_([c.last_message_id for c in conversations])),
+            [c.user1_id for c in conversations]) for message in result.scalars()}
+    entries = [InboxEntry(c, c.other(user), c.unread(user), last_messages.get(c.last_message_id))
+               for c in conversations]
+    return collection(entries, has_next, fields,
+                      lambda entry: (entry.conversation.last_message_at, entry.conversation.id))
+
+
+@bp.route("/messages/<username>")
+@token_auth_required
+def get_conversation(username):
+    fields = fields_arg(MESSAGE_FIELDS, list(MESSAGE_FIELDS))
+    before, limit = page_args()
+    user, other = g.current_user, get_user(username)
+    conversation = Conversation.between(user, other, create=False)
+    if conversation is None:
+        return collection([], False, fields, None)
+    if conversation.unread(user):
+        conversation.mark_read(user)
+        user.last_message_read_time = datetime.now(tz=timezone.utc)
+        db.session.flush()
+        user.add_notification('unread_message_count', user.unread_message_count())
+        db.session.commit()
+    messages, has_next = conversation.thread(before, limit)
+    return collection(messages, has_next, fields, lambda message: (message.timestamp, message.id))
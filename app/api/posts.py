@@ -0,0 +1,54 @@
+from flask import g
+from sqlalchemy import select
+from app import db
+from app.models import User
+from app.timeline import home_timeline, recent_posts
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.encoding import Related, timestamp, fields_arg, page_args, collection, selected
+
+AUTHOR_FIELDS = {
+    "id": lambda user: user.id,
+    "username": lambda user: user.username,
+    "avatar": lambda user: user.avatar(36),
+}
+
+POST_FIELDS = {
+    "id": lambda post: post.id,
+    "body": lambda post: post.body,
+    "timestamp": lambda post: timestamp(post.timestamp),
+    "language": lambda post: post.language,
+    "author": Related(lambda post: post.author, AUTHOR_FIELDS),
+}
+
+
+def post_key(post):
+    return post.timestamp, post.id
+
+
+def load_authors(posts, fields):
+    """Load the authors of a page with one query, so serializing ``post.author`` finds them in the session."""
+    if selected(fields, "author"):
+        ids = {post.user_id for post in posts}
+        if ids:
+            db.session.scalars(select(User).where(User.id.in_(ids))).all()
+
+
+@bp.route("/timeline")
+@token_auth_required
+def get_timeline():
+    fields = fields_arg(POST_FIELDS, list(POST_FIELDS))
+    before, limit = page_args()
+    posts, has_next = home_timeline(g.current_user, 1, limit, before)
+    load_authors(posts, fields)
+    return collection(posts, has_next, fields, post_key)
+
+
+@bp.route("/explore")
+@token_auth_required
+def get_explore():
+    fields = fields_arg(POST_FIELDS, list(POST_FIELDS))
+    before, limit = page_args()
+    posts, has_next = recent_posts(before, limit)
+    load_authors(posts, fields)
+    return collection(posts, has_next, fields, post_key)
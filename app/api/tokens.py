@@ -0,0 +1,21 @@
+from flask import g, current_app
+from app import db
+from app.api import bp
+from app.api.auth import basic_auth_required, token_auth_required
+from app.api.encoding import respond, timestamp
+
+
+@bp.route("/tokens", methods=["POST"])
+@basic_auth_required
+def get_token():
+    token = g.current_user.get_token(current_app.config["API_TOKEN_EXPIRATION"])
+    db.session.commit()
+    return respond({"token": token, "expires": timestamp(g.current_user.token_expiration)})
+
+
+@bp.route("/tokens", methods=["DELETE"])
+@token_auth_required
+def revoke_token():
+    g.current_user.revoke_token()
+    db.session.commit()
+    return "", 204
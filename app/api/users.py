@@ -0,0 +1,39 @@
+from sqlalchemy import select
+from app import db
+from app.models import User
+from app.archive import user_posts
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.encoding import respond, timestamp, fields_arg, page_args, collection, serialize
+from app.api.posts import POST_FIELDS, post_key
+
+USER_FIELDS = {
+    "id": lambda user: user.id,
+    "username": lambda user: user.username,
+    "about_me": lambda user: user.about_me,
+    "last_seen": lambda user: timestamp(user.last_seen),
+    "avatar": lambda user: user.avatar(128),
+    "follower_count": lambda user: user.follower_count,
+    "following_count": lambda user: user.following_count(),
+}
+
+
+def get_user(username):
+    return db.first_or_404(select(User).where(User.username == username).execution_options(query_cache=60))
+
+
+@bp.route("/users/<username>")
+@token_auth_required
+def get_profile(username):
+    fields = fields_arg(USER_FIELDS, list(USER_FIELDS))
+    return respond(serialize(get_user(username), fields))
+
+
+@bp.route("/users/<username>/posts")
+@token_auth_required
+def get_user_posts(username):
+    fields = fields_arg(POST_FIELDS, list(POST_FIELDS))
+    user = get_user(username)
+    before, limit = page_args()
+    posts, has_next = user_posts(user, before, limit)
+    return collection(posts, has_next, fields, post_key)
@@ -0,0 +1,146 @@
+import heapq
+from datetime import datetime, timezone
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, DateTime, select, insert, update, delete, \
+    text, func
+from flask import current_app
+from app import db
+from app.models import Post, post_archive_month, timeline, hot_post
+from app.pagination import keyset
+from app.search import bulk_remove_from_index
+from app.shards import routed
+
+COLUMNS = ["id", "body", "timestamp", "user_id", "language"]
+
+archive_metadata = MetaData()
+
+
+def archive_columns():
+    return [Column("id", Integer, nullable=False), Column("body", String(140)),
+            Column("timestamp", DateTime, nullable=False), Column("user_id", Integer, nullable=False),
+            Column("language", String(5))]
+
+
+# everything archived: the partitioned parent table on PostgreSQL, a UNION ALL view elsewhere
+post_archive = Table("post_archive", archive_metadata, *archive_columns())
+
+
+class ArchivedPost(object):
+    """A read-only post from the archive, with what ``_post.html`` needs."""
+    __slots__ = COLUMNS + ["author"]
+    # renders exactly like the post it was, so it shares its fragments
+    __tablename__ = "post"
+
+    def __init__(self, row, author):
+        for column in COLUMNS:
+            setattr(self, column, getattr(row, column))
+        self.author = author
+
+
+def month_of(timestamp):
+    return timestamp.year * 100 + timestamp.month
+
+
+def month_start(month):
+    return datetime(month // 100, month % 100, 1)
+
+
+def next_month(month):
+    return month + 1 if month % 100 < 12 else (month // 100 + 1) * 100 + 1
+
+
+def month_table(month):
+    name = "post_archive_{}".format(month)
+    if name in archive_metadata.tables:
+        return archive_metadata.tables[name]
+    return Table(name, archive_metadata, *archive_columns(),
+                 Index("ix_{}_user_id_timestamp".format(name), "user_id", "timestamp", "id"))
+
+
+def ensure_partition(month):
+    """Create the storage for ``month`` if needed: a partition of ``post_archive`` on PostgreSQL,
+    or a table of its own with the ``post_archive`` view recreated over all of them."""
+    if db.session.scalar(select(post_archive_month.c.month).where(post_archive_month.c.month == month)):
+        return
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS post_archive_{} PARTITION OF post_archive "
+            "FOR VALUES FROM ('{}') TO ('{}')".format(month, month_start(month), month_start(next_month(month)))))
+    else:
+        month_table(month).create(connection, checkfirst=True)
+        months = sorted(set(db.session.scalars(select(post_archive_month.c.month))) | {month})
+        connection.execute(text("DROP VIEW IF EXISTS post_archive"))
+        connection.execute(text("CREATE VIEW post_archive AS " + " UNION ALL ".join(
+            "SELECT {} FROM post_archive_{}".format(", ".join(COLUMNS), m) for m in months)))
+    db.session.execute(insert(post_archive_month).values(month=month, rows=0))
+    db.session.commit()
+
+
+def hot_window_start(now=None):
+    """First day of the oldest month that stays in ``post``, ``POST_HOT_MONTHS`` back from ``now``."""
+    month = month_of(now or datetime.now(tz=timezone.utc))
+    months = (month // 100) * 12 + month % 100 - 1 - current_app.config["POST_HOT_MONTHS"]
+    return month_start((months // 12) * 100 + months % 12 + 1)
+
+
+def archive(before, batch_size=1000):
+    """Move the posts of every month that ends before ``before`` out of ``post`` into the archive.
+
+    Each batch of ids is copied and deleted, with its timeline and ranking entries, in its own
+    transaction, then removed from the search index. Returns ``{month: rows moved}``.
+    """
+    moved = {}
+    cutoff = month_start(month_of(before))
+    while True:
+        oldest = db.session.scalar(select(func.min(Post.timestamp)).where(Post.timestamp < cutoff))
+        if oldest is None:
+            return moved
+        month = month_of(oldest)
+        ensure_partition(month)
+        target = post_archive if db.session.connection().dialect.name == "postgresql" else month_table(month)
+        end = month_start(next_month(month))
+        while ids := db.session.scalars(select(Post.id).where(Post.timestamp < end).limit(batch_size)).all():
+            db.session.execute(insert(target).from_select(
+                COLUMNS, select(*[getattr(Post, column) for column in COLUMNS]).where(Post.id.in_(ids))))
+            db.session.execute(delete(timeline).where(timeline.c.post_id.in_(ids)))
+            db.session.execute(delete(hot_post).where(hot_post.c.post_id.in_(ids)))
+            db.session.execute(delete(Post).where(Post.id.in_(ids)).execution_options(synchronize_session=False))
+            db.session.execute(update(post_archive_month).where(post_archive_month.c.month == month).values(
+                rows=post_archive_month.c.rows + len(ids), archived_at=datetime.now(tz=timezone.utc)))
+            db.session.commit()
+            bulk_remove_from_index(Post.__tablename__, ids, batch_size)
+            moved[month] = moved.get(month, 0) + len(ids)
+
+
+def has_archive():
+    return db.session.scalar(select(post_archive_month.c.month).limit(1)) is not None
+
+
+def user_posts(user, before=None, limit=20):
+    """A newest-first keyset page of ``user``'s posts and whether there are more.
+
+    The hot ``post`` table answers on its own while it can fill the page; the archive is read
+    only when the page runs past what is still hot, and the two streams are merged.
+    """
+    hot = db.session.scalars(keyset(select(Post).where(Post.user_id == user.id),
+                                    Post.timestamp, Post.id, before, limit), bind_arguments=routed(user.id)).all()
+    if len(hot) <= limit and has_archive():
+        rows = db.session.execute(keyset(select(post_archive).where(post_archive.c.user_id == user.id),
+                                         post_archive.c.timestamp, post_archive.c.id, before, limit)).all()
+        cold = [ArchivedPost(row, user) for row in rows]
+        hot = list(heapq.merge(hot, cold, key=lambda post: (post.timestamp, post.id), reverse=True))
+    return hot[:limit], len(hot) > limit
+
+
+def archived_rows(user, after=None, batch_size=1000):
+    """``user``'s archived posts as ``(id, timestamp, language, body)``, oldest first, after the
+    ``(timestamp, id)`` cursor ``after``."""
+    if not has_archive():
+        return
+    query = select(post_archive.c.id, post_archive.c.timestamp, post_archive.c.language, post_archive.c.body) \
+        .where(post_archive.c.user_id == user.id) \
+        .order_by(post_archive.c.timestamp, post_archive.c.id).execution_options(yield_per=batch_size)
+    if after is not None:
+        query = query.where((post_archive.c.timestamp > after[0]) |
+                            ((post_archive.c.timestamp == after[0]) & (post_archive.c.id > after[1])))
+    yield from db.session.execute(query)
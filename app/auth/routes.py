@@ -20,6 +20,10 @@ def login():
         if user is None or not user.check_password(form.password.data):
             flash("Invalid username or password")
             return redirect(url_for("auth.login"))
+        if user.password_needs_rehash():
+            # upgrade hashes made with older parameters while the password is at hand
+            user.set_password(form.password.data)
+            db.session.commit()
         login_user(user=user, remember=form.remember_me.data)
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != "":
@@ -61,6 +65,7 @@ def reset_password_request():
         user = db.session.scalar(select(User).where(User.email == form.email.data))
         if user:
             send_password_reset_email(user)
+            db.session.commit()
         flash('Check your email for the instructions to reset your password')
         return redirect(url_for('auth.login'))
     return render_template('auth/reset_password_request.html',
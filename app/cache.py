@@ -0,0 +1,266 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+from flask import current_app
+from markupsafe import Markup
+from sqlalchemy import TableClause, Alias
+from sqlalchemy.orm import loading
+from sqlalchemy.sql.util import find_tables
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return None
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete_matching(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k[:len(prefix)] == prefix]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def values(self):
+        with self._lock:
+            return list(self._data.values())
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RedisBackend(object):
+    def __init__(self, url, timeout):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.timeout = timeout
+
+    @staticmethod
+    def _key(key):
+        return "fragment:" + ":".join(str(part) for part in key)
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        return value.decode("utf-8") if value is not None else None
+
+    def set(self, key, value):
+        # index the entry under its (kind, id), so invalidate() finds it without scanning the keyspace
+        index = self._key(("keys",) + key[:2])
+        pipeline = self.client.pipeline()
+        pipeline.set(self._key(key), value, ex=self.timeout)
+        pipeline.sadd(index, self._key(key))
+        pipeline.expire(index, self.timeout)
+        pipeline.execute()
+
+    def delete_matching(self, prefix):
+        index = self._key(("keys",) + prefix)
+        keys = self.client.smembers(index)
+        self.client.delete(index, *keys)
+
+
+class FragmentCache(object):
+    """Rendered template fragments, kept in a local LRU in front of an optional shared backend.
+
+    Keys carry the versions of everything the fragment renders, so a changed post or
+    profile simply misses; stale entries age out of the LRU (or expire in the backend).
+    """
+
+    def __init__(self, maxsize=1024, shared=None):
+        self.local = LRUCache(maxsize)
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    def invalidate(self, kind, id):
+        self.local.delete_matching((kind, id))
+        if self.shared is not None:
+            self.shared.delete_matching((kind, id))
+
+
+def init_fragment_cache(app):
+    if not app.config["FRAGMENT_CACHE_SIZE"]:
+        return None
+    shared = None
+    if app.config["FRAGMENT_CACHE_REDIS_URL"]:
+        shared = RedisBackend(app.config["FRAGMENT_CACHE_REDIS_URL"], app.config["FRAGMENT_CACHE_TIMEOUT"])
+    return FragmentCache(app.config["FRAGMENT_CACHE_SIZE"], shared)
+
+
+def cached_fragment(*key, caller):
+    cache = current_app.fragment_cache
+    if cache is None:
+        return caller()
+    html = cache.get(key)
+    if html is None:
+        html = str(caller())
+        cache.set(key, html)
+    return Markup(html)
+
+
+def invalidate_fragments(session):
+    stale = session.info.pop("stale_fragments", None)
+    if not stale or not current_app.fragment_cache:
+        return
+    for kind, id in stale:
+        current_app.fragment_cache.invalidate(kind, id)
+
+
+def read_tables(statement):
+    """Names of the tables ``statement`` selects from, through joins, aliases and subqueries."""
+    names = set()
+    for table in find_tables(statement, check_columns=True, include_aliases=True, include_joins=True):
+        while isinstance(table, Alias):
+            table = table.element
+        if isinstance(table, TableClause):
+            names.add(table.name)
+    return names
+
+
+class QueryCache(object):
+    """Results of the ``select()`` statements that opt in with ``.execution_options(query_cache=ttl)``.
+
+    Entries are keyed on the statement's compiled form, its parameters and the database it runs on, and
+    remember a generation number for every table the statement reads. A commit that wrote to
+    one of those tables bumps its generation, so the entry misses from then on; entries also
+    expire after their TTL and the least recently used are evicted past ``maxsize``. Writes
+    executed with ``query_cache_invalidate=False`` (such as ``last_seen``) bump nothing.
+    Generations are per process: other processes' writes are only seen once the TTL runs out.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.entries = LRUCache(maxsize)
+        self.read = LRUCache(maxsize)
+        self.generations = {}
+        self.counts = {"hits": 0, "misses": 0, "bypassed": 0, "invalidations": 0}
+        self._lock = Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def tables(self, statement_key, statement):
+        tables = self.read.get(statement_key)
+        if tables is None:
+            tables = tuple(sorted(read_tables(statement)))
+            self.read.set(statement_key, tables)
+        return tables
+
+    def snapshot(self, tables):
+        return tuple(self.generations.get(table, 0) for table in tables)
+
+    def get(self, key, tables):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time() or entry[1] != self.snapshot(tables):
+            self.count("misses")
+            return None
+        self.count("hits")
+        return entry[2]
+
+    def set(self, key, generations, ttl, result):
+        self.entries.set(key, (time() + ttl, generations, result))
+
+    def invalidate(self, tables):
+        with self._lock:
+            for table in tables:
+                self.generations[table] = self.generations.get(table, 0) + 1
+            self.counts["invalidations"] += 1
+
+    def stats(self):
+        lookups = self.counts["hits"] + self.counts["misses"]
+        return dict(self.counts, size=len(self.entries),
+                    hit_rate=self.counts["hits"] / lookups if lookups else 0.0)
+
+
+def init_query_cache(app):
+    if not app.config["QUERY_CACHE_SIZE"]:
+        return None
+    return QueryCache(app.config["QUERY_CACHE_SIZE"])
+
+
+def written_tables(session):
+    return set().union(*session.info.get("query_cache_writes", ()))
+
+
+def cache_query_results(orm_context):
+    """``do_orm_execute`` hook serving opted-in selects from ``current_app.query_cache``."""
+    ttl = orm_context.execution_options.get("query_cache")
+    cache = current_app.query_cache
+    if not ttl or cache is None or not orm_context.is_select:
+        return None
+    # SQLAlchemy's structural key of the statement, the one its compiled-SQL cache uses, with the
+    # bound values pulled out; cheaper than compiling and equivalent to the compiled string
+    cache_key = orm_context.statement._generate_cache_key()
+    if cache_key is None:
+        return None
+    session = orm_context.session
+    tables = cache.tables(cache_key.key, orm_context.statement)
+    if written_tables(session).intersection(tables):
+        # the transaction has its own uncommitted changes to these tables
+        cache.count("bypassed")
+        return None
+    bind = session.get_bind(**orm_context.bind_arguments)
+    parameters = [parameter.effective_value for parameter in cache_key.bindparams]
+    key = (bind.url, cache_key.key, repr((parameters, orm_context.parameters)))
+    frozen = cache.get(key, tables)
+    if frozen is None:
+        generations = cache.snapshot(tables)
+        frozen = orm_context.invoke_statement().freeze()
+        cache.set(key, generations, ttl, frozen)
+    if orm_context.is_orm_statement:
+        return loading.merge_frozen_result(session, orm_context.statement, frozen, load=False)()
+    return frozen()
+
+
+def track_writes(session, transaction, connection):
+    """``after_begin`` hook: collect the tables written on ``connection`` until the session commits."""
+    connection.info["written_tables"] = written = set()
+    session.info.setdefault("query_cache_writes", []).append(written)
+
+
+def record_write(connection, clauseelement, multiparams, params, execution_options, result):
+    # writes run with query_cache_invalidate=False leave cached results alone until their TTL runs out
+    written = connection.info.get("written_tables")
+    if written is not None and getattr(clauseelement, "is_dml", False) and \
+            execution_options.get("query_cache_invalidate", True):
+        written.add(clauseelement.table.name)
+
+
+def invalidate_queries(session):
+    tables = written_tables(session)
+    forget_writes(session)
+    if tables and current_app.query_cache is not None:
+        current_app.query_cache.invalidate(tables)
+
+
+def forget_writes(session, transaction=None):
+    if transaction is None or transaction.parent is None:
+        for written in session.info.pop("query_cache_writes", ()):
+            written.clear()
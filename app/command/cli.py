@@ -1,8 +1,26 @@
 import os
 import click
+from flask import current_app
+from flask.cli import ScriptInfo
+from app import db
 from app.command import bp
 
 
+class LazyMigrateGroup(click.Group):
+    """The Flask-Migrate ``db`` group, importing Alembic only when a ``db`` command actually runs."""
+
+    def make_context(self, info_name, args, parent=None, **extra):
+        from flask_migrate import Migrate
+        from flask_migrate.cli import db as db_group
+        app = parent.ensure_object(ScriptInfo).load_app()
+        if "migrate" not in app.extensions:
+            Migrate(app, db)
+        return db_group.make_context(info_name, args, parent=parent, **extra)
+
+
+bp.cli.add_command(LazyMigrateGroup("db", help="Perform database migrations."))
+
+
 @bp.cli.group()
 def translate():
     """Translation and localization commands."""
@@ -37,3 +55,307 @@ def compile():
     """Compile all languages"""
     if os.system("pybabel compile -d app/translations"):
         raise RuntimeError("compile command failed")
+
+
+@bp.cli.group()
+def timeline():
+    """Home timeline commands."""
+    pass
+
+
+@timeline.command()
+def rebuild():
+    """Recount followers and rebuild all pushed timelines."""
+    from app.timeline import rebuild as rebuild_timelines
+    rebuild_timelines()
+
+
+@bp.cli.group()
+def graph():
+    """Follow graph commands."""
+    pass
+
+
+@graph.command()
+def stats():
+    """Load the whole follow graph and report its memory use."""
+    from sqlalchemy import select, func
+    from app.graph import FollowGraph, load_all
+    from app.models import User
+    users = db.session.scalar(select(func.count()).select_from(User))
+    report = load_all(FollowGraph(max(users, 1))).stats()
+    click.echo(f"users with followees: {report['users']}")
+    click.echo(f"edges:                {report['edges']}")
+    click.echo(f"memory:               {report['bytes'] / 1024 / 1024:.1f} MiB")
+    click.echo(f"per million edges:    {report['bytes_per_million_edges'] / 1024 / 1024:.1f} MiB")
+
+
+@bp.cli.group()
+def suggestions():
+    """"Who to follow" commands."""
+    pass
+
+
+@suggestions.command()
+@click.option("--top", default=10, help="Suggestions to keep per user.")
+@click.option("--chunk-size", default=10000, help="Users scored per batch.")
+@click.option("--changed", is_flag=True, help="Only refresh users whose follows changed.")
+def refresh(top, chunk_size, changed):
+    """Recompute friends-of-friends follow suggestions."""
+    from app.suggestions import refresh as refresh_suggestions
+    report = refresh_suggestions(top=top, chunk_size=chunk_size, only_changed=changed)
+    click.echo(f"{report['users']} users, {report['edges']} edges, {report['suggestions']} suggestions "
+               f"in {report['seconds']:.1f}s")
+
+
+@bp.cli.group()
+def explore():
+    """Explore page commands."""
+    pass
+
+
+@explore.command("refresh")
+def refresh_explore():
+    """Score new posts into the hot ranking."""
+    ranking = current_app.hot_ranking
+    if ranking is None:
+        raise click.ClickException("the hot ranking is disabled (HOT_SIZE=0 or sharded posts)")
+    click.echo(f"{ranking.refresh()} posts scored")
+
+
+@bp.cli.command("export")
+@click.argument("username")
+@click.option("--format", "format", type=click.Choice(["ndjson", "csv"]), default="ndjson")
+@click.option("--after", default=None, help="Resume after this row cursor.")
+@click.option("--gzip", "compress", is_flag=True, help="Gzip the output.")
+@click.option("--output", type=click.File("wb"), default="-", help="File to write (default: stdout).")
+def export_command(username, format, after, compress, output):
+    """Stream a user's posts and messages."""
+    from sqlalchemy import select
+    from app.export import export
+    from app.models import User
+    user = db.session.scalar(select(User).where(User.username == username))
+    if user is None:
+        raise click.ClickException(f"no user named {username}")
+    try:
+        for chunk in export(user, format, after, compress):
+            output.write(chunk if compress else chunk.encode("utf-8"))
+    except ValueError as e:
+        raise click.ClickException(f"bad cursor: {e}")
+
+
+@bp.cli.group()
+def templates():
+    """Template commands."""
+    pass
+
+
+@templates.command()
+def precompile():
+    """Compile every template into TEMPLATE_CACHE_DIR."""
+    from app.templating import precompile as precompile_templates
+    if not current_app.config["TEMPLATE_CACHE_DIR"]:
+        raise click.ClickException("the template cache is disabled (TEMPLATE_CACHE_DIR is empty)")
+    count, seconds = precompile_templates(current_app)
+    click.echo(f"{count} templates compiled into {current_app.config['TEMPLATE_CACHE_DIR']} in {seconds * 1000:.0f} ms")
+
+
+@bp.cli.group()
+def notifications():
+    """Notification commands."""
+    pass
+
+
+@notifications.command()
+@click.option("--ttl", default=None, type=int, help="Age in seconds after which notifications are deleted.")
+@click.option("--batch-size", default=500, help="Rows deleted per transaction.")
+def compact(ttl, batch_size):
+    """Delete expired notifications in small batches."""
+    from app.notifications import compact as compact_notifications
+    ttl = ttl if ttl is not None else current_app.config["NOTIFICATION_TTL"]
+    click.echo(f"{compact_notifications(ttl, batch_size)} notifications deleted")
+
+
+@bp.cli.group()
+def posts():
+    """Post storage commands."""
+    pass
+
+
+@posts.command("archive")
+@click.option("--batch-size", default=1000, help="Posts moved per transaction.")
+def archive_posts(batch_size):
+    """Move posts older than POST_HOT_MONTHS months into the monthly archive."""
+    from app.archive import archive, hot_window_start
+    if current_app.shards is not None:
+        raise click.ClickException("archiving reads the primary post table; it does not support shards yet")
+    for month, rows in archive(hot_window_start(), batch_size).items():
+        click.echo(f"{month // 100}-{month % 100:02d}: {rows} posts archived")
+
+
+@bp.cli.group()
+def shards():
+    """Post and message shard commands."""
+    pass
+
+
+@shards.command("init")
+@click.option("--batch-size", default=1000, help="Rows copied per transaction.")
+def shards_init(batch_size):
+    """Create the shard tables, pin every bucket in the shard directory and copy the existing posts and
+    messages over from the primary database."""
+    router = current_app.shards
+    if router is None:
+        raise click.ClickException("sharding is off (SHARD_DATABASE_URLS is empty)")
+    click.echo(f"{router.create_all(batch_size)} rows copied from the primary database")
+    for shard in range(router.count):
+        click.echo(f"shard{shard}: {list(router.directory.values()).count(shard)} buckets")
+
+
+@shards.command("rebalance")
+@click.option("--batch-size", default=1000, help="Rows copied per transaction.")
+@click.option("--dry-run", is_flag=True, help="Only print the planned moves.")
+def shards_rebalance(batch_size, dry_run):
+    """Move buckets until every shard holds an even share, e.g. after adding a shard."""
+    from app.shards import rebalance
+    if current_app.shards is None:
+        raise click.ClickException("sharding is off (SHARD_DATABASE_URLS is empty)")
+
+    def progress(bucket, source, target, rows):
+        click.echo(f"bucket {bucket}: shard{source} -> shard{target}, {rows} rows")
+
+    moves = rebalance(batch_size, dry_run=dry_run, progress=progress)
+    if dry_run:
+        for bucket, source, target in moves:
+            click.echo(f"bucket {bucket}: shard{source} -> shard{target}")
+    click.echo(f"{len(moves)} buckets {'to move' if dry_run else 'moved'}")
+
+
+@bp.cli.command()
+@click.option("--concurrency", "-c", default=1, help="Worker processes.")
+@click.option("--burst", is_flag=True, help="Exit once no job is due.")
+def worker(concurrency, burst):
+    """Run queued background jobs."""
+    from app.jobs import work
+    if concurrency == 1:
+        click.echo(f"{work(burst=burst)} jobs run")
+        return
+    import multiprocessing
+    app = current_app._get_current_object()
+
+    def run_worker():
+        db.engine.dispose(close=False)
+        if app.shards is not None:
+            app.shards.dispose(close=False)
+        with app.app_context():
+            work(burst=burst)
+
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=run_worker, daemon=True) for i in range(concurrency)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+
+
+@bp.cli.group()
+def jobs():
+    """Background job queue commands."""
+    pass
+
+
+@jobs.command("stats")
+def jobs_stats():
+    """Show queue depth and latency."""
+    from app.jobs import queue_stats
+    for name, value in queue_stats().items():
+        click.echo(f"{name:22} {value:.1f}" if isinstance(value, float) else f"{name:22} {value}")
+
+
+@bp.cli.group("import")
+def import_():
+    """Bulk import commands."""
+    pass
+
+
+@import_.command("posts")
+@click.argument("source", type=click.File("r", encoding="utf-8"))
+@click.option("--batch-size", default=5000, help="Posts inserted per transaction.")
+@click.option("--workers", default=None, type=int, help="Language detection processes (default: one per CPU).")
+@click.option("--no-detect", is_flag=True, help="Leave the language of posts without one empty.")
+def import_posts(source, batch_size, workers, no_detect):
+    """Import posts from an NDJSON file ("-" for stdin)."""
+    from app.importer import import_posts as run_import
+    if current_app.shards is not None:
+        raise click.ClickException("bulk import writes to the primary database; it does not support shards yet")
+
+    def progress(stats):
+        click.echo(f"{stats['rows']} rows, {stats['imported']} imported, {stats['skipped']} skipped, "
+                   f"{stats['rows'] / stats['seconds']:.0f} rows/s", err=True)
+
+    stats = run_import(source, batch_size=batch_size, workers=workers, detect=not no_detect, progress=progress)
+    click.echo(f"{stats['imported']} posts imported, {stats['skipped']} skipped, {stats['indexed']} indexed "
+               f"in {stats['seconds']:.1f}s ({stats['rows'] / stats['seconds']:.0f} rows/s)")
+
+
+@import_.command("follows")
+@click.argument("source", type=click.File("r", encoding="utf-8"))
+@click.option("--user", default=None, help="Make this user follow every username in SOURCE, one per line.")
+@click.option("--batch-size", default=1000, help="Follows created per transaction.")
+def import_follows(source, user, batch_size):
+    """Import follows from a file of "follower followed" username pairs ("-" for stdin)."""
+    from app.importer import import_follows as run_import, read_edges
+
+    def progress(stats):
+        click.echo(f"{stats['rows']} rows, {stats['followed']} followed, {stats['existing']} existing, "
+                   f"{stats['skipped']} skipped, {stats['rows'] / stats['seconds']:.0f} rows/s", err=True)
+
+    stats = run_import(read_edges(source, user), batch_size=batch_size, progress=progress)
+    click.echo(f"{stats['followed']} follows created, {stats['existing']} existing, {stats['skipped']} skipped "
+               f"in {stats['seconds']:.1f}s ({stats['rows'] / stats['seconds']:.0f} rows/s)")
+
+
+@bp.cli.group()
+def passwords():
+    """Password hashing commands."""
+    pass
+
+
+@passwords.command("benchmark")
+@click.option("--seconds", default=3.0, help="Length of each measurement.")
+@click.option("--storm", default=8, help="Threads logging in during the storm.")
+@click.option("--workers", default=None, type=int, help="Hashing processes (default: PASSWORD_HASH_WORKERS).")
+def passwords_benchmark(seconds, storm, workers):
+    """Measure logins/sec per core and timeline latency during a login storm."""
+    from app.passwords import benchmark
+    report = benchmark(seconds, storm, workers)
+    click.echo(f"{report['method']}: {report['logins_per_core']:.1f} logins/s per core")
+    for mode in ("inline", "pool"):
+        result = report[mode]
+        click.echo(f"{mode} ({result['workers']} workers): {result['logins_per_second']:.1f} logins/s, "
+                   f"{result['rejected']} rejected, timeline p50/p95 "
+                   f"{result['timeline_p50'] * 1000:.1f}/{result['timeline_p95'] * 1000:.1f} ms idle, "
+                   f"{result['storm_timeline_p50'] * 1000:.1f}/{result['storm_timeline_p95'] * 1000:.1f} ms in the storm")
+
+
+@bp.cli.command("startup-profile")
+@click.option("--top", default=15, help="Number of packages to list.")
+@click.option("--budget", default=None, type=float, help="Fail if startup takes longer (seconds).")
+@click.option("--no-template-cache", is_flag=True, help="Compile templates from source, ignoring TEMPLATE_CACHE_DIR.")
+def startup_profile(top, budget, no_template_cache):
+    """Report import time per package and time to the first request."""
+    from app.startup import profile_startup
+    report = profile_startup(template_cache=not no_template_cache)
+    for name, seconds in list(report["imports"].items())[:top]:
+        click.echo(f"{seconds * 1000:10.1f} ms  {name}")
+    click.echo(f"create_app:     {report['create_app'] * 1000:.1f} ms")
+    click.echo(f"first request:  {report['first_request'] * 1000:.1f} ms")
+    click.echo(f"total:          {report['total'] * 1000:.1f} ms")
+    if report["eager"]:
+        click.echo("imported at startup: " + ", ".join(report["eager"]))
+    if budget is not None and report["total"] > budget:
+        raise click.ClickException(f"startup took {report['total']:.2f}s, budget is {budget:.2f}s")
@@ -0,0 +1,66 @@
+import gzip
+from datetime import timezone
+from functools import wraps
+from hashlib import sha1
+from flask import request, session, make_response, current_app
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def conditional(version):
+    """Answer a GET with 304 when the client's ETag matches ``version(*args, **kwargs)``.
+
+    ``version`` returns a tuple of cheap version tokens and an optional ``Last-Modified``
+    datetime; the view itself only runs when the tokens have changed.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method != "GET" or session.get("_flashes"):
+                return f(*args, **kwargs)
+            tokens, last_modified = version(*args, **kwargs)
+            if last_modified is not None and last_modified.tzinfo is None:
+                last_modified = last_modified.replace(tzinfo=timezone.utc)
+            etag = sha1(repr(tokens).encode("utf-8")).hexdigest()
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                not_modified = last_modified is not None and request.if_modified_since is not None and \
+                               last_modified.replace(microsecond=0) <= request.if_modified_since
+            if not_modified:
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
+def compress_response(response):
+    if response.direct_passthrough or response.is_streamed or response.status_code < 200 or response.status_code >= 300 \
+            or "Content-Encoding" in response.headers \
+            or response.mimetype not in current_app.config["COMPRESS_MIMETYPES"]:
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config["COMPRESS_MIN_SIZE"]:
+        return response
+    encodings = request.accept_encodings
+    if brotli is not None and encodings["br"]:
+        response.set_data(brotli.compress(data, quality=current_app.config["COMPRESS_BROTLI_QUALITY"]))
+        response.headers["Content-Encoding"] = "br"
+    elif encodings["gzip"]:
+        response.set_data(gzip.compress(data, compresslevel=current_app.config["COMPRESS_LEVEL"]))
+        response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    return response
@@ -1,35 +1,39 @@
 from flask import current_app
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-from app import mail
-from threading import Thread
-from flask_mail import Message
-import app
+from app.outbound import upstream
 
 
-def sendmail(subject, sender, recipients, html_body):
+def get_mail():
+    if "mail" not in current_app.extensions:
+        from flask_mail import Mail
+        Mail(current_app._get_current_object())
+    return current_app.extensions["mail"]
+
+
+def get_sendgrid():
+    if "sendgrid" not in current_app.extensions:
+        from sendgrid import SendGridAPIClient
+        client = SendGridAPIClient(api_key=current_app.config["SENDGRID_API_KEY"])
+        client.client.timeout = current_app.config["SENDGRID_TIMEOUT"]
+        current_app.extensions["sendgrid"] = client
+    return current_app.extensions["sendgrid"]
+
+
+def deliver_sendgrid(subject, sender, recipients, html_body):
+    from sendgrid.helpers.mail import Mail
     message = Mail(
         from_email=sender,
         to_emails=recipients,
         subject=subject,
         html_content=html_body)
-    try:
-        sg = SendGridAPIClient(api_key=current_app.config["SENDGRID_API_KEY"])
-        response = sg.send(message)
-        print(response.status_code)
-        print(response.body)
-        print(response.headers)
-    except Exception as e:
-        print(f"error: {e}")
+    response = upstream("sendgrid").call(get_sendgrid().send, message)
+    current_app.logger.info("SendGrid accepted message: %s", response.status_code)
 
 
-def send_email(subject, sender, recipients, text_body, html_body):
-    msg = Message(subject, sender=sender, recipients=recipients)
-    msg.body = text_body
-    msg.html = html_body
-    Thread(target=send_async_email, args=(app, msg)).start()
+def sendmail(subject, sender, recipients, html_body):
+    from app.tasks import deliver_mail
+    deliver_mail.delay(subject, sender, recipients, html_body)
 
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+def send_email(subject, sender, recipients, text_body, html_body):
+    from app.tasks import deliver_smtp_mail
+    deliver_smtp_mail.delay(subject, sender, recipients, text_body, html_body)
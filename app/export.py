@@ -0,0 +1,116 @@
+import csv
+import heapq
+import io
+import json
+import zlib
+from datetime import datetime
+from sqlalchemy import select, or_, and_
+from app import db
+from app.models import User, Post, Message
+from app.archive import archived_rows
+from app.shards import routed, scatter
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+KINDS = ["archive", "post", "message"]
+CSV_FIELDS = ["type", "id", "timestamp", "sender", "recipient", "language", "body", "cursor"]
+
+
+def make_cursor(kind, timestamp, id):
+    return "{},{},{}".format(kind, timestamp.isoformat(), id)
+
+
+def parse_cursor(cursor):
+    """Split a ``kind,timestamp,id`` cursor, raising ValueError if it is malformed."""
+    kind, timestamp, id = cursor.split(",")
+    if kind not in KINDS:
+        raise ValueError("unknown row type {!r}".format(kind))
+    return kind, datetime.fromisoformat(timestamp), int(id)
+
+
+def after(columns, cursor):
+    timestamp, id = columns
+    return or_(timestamp > cursor[1], and_(timestamp == cursor[1], id > cursor[2]))
+
+
+def export_rows(user, cursor=None, batch_size=1000):
+    """Yield ``user``'s archived and current posts, then the messages they sent or received, as dicts in
+    ``(timestamp, id)`` order.
+
+    Rows are fetched as plain tuples through a server-side cursor, ``batch_size`` at a time, so
+    memory does not grow with the account. Every row carries the ``cursor`` to resume after it.
+    """
+    cursor = parse_cursor(cursor) if cursor else None
+    if cursor is None or cursor[0] == "archive":
+        # archived posts come first and are only read while the cursor is still among them
+        for id, timestamp, language, body in archived_rows(user, cursor and cursor[1:], batch_size):
+            yield {"type": "post", "id": id, "timestamp": timestamp.isoformat(), "sender": user.username,
+                   "recipient": None, "language": language, "body": body,
+                   "cursor": make_cursor("archive", timestamp, id)}
+        cursor = None
+    if cursor is None or cursor[0] == "post":
+        query = select(Post.id, Post.timestamp, Post.language, Post.body).where(Post.user_id == user.id) \
+            .order_by(Post.timestamp, Post.id).execution_options(yield_per=batch_size)
+        if cursor is not None:
+            query = query.where(after((Post.timestamp, Post.id), cursor))
+        for id, timestamp, language, body in db.session.execute(query, bind_arguments=routed(user.id)):
+            yield {"type": "post", "id": id, "timestamp": timestamp.isoformat(), "sender": user.username,
+                   "recipient": None, "language": language, "body": body,
+                   "cursor": make_cursor("post", timestamp, id)}
+        cursor = None
+    query = select(Message.id, Message.timestamp, Message.sender_id, Message.recipient_id, Message.body) \
+        .where(or_(Message.sender_id == user.id, Message.recipient_id == user.id)) \
+        .order_by(Message.timestamp, Message.id).execution_options(yield_per=batch_size)
+    if cursor is not None:
+        query = query.where(after((Message.timestamp, Message.id), cursor))
+    # the user's conversations may live on several shards; merge their ordered streams
+    usernames = {user.id: user.username}
+    for id, timestamp, sender_id, recipient_id, body in heapq.merge(*scatter(query),
+                                                                    key=lambda row: (row.timestamp, row.id)):
+        for user_id in (sender_id, recipient_id):
+            if user_id not in usernames:
+                usernames[user_id] = db.session.scalar(select(User.username).where(User.id == user_id))
+        yield {"type": "message", "id": id, "timestamp": timestamp.isoformat(), "sender": usernames[sender_id],
+               "recipient": usernames[recipient_id], "language": None, "body": body,
+               "cursor": make_cursor("message", timestamp, id)}
+
+
+def to_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+
+def to_csv(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_FIELDS)
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def gzip_chunks(chunks, level=6, flush_size=64 * 1024):
+    """Gzip a stream of text chunks on the fly, emitting compressed blocks of roughly ``flush_size`` input bytes."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    pending = 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        pending += len(data)
+        out = compressor.compress(data)
+        if pending >= flush_size:
+            out += compressor.flush(zlib.Z_SYNC_FLUSH)
+            pending = 0
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+def export(user, format="ndjson", cursor=None, compress=False, level=6):
+    """The whole export of ``user`` as an iterator of ``str`` chunks, or ``bytes`` when ``compress``."""
+    serialize = to_csv if format == "csv" else to_ndjson
+    chunks = serialize(export_rows(user, cursor))
+    return gzip_chunks(chunks, level) if compress else chunks
@@ -0,0 +1,83 @@
+import sys
+from array import array
+from bisect import bisect_left, insort
+from itertools import groupby
+from sqlalchemy import select
+from app import db
+from app.cache import LRUCache
+from app.models import User, followers
+
+
+class FollowGraph(object):
+    """Process-local cache of who each user follows, as sorted ``array('I')`` of user ids.
+
+    Entries are tagged with the follower's ``User.version``, which every follow/unfollow bumps,
+    so a change committed by another process is noticed on the next lookup and reloaded.
+    """
+
+    def __init__(self, maxsize):
+        self.entries = LRUCache(maxsize)
+
+    def followees(self, user):
+        entry = self.entries.get(user.id)
+        if entry is None or entry[0] != user.version:
+            ids = db.session.scalars(select(followers.c.followed_id)
+                                     .where(followers.c.follower_id == user.id)
+                                     .order_by(followers.c.followed_id))
+            entry = (user.version, array("I", ids))
+            self.entries.set(user.id, entry)
+        return entry[1]
+
+    def is_following(self, user, followed_id):
+        ids = self.followees(user)
+        i = bisect_left(ids, followed_id)
+        return i < len(ids) and ids[i] == followed_id
+
+    def apply(self, changes):
+        """Apply committed ``(follower_id, followed_id, added)`` changes to the loaded entries."""
+        updated = {}
+        for follower_id, followed_id, added in changes:
+            if follower_id not in updated:
+                entry = self.entries.get(follower_id)
+                if entry is None:
+                    continue
+                # copy, so concurrent readers keep bisecting a consistent array
+                updated[follower_id] = (entry[0] + 1, array("I", entry[1]))
+            ids = updated[follower_id][1]
+            i = bisect_left(ids, followed_id)
+            present = i < len(ids) and ids[i] == followed_id
+            if added and not present:
+                insort(ids, followed_id)
+            elif not added and present:
+                del ids[i]
+        for follower_id, entry in updated.items():
+            self.entries.set(follower_id, entry)
+
+    def stats(self):
+        entries = self.entries.values()
+        edges = sum(len(ids) for version, ids in entries)
+        arrays = sum(sys.getsizeof(ids) for version, ids in entries)
+        overhead = sum(sys.getsizeof(entry) for entry in entries)
+        total = arrays + overhead
+        return {
+            "users": len(entries),
+            "edges": edges,
+            "bytes": total,
+            "bytes_per_million_edges": total * 1000000 // edges if edges else 0,
+        }
+
+
+def init_follow_graph(app):
+    if not app.config["FOLLOW_GRAPH_SIZE"]:
+        return None
+    return FollowGraph(app.config["FOLLOW_GRAPH_SIZE"])
+
+
+def load_all(graph):
+    """Load every user's followees into ``graph`` with one ordered scan of ``followers``."""
+    versions = {id: version for id, version in db.session.execute(select(User.id, User.version))}
+    edges = db.session.execute(select(followers.c.follower_id, followers.c.followed_id)
+                               .order_by(followers.c.follower_id, followers.c.followed_id))
+    for follower_id, rows in groupby(edges, key=lambda edge: edge[0]):
+        graph.entries.set(follower_id, (versions[follower_id], array("I", (row[1] for row in rows))))
+    return graph
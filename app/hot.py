@@ -0,0 +1,112 @@
+import math
+import os
+import threading
+from datetime import timezone
+from time import time, sleep
+from sqlalchemy import select, insert, delete, func
+from app import db
+from app.models import User, Post, hot_post
+from app.pagination import keyset
+
+
+def hot_score(timestamp, follower_count, decay):
+    """Time-decayed rank of a post: every ``decay`` seconds of age weighs as much as 10x the author's reach.
+
+    The age term is the post's own timestamp, so a score never changes once computed and newer
+    posts simply outrank older ones; that keeps the ranking incremental.
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return math.log10(1 + follower_count) + timestamp.timestamp() / decay
+
+
+class HotRanking(object):
+    """Bounded list of the ``size`` best scored post ids, kept in ``hot_post`` and mirrored in memory.
+
+    Scoring is done by one process at a time: the ``refresh_hot_ranking`` periodic job (or
+    ``flask explore refresh``) scores the posts written since the last run and trims the table
+    back to ``size`` rows. Every web process reloads ``ids`` in a background thread every
+    ``interval`` seconds, so explore pages are sliced from memory and hydrated with one ``IN`` query.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.size = app.config["HOT_SIZE"]
+        self.interval = app.config["HOT_REFRESH_INTERVAL"]
+        self.decay = app.config["HOT_DECAY"]
+        self.ids = []
+        self.version = None
+        self.loaded_at = None
+        self._pid = None
+
+    def _ensure_timer(self):
+        if self.interval and self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="hot-refresh", daemon=True).start()
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.reload()
+                except Exception as e:
+                    self.app.logger.warning("Could not reload the hot ranking: %r", e)
+                    db.session.rollback()
+
+    def refresh(self, batch_size=1000):
+        """Score the posts newer than the newest ranked one and trim to ``size``. Returns posts scored."""
+        since = db.session.scalar(select(func.max(hot_post.c.post_id))) or 0
+        query = select(Post.id, Post.timestamp, User.follower_count).join(User, User.id == Post.user_id) \
+            .where(Post.id > since).order_by(Post.id).execution_options(yield_per=batch_size)
+        scored = 0
+        for partition in db.session.execute(query).partitions():
+            db.session.execute(insert(hot_post), [
+                {"post_id": id, "score": hot_score(timestamp, follower_count, self.decay)}
+                for id, timestamp, follower_count in partition])
+            scored += len(partition)
+        threshold = db.session.scalar(select(hot_post.c.score).order_by(hot_post.c.score.desc())
+                                      .offset(self.size - 1).limit(1))
+        if threshold is not None:
+            db.session.execute(delete(hot_post).where(hot_post.c.score < threshold))
+        db.session.commit()
+        return scored
+
+    def reload(self):
+        self.ids = list(db.session.scalars(select(hot_post.c.post_id)
+                                           .order_by(hot_post.c.score.desc(), hot_post.c.post_id.desc())
+                                           .limit(self.size)))
+        self.version = hash(tuple(self.ids))
+        self.loaded_at = time()
+
+    def current(self):
+        """The ranked post ids, read from the DB only before the first background refresh."""
+        if self.loaded_at is None or not self.interval:
+            self.reload()
+        self._ensure_timer()
+        return self.ids
+
+    def unranked(self, before, limit):
+        """A newest-first keyset page of the posts left out of the ranking, after the ``before`` cursor,
+        and whether there are more; explore carries on with these once the ranking runs out."""
+        query = keyset(select(Post).where(Post.id.not_in(self.current())), Post.timestamp, Post.id, before, limit)
+        posts = db.session.scalars(query).all()
+        return posts[:limit], len(posts) > limit
+
+    def page(self, page, per_page):
+        """Posts for ``page`` of the ranking and whether there is a next page, or None if nothing is ranked."""
+        ids = self.current()
+        if not ids:
+            return None
+        ids = ids[(page - 1) * per_page:page * per_page + 1]
+        query = select(Post).where(Post.id.in_(ids[:per_page])).execution_options(query_cache=self.interval or 60)
+        posts = {post.id: post for post in db.session.scalars(query)}
+        return [posts[id] for id in ids[:per_page] if id in posts], len(ids) > per_page
+
+
+def init_hot_ranking(app):
+    # hot_post references the primary post table, which sharding leaves empty
+    if not app.config["HOT_SIZE"] or app.config["SHARD_DATABASE_URLS"]:
+        return None
+    return HotRanking(app)
@@ -0,0 +1,188 @@
+import json
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from time import perf_counter
+from flask import current_app
+from sqlalchemy import select, insert, update, func, tuple_, bindparam
+from app import db
+from app.models import User, Post, followers, timeline
+from app.sql import insert_ignore
+from app.timeline import fan_out_since
+
+
+def detect_language(text):
+    from langdetect import detect, DetectorFactory, LangDetectException
+    DetectorFactory.seed = 0
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ""
+
+
+def read_posts(lines):
+    """Parse NDJSON posts, as written by ``flask export``: ``username`` (or ``sender``), ``body`` and
+    optional ``timestamp`` and ``language``. Non-post rows are ignored; malformed lines yield None."""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+            if row.get("type", "post") != "post":
+                continue
+            post = {"username": row.get("username") or row["sender"], "body": row["body"],
+                    "language": row.get("language")}
+            if row.get("timestamp"):
+                post["timestamp"] = datetime.fromisoformat(row["timestamp"])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            yield None
+            continue
+        yield post
+
+
+def resolve_authors(usernames, authors):
+    """Add the ids of ``usernames`` not yet in ``authors`` (None for unknown names), one query per 500 names."""
+    missing = sorted(set(usernames) - authors.keys())
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        authors.update(dict.fromkeys(chunk))
+        authors.update({username: id for username, id in
+                        db.session.execute(select(User.username, User.id).where(User.username.in_(chunk)))})
+
+
+def import_posts(lines, batch_size=5000, workers=None, detect=True, progress=None):
+    """Bulk insert the posts read from ``lines`` and return import statistics.
+
+    Each batch resolves its authors with one query, detects missing languages in a process pool
+    and is inserted with a single executemany in its own transaction, bypassing the per-object
+    session hooks. Timeline fan-out and search indexing run once over all imported posts at the end.
+    ``progress`` is called with the running statistics after every batch.
+    """
+    started = perf_counter()
+    first_id = db.session.scalar(select(func.max(Post.id))) or 0
+    max_length = Post.body.type.length
+    stats = {"rows": 0, "imported": 0, "skipped": 0, "indexed": 0}
+    authors = {}
+    pool = ProcessPoolExecutor(workers) if detect else None
+    try:
+        posts = read_posts(lines)
+        while batch := list(islice(posts, batch_size)):
+            stats["rows"] += len(batch)
+            valid = [post for post in batch if post is not None and post["body"] and len(post["body"]) <= max_length]
+            resolve_authors([post["username"] for post in valid], authors)
+            rows = []
+            for post in valid:
+                user_id = authors[post.pop("username")]
+                if user_id is not None:
+                    post["user_id"] = user_id
+                    rows.append(post)
+            if pool is not None:
+                undetected = [row for row in rows if row["language"] is None]
+                languages = pool.map(detect_language, [row["body"] for row in undetected], chunksize=256)
+                for row, language in zip(undetected, languages):
+                    row["language"] = language
+            if rows:
+                db.session.execute(insert(Post), rows)
+                db.session.commit()
+            stats["imported"] += len(rows)
+            stats["skipped"] += len(batch) - len(rows)
+            if progress is not None:
+                progress(dict(stats, seconds=perf_counter() - started))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    if stats["imported"]:
+        fan_out_since(first_id)
+        db.session.commit()
+        stats["indexed"] = Post.reindex(Post.id > first_id)
+    stats["seconds"] = perf_counter() - started
+    return stats
+
+
+def read_edges(lines, follower=None):
+    """Parse follow edges, one ``follower followed`` pair of usernames per line (comma or space
+    separated). With ``follower`` each line is a single username for ``follower`` to follow.
+    Blank lines and ``#`` comments are ignored; malformed lines yield None."""
+    for line in lines:
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        names = re.split(r"[\s,]+", line)
+        if follower is not None:
+            names.insert(0, follower)
+        yield tuple(names) if len(names) == 2 else None
+
+
+def follow_all(edges):
+    """Add the ``(follower_id, followed_id)`` follows in ``edges`` that do not exist yet, in bulk.
+
+    Missing rows are inserted with one executemany that ignores conflicts. Follower counts and
+    ``User.version`` are then updated with one executemany, and the new followers' timelines are
+    backfilled with one ``INSERT ... SELECT``, instead of one round of each per follow.
+    Returns the edges added. The caller commits.
+    """
+    edges = {(follower_id, followed_id) for follower_id, followed_id in edges if follower_id != followed_id}
+    if not edges:
+        return []
+    existing = set(db.session.execute(select(followers.c.follower_id, followers.c.followed_id)
+                                      .where(tuple_(followers.c.follower_id, followers.c.followed_id).in_(edges))))
+    added = sorted(edges - existing)
+    if not added:
+        return []
+    insert_ignore(followers, [{"follower_id": follower_id, "followed_id": followed_id}
+                              for follower_id, followed_id in added])
+    gained = Counter(followed_id for follower_id, followed_id in added)
+    touched = {id for edge in added for id in edge}
+    db.session.execute(update(User.__table__).where(User.id == bindparam("user_id"))
+                       .values(version=User.version + 1, follower_count=User.follower_count + bindparam("gained")),
+                       [{"user_id": id, "gained": gained.get(id, 0)} for id in sorted(touched)])
+    if current_app.shards is None:
+        backfill_all(added)
+    db.session.info.setdefault("follow_changes", []).extend(
+        (follower_id, followed_id, True) for follower_id, followed_id in added)
+    return added
+
+
+def backfill_all(edges):
+    """Copy the latest posts of every light author followed in ``edges`` into the follower's timeline."""
+    authors = select(User.id).where(User.id.in_({followed_id for follower_id, followed_id in edges}),
+                                    User.follower_count < current_app.config["TIMELINE_HEAVY_THRESHOLD"])
+    ranked = select(Post.id, Post.user_id, Post.timestamp, func.row_number().over(
+        partition_by=Post.user_id, order_by=(Post.timestamp.desc(), Post.id.desc())).label("rank")) \
+        .where(Post.user_id.in_(authors)).subquery()
+    entries = select(followers.c.follower_id, ranked.c.id, ranked.c.user_id, ranked.c.timestamp) \
+        .join(ranked, ranked.c.user_id == followers.c.followed_id) \
+        .where(ranked.c.rank <= current_app.config["TIMELINE_BACKFILL"],
+               tuple_(followers.c.follower_id, followers.c.followed_id).in_(edges))
+    db.session.execute(insert(timeline).from_select(["user_id", "post_id", "author_id", "timestamp"], entries))
+
+
+def import_follows(edges, batch_size=1000, progress=None):
+    """Create the follows read from ``edges`` (``(follower, followed)`` usernames, or None for a
+    malformed row) and return import statistics.
+
+    Each batch resolves its usernames with one query per 500 names and goes through
+    ``follow_all`` in its own transaction. ``progress`` is called with the running statistics
+    after every batch.
+    """
+    started = perf_counter()
+    stats = {"rows": 0, "followed": 0, "existing": 0, "skipped": 0}
+    users = {}
+    edges = iter(edges)
+    while batch := list(islice(edges, batch_size)):
+        stats["rows"] += len(batch)
+        valid = [edge for edge in batch if edge is not None]
+        resolve_authors([name for edge in valid for name in edge], users)
+        ids = [(users[follower], users[followed]) for follower, followed in valid
+               if users[follower] is not None and users[followed] is not None and follower != followed]
+        added = follow_all(ids)
+        db.session.commit()
+        stats["followed"] += len(added)
+        stats["existing"] += len(ids) - len(added)
+        stats["skipped"] += len(batch) - len(ids)
+        if progress is not None:
+            progress(dict(stats, seconds=perf_counter() - started))
+    stats["seconds"] = perf_counter() - started
+    return stats
@@ -0,0 +1,214 @@
+import importlib
+import json
+import os
+import socket
+from datetime import datetime, timezone, timedelta
+from time import sleep
+from flask import current_app
+from sqlalchemy import select, insert, update, delete, func
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import job as job_table, job_schedule
+
+registry = {}
+
+
+def utcnow():
+    return datetime.now(tz=timezone.utc).replace(tzinfo=None)
+
+
+class Job(object):
+    """A function that can also be run later by ``flask worker``; see :func:`job`."""
+
+    def __init__(self, fn, max_attempts=None, backoff=None, every=None):
+        self.fn = fn
+        self.name = "{}.{}".format(fn.__module__, fn.__qualname__)
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.every = every
+        self.__doc__ = fn.__doc__
+
+    def __call__(self, *args, **kwargs):
+        return self.fn(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        """Queue a run as part of the current transaction; it is picked up once the caller commits."""
+        return enqueue(self, args, kwargs)
+
+    def schedule(self, run_at, *args, **kwargs):
+        return enqueue(self, args, kwargs, run_at)
+
+
+def job(max_attempts=None, backoff=None, every=None):
+    """Register a background job. Arguments must be JSON serializable.
+
+    ``max_attempts`` and ``backoff`` (seconds, doubled after every failure) default to
+    ``JOB_MAX_ATTEMPTS`` and ``JOB_BACKOFF``; with ``every`` (seconds) the workers also run it
+    periodically, once per period across all of them.
+    """
+    def decorator(fn):
+        registered = Job(fn, max_attempts, backoff, every)
+        registry[registered.name] = registered
+        return registered
+    return decorator
+
+
+def resolve(name):
+    if name not in registry:
+        importlib.import_module(name.rsplit(".", 1)[0])
+    return registry[name]
+
+
+def enqueue(job, args=(), kwargs=None, run_at=None):
+    """Insert a queued row for ``job`` and return its id, or run it right away with ``JOBS_EAGER``."""
+    kwargs = kwargs or {}
+    if current_app.config["JOBS_EAGER"]:
+        try:
+            job.fn(*args, **kwargs)
+        except Exception:
+            current_app.logger.exception("Job %s failed", job.name)
+        return None
+    now = utcnow()
+    result = db.session.execute(insert(job_table).values(
+        name=job.name, arguments=json.dumps({"args": list(args), "kwargs": kwargs}), status="queued",
+        max_attempts=job.max_attempts or current_app.config["JOB_MAX_ATTEMPTS"],
+        run_at=run_at or now, enqueued_at=now))
+    return result.inserted_primary_key[0]
+
+
+def claim(worker):
+    """Take the next due job, or return None. ``SKIP LOCKED`` keeps workers off each other's rows
+    where the database supports it; elsewhere (SQLite) the conditional update settles races."""
+    now = utcnow()
+    id = db.session.scalar(select(job_table.c.id)
+                           .where(job_table.c.status == "queued", job_table.c.run_at <= now)
+                           .order_by(job_table.c.run_at, job_table.c.id).limit(1)
+                           .with_for_update(skip_locked=True))
+    if id is None:
+        db.session.rollback()
+        return None
+    claimed = db.session.execute(update(job_table)
+                                 .where(job_table.c.id == id, job_table.c.status == "queued")
+                                 .values(status="running", started_at=now, worker=worker,
+                                         attempts=job_table.c.attempts + 1))
+    db.session.commit()
+    if claimed.rowcount != 1:
+        return None
+    return db.session.execute(select(job_table).where(job_table.c.id == id)).one()
+
+
+def run(row):
+    """Run a claimed job; on failure queue it again with exponential backoff until ``max_attempts``."""
+    try:
+        job = resolve(row.name)
+        arguments = json.loads(row.arguments)
+        job.fn(*arguments["args"], **arguments["kwargs"])
+        db.session.execute(update(job_table).where(job_table.c.id == row.id)
+                           .values(status="done", finished_at=utcnow(), error=None))
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception("Job %s (%s) failed, attempt %d", row.id, row.name, row.attempts)
+        values = {"error": repr(e), "finished_at": utcnow()}
+        if row.attempts < row.max_attempts:
+            backoff = (registry[row.name].backoff if row.name in registry else None) or \
+                current_app.config["JOB_BACKOFF"]
+            values.update(status="queued", run_at=utcnow() + timedelta(seconds=backoff * 2 ** (row.attempts - 1)))
+        else:
+            values.update(status="failed")
+        db.session.execute(update(job_table).where(job_table.c.id == row.id).values(**values))
+        db.session.commit()
+        return False
+
+
+def requeue_stale(timeout):
+    """Queue again the jobs whose worker died while running them."""
+    result = db.session.execute(update(job_table)
+                                .where(job_table.c.status == "running",
+                                       job_table.c.started_at < utcnow() - timedelta(seconds=timeout))
+                                .values(status="queued", run_at=utcnow()))
+    db.session.commit()
+    return result.rowcount
+
+
+def schedule_periodic():
+    """Queue the periodic jobs that are due. Claiming a period is a conditional update of its
+    ``job_schedule`` row, so only one worker queues each run."""
+    now = utcnow()
+    for job in [job for job in registry.values() if job.every]:
+        next_run_at = db.session.scalar(select(job_schedule.c.next_run_at).where(job_schedule.c.name == job.name))
+        if next_run_at is None:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(job_schedule).values(name=job.name, next_run_at=now))
+                next_run_at = now
+            except IntegrityError:
+                continue
+        if next_run_at > now:
+            continue
+        claimed = db.session.execute(update(job_schedule)
+                                     .where(job_schedule.c.name == job.name,
+                                            job_schedule.c.next_run_at == next_run_at)
+                                     .values(next_run_at=now + timedelta(seconds=job.every)))
+        if claimed.rowcount == 1:
+            enqueue(job)
+    db.session.commit()
+
+
+def work(burst=False, poll=None, worker=None):
+    """Process jobs until interrupted, or with ``burst`` until none is due. Returns jobs run."""
+    import app.tasks  # noqa: F401 -- registers the periodic jobs
+    worker = worker or "{}:{}".format(socket.gethostname(), os.getpid())
+    poll = poll if poll is not None else current_app.config["JOB_POLL_INTERVAL"]
+    processed = 0
+    idle = True
+    while True:
+        if idle:
+            requeue_stale(current_app.config["JOB_TIMEOUT"])
+            schedule_periodic()
+        row = claim(worker)
+        idle = row is None
+        if row is not None:
+            run(row)
+            processed += 1
+        elif burst:
+            return processed
+        else:
+            sleep(poll)
+
+
+def queue_stats(window=3600):
+    """Queue depth and latency: jobs per status, due jobs waiting and how late the oldest is, and
+    the mean delay between due time and start over the last ``window`` seconds."""
+    now = utcnow()
+    counts = dict(db.session.execute(select(job_table.c.status, func.count()).group_by(job_table.c.status)).all())
+    due = db.session.execute(select(func.count(), func.min(job_table.c.run_at))
+                             .where(job_table.c.status == "queued", job_table.c.run_at <= now)).one()
+    started = db.session.execute(select(job_table.c.run_at, job_table.c.started_at)
+                                 .where(job_table.c.started_at >= now - timedelta(seconds=window))).all()
+    delays = [(started_at - run_at).total_seconds() for run_at, started_at in started if run_at <= started_at]
+    return {
+        "queued": counts.get("queued", 0),
+        "running": counts.get("running", 0),
+        "done": counts.get("done", 0),
+        "failed": counts.get("failed", 0),
+        "due": due[0],
+        "oldest_due_seconds": (now - due[1]).total_seconds() if due[1] is not None else 0.0,
+        "mean_latency_seconds": sum(delays) / len(delays) if delays else 0.0,
+    }
+
+
+def prune(retention, batch_size=500):
+    """Delete finished jobs older than ``retention`` seconds in small batches."""
+    cutoff = utcnow() - timedelta(seconds=retention)
+    deleted = 0
+    while True:
+        ids = db.session.scalars(select(job_table.c.id)
+                                 .where(job_table.c.status.in_(["done", "failed"]),
+                                        job_table.c.finished_at < cutoff).limit(batch_size)).all()
+        if not ids:
+            return deleted
+        db.session.execute(delete(job_table).where(job_table.c.id.in_(ids)))
+        db.session.commit()
+        deleted += len(ids)
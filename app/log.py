@@ -0,0 +1,121 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, SMTPHandler
+from flask.logging import default_handler
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "path": record.pathname,
+            "line": record.lineno,
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        if record.stack_info:
+            entry["stack_info"] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Hands records to a bounded queue and drops them when it is full, so logging never blocks a request.
+
+    The number of dropped records is reported with the next record that fits in the queue.
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.dropped:
+            warning = logging.makeLogRecord({
+                "name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                "msg": "Log queue full, dropped %d records" % self.dropped})
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                self.dropped += 1
+                return
+            self.dropped = 0
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(app):
+    formatter = JsonFormatter() if app.config["LOG_FORMAT"] == "json" else logging.Formatter(
+        "%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]")
+    handlers = []
+    if app.config["MAIL_SERVER"]:
+        auth = None
+        if app.config["MAIL_USERNAME"] or app.config["MAIL_PASSWORD"]:
+            auth = (app.config["MAIL_USERNAME"] or app.config["MAIL_PASSWORD"])
+        secure = None
+        if app.config["MAIL_USE_TLS"]:
+            secure = ()
+        mail_handler = SMTPHandler(
+            mailhost=(app.config["MAIL_SERVER"], app.config["MAIL_PORT"]),
+            fromaddr="noreply@" + app.config["MAIL_SERVER"],
+            toaddrs=app.config["ADMINS"], subject="Blog Log Failures",
+            credentials=auth, secure=secure)
+        mail_handler.setLevel(logging.ERROR)
+        handlers.append(mail_handler)
+    if app.config['LOG_TO_STDOUT']:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter)
+        stream_handler.setLevel(logging.INFO)
+        handlers.append(stream_handler)
+    else:
+        if not os.path.exists("logs"):
+            os.mkdir("logs")
+        filehandler = RotatingFileHandler("logs/blog.log", maxBytes=app.config["LOG_MAX_BYTES"],
+                                          backupCount=app.config["LOG_BACKUP_COUNT"], delay=True)
+        filehandler.setFormatter(formatter)
+        filehandler.setLevel(logging.INFO)
+        handlers.append(filehandler)
+
+    log_queue = queue.Queue(maxsize=app.config["LOG_QUEUE_SIZE"])
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(DroppingQueueHandler(log_queue))
+    app.log_listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    app.log_listener.start()
+    atexit.register(app.log_listener.stop)
+
+
+def restart_logging(app):
+    """Give a forked worker its own queue and listener thread; the parent's thread does not survive fork."""
+    listener = getattr(app, "log_listener", None)
+    if listener is None:
+        return
+    log_queue = queue.Queue(maxsize=app.config["LOG_QUEUE_SIZE"])
+    for handler in app.logger.handlers:
+        if isinstance(handler, DroppingQueueHandler):
+            handler.queue = log_queue
+    app.log_listener = QueueListener(log_queue, *listener.handlers, respect_handler_level=True)
+    app.log_listener.start()
+    atexit.register(app.log_listener.stop)
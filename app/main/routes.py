@@ -1,15 +1,28 @@
+import asyncio
+import json
+from functools import wraps
+from itertools import chain
 from datetime import datetime, timezone
 from flask_babel import get_locale
 from flask_login import current_user, login_required
-from flask import render_template, flash, url_for, request, current_app, g
-from langdetect import detect, LangDetectException
-from sqlalchemy import select
+from flask import render_template, flash, url_for, request, current_app, g, abort, Response, stream_with_context
+from sqlalchemy import select, update
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.utils import redirect
 from app.main.forms import EditProfile, EmptyForm, PostForm, MessageForm
 from app import db
-from app.models import User, Post, Message, Notification
+from app.models import User, Post, Message, Conversation, Notification
 from app.main import bp
+from app.main.versions import index_version, explore_version, user_version, user_popup_version, \
+    notifications_version
+from app.conditional import conditional
+from app.export import FORMATS, export
+from app.pagination import encode_cursor, decode_cursor
+from app.outbound import CircuitOpenError, UpstreamError, upstream_stats
 from app.translate import translate
+from app.timeline import home_timeline
+from app.archive import user_posts
+from app.shards import scatter
 from app.main.forms import SearchForm
 from flask_babel import _
 
@@ -17,31 +30,34 @@ from flask_babel import _
 @bp.route("/", methods=["GET", "POST"])
 @bp.route("/index", methods=["GET", "POST"])
 @login_required
+@conditional(index_version)
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ""
-        post = Post(body=form.post.data, author=current_user, language=language)
+        from app.tasks import detect_post_language
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        db.session.flush()
+        detect_post_language.delay(post.id)
         db.session.commit()
         flash("Your post is now live!!")
         return redirect(url_for("main.index"))
-    page = request.args.get("page", 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page, per_page=current_app.config["POSTS_PER_PAGE"],
-                        error_out=False)
-    next_url = url_for("main.index", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.index", page=posts.prev_num) if posts.prev_num else None
-    return render_template("index.html", title="Home Page", form=form, posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
+    page = max(request.args.get("page", 1, type=int), 1)
+    posts, has_next = home_timeline(current_user, page, current_app.config["POSTS_PER_PAGE"])
+    next_url = url_for("main.index", page=page + 1) if has_next else None
+    prev_url = url_for("main.index", page=page - 1) if page > 1 else None
+    return render_template("index.html", title="Home Page", form=form, posts=posts, next_url=next_url,
+                           prev_url=prev_url, suggestions=current_user.follow_suggestions())
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(tz=timezone.utc)
+        now = datetime.now(tz=timezone.utc)
+        # written on every request, so it must not expire the cached user rows of every other request
+        db.session.execute(update(User).where(User.id == current_user.id).values(last_seen=now)
+                           .execution_options(query_cache_invalidate=False))
+        set_committed_value(current_user._get_current_object(), "last_seen", now)
         db.session.commit()
         g.search_form = SearchForm()
     g.locale = str(get_locale())
@@ -105,46 +121,99 @@ def unfollow(username):
 
 @bp.route("/explore")
 @login_required
+@conditional(explore_version)
 def explore():
     page = request.args.get("page", 1, type=int)
-    query = select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, error_out=False, page=page, per_page=current_app.config["POSTS_PER_PAGE"])
-    next_url = url_for("main.explore", page=posts.next_num) if posts.has_next else None
-    prev_url = url_for("main.explore", page=posts.prev_num) if posts.prev_num else None
-    return render_template("index.html", title="Explore", posts=posts.items, next_url=next_url, prev_url=prev_url)
+    per_page = current_app.config["POSTS_PER_PAGE"]
+    ranking = current_app.hot_ranking
+    unranked = ranking is not None and "unranked" in request.args
+    ranked = ranking.page(page, per_page) if ranking is not None and not unranked else None
+    if unranked:
+        posts, has_next = ranking.unranked(before_cursor(), per_page)
+        next_url = url_for("main.explore", unranked=1, before=encode_cursor(posts[-1].timestamp, posts[-1].id)) \
+            if has_next else None
+        prev_url = url_for("main.explore")
+    elif ranked is not None:
+        posts, has_next = ranked
+        next_url = url_for("main.explore", page=page + 1) if has_next else None
+        if next_url is None and ranking.unranked(None, 1)[0]:
+            # past the ranking, carry on with every other post, newest first
+            next_url = url_for("main.explore", unranked=1)
+            if not posts:
+                return redirect(next_url)
+        prev_url = url_for("main.explore", page=page - 1) if page > 1 else None
+    else:
+        if current_app.shards is not None:
+            posts, has_next = current_app.shards.feed(None, page, per_page)
+        else:
+            query = select(Post).order_by(Post.timestamp.desc()).execution_options(query_cache=10)
+            pagination = db.paginate(query, error_out=False, page=page, per_page=per_page)
+            posts, has_next = pagination.items, pagination.has_next
+        next_url = url_for("main.explore", page=page + 1) if has_next else None
+        prev_url = url_for("main.explore", page=page - 1) if page > 1 else None
+    trending = current_app.trending.current() if current_app.trending is not None else None
+    return render_template("index.html", title="Explore", posts=posts, next_url=next_url, prev_url=prev_url,
+                           trending=trending)
 
 
 @bp.route("/user/<username>")
 @login_required
+@conditional(user_version)
 def user(username):
-    user = db.first_or_404(select(User).where(User.username == username))
-    page = request.args.get("next")
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False)
-    next_url = url_for("main.user", username=user.username, page=posts.next_num) if posts.next_num else None
-    prev_url = url_for("main.user", username=user.username, page=posts.prev_num) if posts.prev_num else None
+    user = db.first_or_404(select(User).where(User.username == username).execution_options(query_cache=60))
+    posts, has_next = user_posts(user, before_cursor(), current_app.config["POSTS_PER_PAGE"])
+    next_url = url_for("main.user", username=user.username,
+                       before=encode_cursor(posts[-1].timestamp, posts[-1].id)) if has_next else None
+    prev_url = url_for("main.user", username=user.username) if "before" in request.args else None
     form = EmptyForm()
-    return render_template("user.html", user=user, posts=posts, form=form, prev_url=prev_url, next_url=next_url)
+    suggestions = current_user.follow_suggestions() if user == current_user else None
+    return render_template("user.html", user=user, posts=posts, form=form, prev_url=prev_url, next_url=next_url,
+                           suggestions=suggestions)
+
+
+@bp.route("/user/<username>/export")
+@login_required
+def export_user(username):
+    user = db.first_or_404(select(User).where(User.username == username))
+    if user != current_user:
+        abort(403)
+    format = request.args.get("format", "ndjson")
+    compress = request.args.get("gzip", 0, type=int) == 1
+    if format not in FORMATS:
+        abort(400)
+    try:
+        chunks = export(user, format, request.args.get("after"), compress, current_app.config["COMPRESS_LEVEL"])
+        first = next(chunks, "")
+    except ValueError:
+        abort(400)
+    filename = "{}.{}{}".format(user.username, format, ".gz" if compress else "")
+    return Response(stream_with_context(chain([first], chunks)),
+                    mimetype="application/gzip" if compress else FORMATS[format],
+                    headers={"Content-Disposition": "attachment; filename=" + filename})
 
 
 @bp.route("/translate", methods=["POST"])
 @login_required
-def translate_text():
+async def translate_text():
     data = request.get_json()
     return {
-        "text": translate(data['text'],
-                          data['source_language'],
-                          data['dest_language'])
+        "text": await translate(data['text'],
+                                data['source_language'],
+                                data['dest_language'])
     }
 
 
 @bp.route("/search")
 @login_required
-def search():
+async def search():
     if not g.search_form.validate():
         return redirect(url_for("main.explore"))
     page = request.args.get("page", 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page, current_app.config["POSTS_PER_PAGE"])
+    try:
+        posts, total = await Post.search_async(g.search_form.q.data, page, current_app.config["POSTS_PER_PAGE"])
+    except (asyncio.TimeoutError, CircuitOpenError, UpstreamError):
+        flash(_("Search is not available right now, please try again later."))
+        posts, total = [], 0
     next_url = url_for("main.search", q=g.search_form.q.data, page=page - 1) \
         if total > page * current_app.config["POSTS_PER_PAGE"] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
@@ -154,8 +223,9 @@ def search():
 
 
 @bp.route("/user/<username>/popup")
+@conditional(user_popup_version)
 def user_popup(username):
-    user = db.first_or_404(select(User).where(User.username == username))
+    user = db.first_or_404(select(User).where(User.username == username).execution_options(query_cache=60))
     form = EmptyForm()
     return render_template("user_popup.html", user=user, form=form)
 
@@ -166,41 +236,109 @@ def send_message(recipient):
     user = db.first_or_404(select(User).where(User.username == recipient))
     form = MessageForm()
     if form.validate_on_submit():
+        conversation = Conversation.between(current_user, user)
+        conversation.add_message(Message(author=current_user, recipient=user, body=form.message.data))
+        db.session.flush()
         user.add_notification('unread_message_count', user.unread_message_count())
-        msg = Message(author=current_user, recipient=user, body=form.message.data)
-        db.session.add(msg)
         db.session.commit()
         flash(_("Your message has been sent."))
         return redirect(url_for("main.user", username=recipient))
     return render_template("send_message.html", title=_("Send Message"), form=form, recipient=recipient)
 
 
+def before_cursor():
+    before = request.args.get("before")
+    try:
+        return decode_cursor(before) if before else None
+    except ValueError:
+        abort(400)
+
+
 @bp.route("/messages")
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.now(tz=timezone.utc)
-    current_user.add_notification('unread_message_count', 0)
-    db.session.commit()
-    page = request.args.get("page", 1, type=int)
-    query = current_user.messages_received.select().order_by(Message.timestamp.desc())
-    messages = db.paginate(query, page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items,
+    conversations, has_next = current_user.inbox(before_cursor(), current_app.config["MESSAGES_PER_PAGE"])
+    last_messages = {message.id: message for result in scatter(
+        select(Message).where(Message.id.in_([c.last_message_id for c in conversations])),
+        [c.user1_id for c in conversations]) for message in result.scalars()}
+    next_url = url_for("main.messages", before=encode_cursor(conversations[-1].last_message_at,
+                                                              conversations[-1].id)) if has_next else None
+    prev_url = url_for("main.messages") if "before" in request.args else None
+    return render_template("messages.html", conversations=conversations, last_messages=last_messages,
+                           next_url=next_url, prev_url=prev_url)
+
+
+@bp.route("/messages/<username>")
+@login_required
+def conversation(username):
+    user = db.first_or_404(select(User).where(User.username == username))
+    conversation = Conversation.between(current_user, user, create=False)
+    if conversation is None:
+        messages, has_next = [], False
+    else:
+        if conversation.unread(current_user):
+            conversation.mark_read(current_user)
+            current_user.last_message_read_time = datetime.now(tz=timezone.utc)
+            db.session.flush()
+            current_user.add_notification('unread_message_count', current_user.unread_message_count())
+            db.session.commit()
+        messages, has_next = conversation.thread(before_cursor(), current_app.config["MESSAGES_PER_PAGE"])
+    next_url = url_for("main.conversation", username=username,
+                       before=encode_cursor(messages[-1].timestamp, messages[-1].id)) if has_next else None
+    prev_url = url_for("main.conversation", username=username) if "before" in request.args else None
+    return render_template("conversation.html", title=user.username, user=user, messages=messages,
                            next_url=next_url, prev_url=prev_url)
 
 
 @bp.route('/notifications')
 @login_required
+@conditional(notifications_version)
 def notifications():
     since = request.args.get('since', 0.0, type=float)
-    query = current_user.notifications.select().where(Notification.timestamp > since).order_by(
+    query = select(Notification.name, Notification.payload_json, Notification.timestamp).where(
+        Notification.user_id == current_user.id, Notification.timestamp > since).order_by(
         Notification.timestamp.asc())
-    notifications = db.session.scalars(query)
     return [{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications]
+        'name': name,
+        'data': json.loads(payload_json),
+        'timestamp': timestamp
+    } for name, payload_json, timestamp in db.session.execute(query)]
+
+
+@bp.route('/trending')
+@login_required
+def trending():
+    if current_app.trending is None:
+        return []
+    return current_app.trending.current()
+
+
+def internal_only(f):
+    """Serve the route only to ``STATUS_ADDRESSES``; anyone else gets a 404."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if request.remote_addr not in current_app.config["STATUS_ADDRESSES"]:
+            abort(404)
+        return f(*args, **kwargs)
+    return wrapper
+
+
+@bp.route('/status/jobs')
+@internal_only
+def jobs_status():
+    from app.jobs import queue_stats
+    return queue_stats()
+
+
+@bp.route('/status/query-cache')
+@internal_only
+def query_cache_status():
+    if current_app.query_cache is None:
+        return {}
+    return current_app.query_cache.stats()
+
+
+@bp.route('/status/outbound')
+@internal_only
+def outbound_status():
+    return upstream_stats()
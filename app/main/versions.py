@@ -0,0 +1,66 @@
+from datetime import datetime, timezone
+from time import time
+from flask import g, request, current_app
+from flask_login import current_user
+from sqlalchemy import select, func, or_
+from app import db
+from app.models import User, Post, Conversation, Notification
+from app.shards import routed, scatter, latest
+
+
+def viewer_version():
+    """Tokens for what every full page shows about the viewer (navbar, unread badge, CSRF token age)."""
+    latest_message = db.session.scalar(
+        select(func.max(Conversation.last_message_at)).where(or_(Conversation.user1_id == current_user.id,
+                                                                 Conversation.user2_id == current_user.id)))
+    csrf_window = int(time() * 2 // (current_app.config.get("WTF_CSRF_TIME_LIMIT") or 3600))
+    return (current_user.id, current_user.version, current_user.suggestions_version,
+            current_user.last_message_read_time, latest_message, g.locale, csrf_window)
+
+
+def index_version():
+    authors = current_user.followed_ids() + [current_user.id]
+    latest_id, latest_timestamp = latest(scatter(
+        select(func.max(Post.id), func.max(Post.timestamp)).where(Post.user_id.in_(authors)), authors))
+    return (viewer_version(), latest_id, request.args.get("page")), latest_timestamp
+
+
+def explore_version():
+    latest_id, latest_timestamp = latest(scatter(
+        select(func.max(Post.id), func.max(Post.timestamp)).execution_options(query_cache=10)))
+    trending = current_app.trending.current() if current_app.trending is not None else None
+    ranking = current_app.hot_ranking
+    if ranking is not None:
+        ranking.current()
+    return (viewer_version(), latest_id, request.args.get("page"), request.args.get("unranked"),
+            request.args.get("before"), trending,
+            ranking.version if ranking is not None else None), latest_timestamp
+
+
+def user_version(username):
+    row = db.session.execute(select(User.id, User.version, User.last_seen).where(User.username == username)
+                             .execution_options(query_cache=60)).one_or_none()
+    if row is None:
+        return (viewer_version(), username, None), None
+    latest_id, latest_timestamp = db.session.execute(
+        select(func.max(Post.id), func.max(Post.timestamp)).where(Post.user_id == row.id),
+        bind_arguments=routed(row.id)).one()
+    return (viewer_version(), tuple(row), latest_id, request.args.get("before")), latest_timestamp
+
+
+def user_popup_version(username):
+    row = db.session.execute(select(User.id, User.version, User.last_seen).where(User.username == username)
+                             .execution_options(query_cache=60)).one_or_none()
+    viewer = (current_user.id, current_user.version) if current_user.is_authenticated else None
+    if row is None:
+        return (viewer, username, None, g.locale), None
+    # the popup shows last_seen to the minute; every request by the user moves it by seconds
+    last_seen = row.last_seen.replace(second=0, microsecond=0) if row.last_seen else None
+    return (viewer, username, row.id, row.version, last_seen, g.locale), None
+
+
+def notifications_version():
+    latest = db.session.scalar(
+        select(func.max(Notification.timestamp)).where(Notification.user_id == current_user.id))
+    last_modified = datetime.fromtimestamp(latest, tz=timezone.utc) if latest else None
+    return (current_user.id, latest, request.args.get("since")), last_modified
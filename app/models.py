@@ -1,19 +1,27 @@
+import heapq
 import json
-from datetime import datetime, timezone
+import secrets
+from functools import partial
+from datetime import datetime, timezone, timedelta
 from typing import Optional
 import jwt
 from flask_login import UserMixin
 from sqlalchemy.dialects.mysql import INTEGER
-from werkzeug.security import generate_password_hash, check_password_hash
 from app import db
-from sqlalchemy import String, ForeignKey, Table, Column, func, select, or_, Text
+from sqlalchemy import String, ForeignKey, Table, Column, func, select, or_, Text, DateTime, Index, Float, UniqueConstraint
 from sqlalchemy.orm import Mapped, mapped_column, relationship, WriteOnlyMapped, aliased
+from sqlalchemy import inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
 from app import login
 from hashlib import md5
 from time import time
 from flask import current_app
-from app.search import add_to_index, remove_from_index, query_index
-from elasticsearch.exceptions import NotFoundError
+from app.search import add_to_index, bulk_add_to_index, remove_from_index, query_index, query_index_async
+from app.cache import invalidate_fragments, cache_query_results, track_writes, record_write, invalidate_queries, \
+    forget_writes
+from app.pagination import keyset
+from app.sql import upsert
 
 followers = Table(
     "followers",
@@ -22,8 +30,84 @@ followers = Table(
     Column("followed_id", INTEGER, ForeignKey("user.id"), primary_key=True)
 )
 
+timeline = Table(
+    "timeline",
+    db.metadata,
+    Column("user_id", INTEGER, ForeignKey("user.id", ondelete="CASCADE"), primary_key=True),
+    Column("post_id", INTEGER, ForeignKey("post.id", ondelete="CASCADE"), primary_key=True),
+    Column("author_id", INTEGER, nullable=False),
+    Column("timestamp", DateTime, nullable=False),
+    Index("ix_timeline_user_id_timestamp", "user_id", "timestamp"),
+)
+
+follow_suggestion = Table(
+    "follow_suggestion",
+    db.metadata,
+    Column("user_id", INTEGER, ForeignKey("user.id", ondelete="CASCADE"), primary_key=True),
+    Column("suggested_id", INTEGER, ForeignKey("user.id", ondelete="CASCADE"), primary_key=True),
+    Column("score", INTEGER, nullable=False),
+    Index("ix_follow_suggestion_user_id_score", "user_id", "score"),
+)
+
+hot_post = Table(
+    "hot_post",
+    db.metadata,
+    Column("post_id", INTEGER, ForeignKey("post.id", ondelete="CASCADE"), primary_key=True),
+    Column("score", Float, nullable=False, index=True),
+)
+
+post_archive_month = Table(
+    "post_archive_month",
+    db.metadata,
+    Column("month", INTEGER, primary_key=True, autoincrement=False),
+    Column("rows", INTEGER, nullable=False, default=0, server_default="0"),
+    Column("archived_at", DateTime),
+)
+
+shard_bucket = Table(
+    "shard_bucket",
+    db.metadata,
+    Column("bucket", INTEGER, primary_key=True, autoincrement=False),
+    Column("shard", INTEGER, nullable=False),
+)
+
+job = Table(
+    "job",
+    db.metadata,
+    Column("id", INTEGER, primary_key=True),
+    Column("name", String(128), nullable=False),
+    Column("arguments", Text, nullable=False),
+    Column("status", String(16), nullable=False),
+    Column("attempts", INTEGER, nullable=False, default=0, server_default="0"),
+    Column("max_attempts", INTEGER, nullable=False),
+    Column("run_at", DateTime, nullable=False),
+    Column("enqueued_at", DateTime, nullable=False),
+    Column("started_at", DateTime),
+    Column("finished_at", DateTime),
+    Column("worker", String(64)),
+    Column("error", Text),
+    Index("ix_job_status_run_at", "status", "run_at"),
+)
+
+job_schedule = Table(
+    "job_schedule",
+    db.metadata,
+    Column("name", String(128), primary_key=True),
+    Column("next_run_at", DateTime, nullable=False),
+)
+
+trending_term = Table(
+    "trending_term",
+    db.metadata,
+    Column("id", INTEGER, primary_key=True),
+    Column("bucket", INTEGER, nullable=False, index=True),
+    Column("term", String(64), nullable=False),
+    Column("count", INTEGER, nullable=False),
+)
+
 
 class User(db.Model, UserMixin):
+    __versioned__ = ['username', 'email', 'about_me']
     id: Mapped[int] = mapped_column(primary_key=True)
     username: Mapped[str] = mapped_column(String(64), index=True, unique=True)
     email: Mapped[str] = mapped_column(String(120), index=True, unique=True)
@@ -32,6 +116,11 @@ class User(db.Model, UserMixin):
     about_me: Mapped[Optional[str]] = mapped_column(String(140))
     last_seen: Mapped[Optional[datetime]] = mapped_column(default=lambda: datetime.now(tz=timezone.utc))
     last_message_read_time: Mapped[Optional[datetime]]
+    version: Mapped[int] = mapped_column(default=1, server_default="1")
+    follower_count: Mapped[int] = mapped_column(default=0, server_default="0", index=True)
+    suggestions_version: Mapped[Optional[int]]
+    token: Mapped[Optional[str]] = mapped_column(String(32), index=True, unique=True)
+    token_expiration: Mapped[Optional[datetime]]
     following: WriteOnlyMapped["User"] = relationship(secondary=followers, primaryjoin=(followers.c.follower_id == id),
                                                       secondaryjoin=(followers.c.followed_id == id),
                                                       back_populates="followers")
@@ -48,10 +137,13 @@ class User(db.Model, UserMixin):
         return "User {}".format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.password_hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return self.password_hash is not None and current_app.password_hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return current_app.password_hasher.needs_rehash(self.password_hash)
 
     def avatar(self, size):
         digest = md5(self.email.lower().encode("utf-8")).hexdigest()
@@ -59,25 +151,77 @@ class User(db.Model, UserMixin):
 
     def follow(self, user):
         if not self.is_following(user):
+            from app.timeline import backfill
             self.following.add(user)
+            self.touch()
+            user.touch(followers=1)
+            backfill(self, user)
+            db.session.info.setdefault("follow_changes", []).append((self.id, user.id, True))
 
     def unfollow(self, user):
         if self.is_following(user):
+            from app.timeline import remove
+            follower_count = select(User.follower_count).where(User.id == user.id)
+            # locked until commit, so concurrent unfollows each see their own before and after
+            before = db.session.scalar(follower_count.with_for_update())
             self.following.remove(user)
+            self.touch()
+            user.touch(followers=-1)
+            remove(self, user)
+            db.session.info.setdefault("follow_changes", []).append((self.id, user.id, False))
+            after = db.session.scalar(follower_count)
+            if before >= current_app.config["TIMELINE_HEAVY_THRESHOLD"] > after:
+                # back to light: followers have none of the posts that were pulled while heavy
+                from app.tasks import backfill_timelines
+                backfill_timelines.delay(user.id)
+
+    def touch(self, followers=0):
+        """Bump ``version`` once per transaction (caches rely on one commit meaning one increment)."""
+        if inspect(self).persistent:
+            touched = db.session.info.setdefault("touched", set())
+            if self.id not in touched:
+                touched.add(self.id)
+                self.version = User.version + 1
+            if followers:
+                self.follower_count = User.follower_count + followers
+
+    def _follow_graph(self):
+        """The process follow graph, unless this user has follow changes that are not committed yet."""
+        if not inspect(self).persistent or current_app.follow_graph is None:
+            return None
+        if any(change[0] == self.id for change in db.session.info.get("follow_changes", ())):
+            return None
+        return current_app.follow_graph
 
     def is_following(self, user):
+        graph = self._follow_graph()
+        if graph is not None and user.id is not None:
+            return graph.is_following(self, user.id)
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
 
+    def followed_ids(self):
+        graph = self._follow_graph()
+        if graph is not None:
+            return list(graph.followees(self))
+        return list(db.session.scalars(select(followers.c.followed_id).where(followers.c.follower_id == self.id)))
+
+    def follow_suggestions(self, limit=5):
+        query = select(User) \
+            .join(follow_suggestion, follow_suggestion.c.suggested_id == User.id) \
+            .where(follow_suggestion.c.user_id == self.id) \
+            .order_by(follow_suggestion.c.score.desc(), User.id).limit(limit * 2)
+        followed = set(self.followed_ids())
+        return [user for user in db.session.scalars(query) if user.id not in followed][:limit]
+
     def followers_count(self):
-        query = select(func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+        # counted on the association table alone, so the cached count only goes stale on follows
+        query = select(func.count()).select_from(followers).where(followers.c.followed_id == self.id)
+        return db.session.scalar(query.execution_options(query_cache=60))
 
     def following_count(self):
-        query = select(func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        query = select(func.count()).select_from(followers).where(followers.c.follower_id == self.id)
+        return db.session.scalar(query.execution_options(query_cache=60))
 
     def following_posts(self):
         Author = aliased(User)
@@ -106,16 +250,54 @@ class User(db.Model, UserMixin):
             return
         return db.session.get(User, id)
 
+    def get_token(self, expires_in=3600):
+        """An API token for this user, reusing the current one while it has over a minute left."""
+        now = datetime.now(tz=timezone.utc)
+        if self.token and self.token_expiration.replace(tzinfo=timezone.utc) > now + timedelta(seconds=60):
+            return self.token
+        self.token = secrets.token_hex(16)
+        self.token_expiration = now + timedelta(seconds=expires_in)
+        return self.token
+
+    def revoke_token(self):
+        self.token_expiration = datetime.now(tz=timezone.utc) - timedelta(seconds=1)
+
+    @staticmethod
+    def check_token(token):
+        user = db.session.scalar(select(User).where(User.token == token))
+        if user is None or user.token_expiration.replace(tzinfo=timezone.utc) < datetime.now(tz=timezone.utc):
+            return None
+        return user
+
     def unread_message_count(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        query = select(Message).where(Message.recipient == self, Message.timestamp > last_read_time)
-        return db.session.scalar(select(func.count()).select_from(query.subquery()))
+        return (db.session.scalar(select(func.sum(Conversation.user1_unread))
+                                  .where(Conversation.user1_id == self.id)) or 0) + \
+            (db.session.scalar(select(func.sum(Conversation.user2_unread))
+                               .where(Conversation.user2_id == self.id)) or 0)
+
+    def inbox(self, before=None, limit=20):
+        """The user's conversations, most recently active first, and whether there are more.
+
+        The user is ``user1`` of some conversations and ``user2`` of others; each side is a range
+        scan of its ``(user_id, last_message_at, id)`` index, and the two are merged. A conversation
+        with oneself is on both sides and only taken from the first. The other users of the page
+        are loaded with one query, so ``other()`` finds them in the session.
+        """
+        streams = []
+        for condition in (Conversation.user1_id == self.id,
+                          (Conversation.user2_id == self.id) & (Conversation.user1_id != self.id)):
+            query = keyset(select(Conversation).where(condition, Conversation.last_message_at.is_not(None)),
+                           Conversation.last_message_at, Conversation.id, before, limit)
+            streams.append(db.session.scalars(query).all())
+        conversations = list(heapq.merge(*streams, key=lambda c: (c.last_message_at, c.id), reverse=True))
+        others = {c.user1_id + c.user2_id - self.id for c in conversations[:limit]} - {self.id}
+        if others:
+            db.session.scalars(select(User).where(User.id.in_(others))).all()
+        return conversations[:limit], len(conversations) > limit
 
     def add_notification(self, name, data):
-        db.session.execute(self.notifications.delete().where(Notification.name == name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        upsert(Notification, {"user_id": self.id, "name": name, "payload_json": json.dumps(data), "timestamp": time()},
+               ["user_id", "name"], ["payload_json", "timestamp"])
 
 
 @login.user_loader
@@ -126,29 +308,46 @@ def load_user(id):
 class SearchableMixin(object):
     @classmethod
     def search(cls, expression, page, per_page):
-        try:
-            ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        except NotFoundError:
-            return [], 0
-        else:
-            if total == 0:
-                return [], 0
-            when = []
-            for i in range(len(ids)):
-                when.append((ids[i], i))
-            query = select(cls).where(cls.id.in_(ids)).order_by(db.case(*when, value=cls.id))
-            return db.session.scalars(query), total
+        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        return cls.from_ids(ids), total
+
+    @classmethod
+    async def search_async(cls, expression, page, per_page):
+        ids, total = await query_index_async(cls.__tablename__, expression, page, per_page)
+        return cls.from_ids(ids), total
+
+    @classmethod
+    def from_ids(cls, ids):
+        if not ids:
+            return []
+        from app.shards import scatter
+        found = {obj.id: obj for result in scatter(select(cls).where(cls.id.in_(ids))) for obj in result.scalars()}
+        return [found[id] for id in ids if id in found]
 
     @classmethod
     def before_commit(cls, session):
         session._changes = {
             'add': list(session.new),
-            'update': list(session.dirty),
+            # only edits to indexed fields need a reindex, not e.g. the detected language
+            'update': [obj for obj in session.dirty if isinstance(obj, SearchableMixin) and any(
+                inspect(obj).attrs[field].history.has_changes() for field in obj.__searchable__)],
             'delete': list(session.deleted)
         }
+        if current_app.config["JOBS_EAGER"] or not current_app.config["ELASTICSEARCH_URL"]:
+            return
+        # queue the index updates in the same transaction, so none is lost if indexing fails
+        from app.tasks import index_object
+        changed = [obj for objs in session._changes.values() for obj in objs if isinstance(obj, SearchableMixin)]
+        if changed:
+            session.flush()
+            for obj in changed:
+                index_object.delay(obj.__tablename__, obj.id)
 
     @classmethod
     def after_commit(cls, session):
+        if not current_app.config["JOBS_EAGER"]:
+            session._changes = None
+            return
         for obj in session._changes['add']:
             if isinstance(obj, SearchableMixin):
                 add_to_index(obj.__tablename__, obj)
@@ -161,17 +360,85 @@ class SearchableMixin(object):
         session._changes = None
 
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(select(cls)):
-            add_to_index(cls.__tablename__, obj)
-
-
+    def reindex(cls, *where, batch_size=1000):
+        """Bulk index the rows matching ``where`` (all rows by default). Returns how many were indexed."""
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        query = select(cls.id, *columns).where(*where).execution_options(yield_per=batch_size)
+        from app.shards import scatter
+        documents = ((row[0], dict(zip(cls.__searchable__, row[1:]))) for result in scatter(query) for row in result)
+        return bulk_add_to_index(cls.__tablename__, documents, batch_size)
+
+
+def bump_versions(session, flush_context, instances):
+    for obj in session.dirty:
+        if isinstance(obj, User) and any(inspect(obj).attrs[attr].history.has_changes()
+                                         for attr in obj.__versioned__):
+            obj.touch()
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Post):
+            session.info.setdefault('stale_fragments', set()).add(('post', obj.id))
+
+
+def apply_follow_changes(session):
+    changes = session.info.pop("follow_changes", None)
+    if changes and current_app.follow_graph is not None:
+        current_app.follow_graph.apply(changes)
+
+
+def discard_follow_changes(session):
+    session.info.pop("follow_changes", None)
+
+
+def forget_touched(session):
+    session.info.pop("touched", None)
+
+
+def track_trending(session):
+    if current_app.trending is None:
+        return
+    for obj in session._changes['add']:
+        if isinstance(obj, Post):
+            current_app.trending.track(obj.body)
+
+
+def fan_out_posts(session, flush_context):
+    from app.timeline import fan_out
+    if current_app.shards is not None:
+        # the home feed reads the shards directly, see ShardRouter.feed
+        return
+    for obj in session.new:
+        if isinstance(obj, Post):
+            fan_out(session.connection(), obj)
+
+
+def route_to_shards(session, flush_context, instances):
+    router = current_app.shards
+    session.connection_callable = partial(router.connection_for, session) if router is not None else None
+
+
+db.event.listen(db.session, 'before_flush', bump_versions)
+db.event.listen(db.session, 'before_flush', route_to_shards)
+db.event.listen(db.session, 'after_flush', fan_out_posts)
+db.event.listen(db.session, 'after_commit', invalidate_fragments)
+db.event.listen(db.session, 'do_orm_execute', cache_query_results)
+db.event.listen(db.session, 'after_begin', track_writes)
+db.event.listen(Engine, 'after_execute', record_write)
+db.event.listen(db.session, 'after_commit', invalidate_queries)
+db.event.listen(db.session, 'after_transaction_end', forget_writes)
+db.event.listen(db.session, 'after_commit', apply_follow_changes)
+db.event.listen(db.session, 'after_rollback', discard_follow_changes)
+db.event.listen(db.session, 'after_commit', forget_touched)
+db.event.listen(db.session, 'after_rollback', forget_touched)
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_commit', track_trending)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    __table_args__ = (
+        Index("ix_post_user_id_timestamp", "user_id", "timestamp", "id"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     body: Mapped[str] = mapped_column(String(140))
     timestamp: Mapped[datetime] = mapped_column(index=True, default=lambda: datetime.now(tz=timezone.utc))
@@ -183,24 +450,105 @@ class Post(SearchableMixin, db.Model):
         return "<Post {}>".format(self.body)
 
 
+class Conversation(db.Model):
+    """The messages between two users, stored once per pair with ``user1_id < user2_id``."""
+    __table_args__ = (
+        UniqueConstraint("user1_id", "user2_id"),
+        Index("ix_conversation_user1_id_last_message_at", "user1_id", "last_message_at", "id"),
+        Index("ix_conversation_user2_id_last_message_at", "user2_id", "last_message_at", "id"),
+    )
+    id: Mapped[int] = mapped_column(primary_key=True)
+    user1_id: Mapped[int] = mapped_column(ForeignKey(User.id))
+    user2_id: Mapped[int] = mapped_column(ForeignKey(User.id))
+    last_message_id: Mapped[Optional[int]]
+    last_message_at: Mapped[Optional[datetime]]
+    user1_unread: Mapped[int] = mapped_column(default=0, server_default="0")
+    user2_unread: Mapped[int] = mapped_column(default=0, server_default="0")
+
+    user1: Mapped[User] = relationship(foreign_keys="Conversation.user1_id")
+    user2: Mapped[User] = relationship(foreign_keys="Conversation.user2_id")
+    messages: WriteOnlyMapped["Message"] = relationship(back_populates="conversation")
+
+    def __repr__(self):
+        return "<Conversation {} {}>".format(self.user1_id, self.user2_id)
+
+    @staticmethod
+    def between(user, other, create=True):
+        """The conversation of ``user`` and ``other``, created if needed unless ``create`` is false."""
+        user1_id, user2_id = sorted((user.id, other.id))
+        query = select(Conversation).where(Conversation.user1_id == user1_id, Conversation.user2_id == user2_id)
+        conversation = db.session.scalar(query)
+        if conversation is None and create:
+            try:
+                with db.session.begin_nested():
+                    conversation = Conversation(user1_id=user1_id, user2_id=user2_id)
+                    db.session.add(conversation)
+            except IntegrityError:
+                # created by a concurrent request
+                conversation = db.session.scalar(query)
+        return conversation
+
+    def other(self, user):
+        return self.user2 if user.id == self.user1_id else self.user1
+
+    def unread(self, user):
+        return self.user1_unread if user.id == self.user1_id else self.user2_unread
+
+    def add_message(self, message):
+        """Store ``message`` in this conversation and count it as unread for its recipient."""
+        message.conversation = self
+        db.session.add(message)
+        db.session.flush()
+        self.last_message_id = message.id
+        self.last_message_at = message.timestamp
+        if message.recipient_id == self.user1_id:
+            self.user1_unread = Conversation.user1_unread + 1
+        else:
+            self.user2_unread = Conversation.user2_unread + 1
+
+    def mark_read(self, user):
+        if user.id == self.user1_id:
+            self.user1_unread = 0
+        else:
+            self.user2_unread = 0
+
+    def thread(self, before=None, limit=20):
+        """The messages of the conversation, newest first, and whether there are more."""
+        from app.shards import routed
+        query = keyset(self.messages.select(), Message.timestamp, Message.id, before, limit)
+        messages = db.session.scalars(query, bind_arguments=routed(self.user1_id)).all()
+        return messages[:limit], len(messages) > limit
+
+
 class Message(db.Model):
+    __table_args__ = (
+        Index("ix_message_conversation_id_timestamp", "conversation_id", "timestamp", "id"),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     sender_id: Mapped[int] = mapped_column(ForeignKey(User.id), index=True)
     recipient_id: Mapped[int] = mapped_column(ForeignKey(User.id), index=True)
+    conversation_id: Mapped[int] = mapped_column(ForeignKey(Conversation.id))
     body: Mapped[str] = mapped_column(String(140))
     timestamp: Mapped[datetime] = mapped_column(index=True, default=lambda: datetime.now(tz=timezone.utc))
 
     author: Mapped[User] = relationship(foreign_keys='Message.sender_id', back_populates='messages_sent')
     recipient: Mapped[User] = relationship(foreign_keys='Message.recipient_id', back_populates='messages_received')
+    conversation: Mapped[Conversation] = relationship(back_populates="messages")
 
     def __repr__(self):
         return "<Message {}>".format(self.body)
 
 
 class Notification(db.Model):
+    __table_args__ = (
+        UniqueConstraint("user_id", "name"),
+        # covers the /notifications poll; PostgreSQL can carry the payload in the index too
+        Index("ix_notification_user_id_timestamp", "user_id", "timestamp", "name",
+              postgresql_include=["payload_json"]),
+    )
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(128), index=True)
-    user_id: Mapped[int] = mapped_column(ForeignKey(User.id), index=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey(User.id))
     timestamp: Mapped[float] = mapped_column(index=True, default=time)
     payload_json: Mapped[str] = mapped_column(Text)
     user: Mapped[User] = relationship(back_populates="notifications")
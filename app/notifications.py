@@ -0,0 +1,26 @@
+from time import time, sleep
+from sqlalchemy import select, delete
+from app import db
+from app.models import Notification
+
+
+def compact(ttl, batch_size=500, pause=0.05):
+    """Delete notifications older than ``ttl`` seconds and return how many were removed.
+
+    Rows go ``batch_size`` at a time, oldest first by the timestamp index, each batch in its own
+    short transaction with a ``pause`` in between, so the table is never locked for long.
+    """
+    cutoff = time() - ttl
+    deleted = 0
+    while True:
+        ids = db.session.scalars(select(Notification.id).where(Notification.timestamp < cutoff)
+                                 .order_by(Notification.timestamp).limit(batch_size)).all()
+        if not ids:
+            return deleted
+        db.session.execute(delete(Notification).where(Notification.id.in_(ids))
+                           .execution_options(synchronize_session=False))
+        db.session.commit()
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            return deleted
+        sleep(pause)
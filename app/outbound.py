@@ -0,0 +1,149 @@
+import asyncio
+import threading
+from time import monotonic
+from flask import current_app
+from app.aio import background
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class UpstreamError(Exception):
+    pass
+
+
+def is_failure(error):
+    """Whether ``error`` says the upstream is unwell. A 4xx reply (a bad query, a missing document) is the
+    caller's mistake and does not count; 5xx replies, timeouts and connection errors do."""
+    while error is not None:
+        status = getattr(error, "status_code", None)
+        if isinstance(status, int):
+            return status >= 500
+        error = error.__cause__
+    return True
+
+
+class CircuitBreaker(object):
+    """Opens after ``threshold`` consecutive failures and lets one trial call through after ``reset_timeout``."""
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.opened_at is not None or self.failures >= self.threshold:
+                self.opened_at = monotonic()
+
+
+class Upstream(object):
+    """One outbound service: its circuit breaker, deadline and call metrics."""
+
+    def __init__(self, name, timeout, threshold, reset_timeout):
+        self.name = name
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(threshold, reset_timeout)
+        self.metrics = {"calls": 0, "failures": 0, "timeouts": 0, "rejected": 0, "latency": 0.0}
+
+    def count(self, name, amount=1):
+        # request threads and the background loop update the metrics concurrently
+        with self.breaker._lock:
+            self.metrics[name] += amount
+
+    def _before(self):
+        if not self.breaker.allow():
+            self.count("rejected")
+            raise CircuitOpenError(self.name)
+        self.count("calls")
+        return monotonic()
+
+    def _after(self, start, error=None):
+        self.count("latency", monotonic() - start)
+        if error is None or not is_failure(error):
+            self.breaker.record_success()
+            return
+        self.count("failures")
+        if isinstance(error, (asyncio.TimeoutError, TimeoutError)):
+            self.count("timeouts")
+        self.breaker.record_failure()
+
+    def call(self, fn, *args, **kwargs):
+        """Call a blocking client; its own timeout must be set to ``self.timeout``."""
+        start = self._before()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._after(start, e)
+            raise
+        self._after(start)
+        return result
+
+    async def call_async(self, coro):
+        """Await ``coro`` on the background loop, cancelling it at the deadline."""
+        try:
+            start = self._before()
+        except CircuitOpenError:
+            coro.close()
+            raise
+        try:
+            result = await background.run(coro, timeout=self.timeout)
+        except Exception as e:
+            self._after(start, e)
+            raise
+        self._after(start)
+        return result
+
+    def stats(self):
+        with self.breaker._lock:
+            metrics = dict(self.metrics)
+        calls = metrics["calls"]
+        return dict(metrics, state=self.breaker.state, mean_latency=metrics["latency"] / calls if calls else 0.0)
+
+
+_lock = threading.Lock()
+
+
+def upstream(name):
+    """This app's :class:`Upstream` for ``name``, with the deadline taken from ``<NAME>_TIMEOUT``."""
+    upstreams = current_app.extensions.setdefault("upstreams", {})
+    with _lock:
+        if name not in upstreams:
+            upstreams[name] = Upstream(name, current_app.config[name.upper() + "_TIMEOUT"],
+                                       current_app.config["OUTBOUND_BREAKER_THRESHOLD"],
+                                       current_app.config["OUTBOUND_BREAKER_RESET"])
+        return upstreams[name]
+
+
+def upstream_stats():
+    return {name: u.stats() for name, u in current_app.extensions.get("upstreams", {}).items()}
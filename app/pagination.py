@@ -0,0 +1,22 @@
+from datetime import datetime
+from sqlalchemy import or_, and_
+
+
+def encode_cursor(timestamp, id):
+    return "{},{}".format(timestamp.isoformat(), id)
+
+
+def decode_cursor(cursor):
+    """Split a ``timestamp,id`` cursor, raising ValueError if it is malformed."""
+    timestamp, id = cursor.split(",")
+    return datetime.fromisoformat(timestamp), int(id)
+
+
+def keyset(query, timestamp, id, before, limit):
+    """Newest-first page of ``query`` ordered by ``(timestamp, id)``, starting after the ``before`` cursor.
+
+    Fetches one extra row so callers can tell whether there is a next page.
+    """
+    if before is not None:
+        query = query.where(or_(timestamp < before[0], and_(timestamp == before[0], id < before[1])))
+    return query.order_by(timestamp.desc(), id.desc()).limit(limit + 1)
@@ -0,0 +1,172 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    """Too many password hashes are already waiting; the client should retry shortly."""
+    description = "Too many sign-in attempts right now, please try again in a moment."
+
+
+class PasswordHasher(object):
+    """Hashes and checks passwords in a small pool of low-priority processes.
+
+    Key stretching is deliberately CPU heavy; run on the request thread, a burst of logins takes
+    the CPU from every other page. The pool bounds how many hashes run at once (``workers``) and
+    how many may wait (``max_pending``, beyond which ``PasswordHasherBusy`` is raised), and its
+    processes are niced so feed traffic wins when the CPU is contended. With ``workers=0``
+    hashes run inline. The pool is started on first use and again after a fork.
+    """
+
+    def __init__(self, method, salt_length=16, workers=1, max_pending=8, timeout=5.0, niceness=10):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.timeout = timeout
+        self.niceness = niceness
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                # spawned, not forked: the caller may be a threaded worker holding locks
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                 initializer=os.nice, initargs=(self.niceness,))
+                self._pid = os.getpid()
+            return self._pool
+
+    def shutdown(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+
+    def run(self, f, *args):
+        if not self.workers:
+            return f(*args)
+        if not self.pending.acquire(blocking=False):
+            raise PasswordHasherBusy(retry_after=1)
+        try:
+            try:
+                future = self.pool.submit(f, *args)
+            except BaseException:
+                self.pending.release()
+                raise
+            # a hash still queued or running after the timeout keeps its permit until it is done
+            future.add_done_callback(lambda future: self.pending.release())
+            try:
+                return future.result(self.timeout)
+            except TimeoutError:
+                future.cancel()
+                raise PasswordHasherBusy(retry_after=1)
+        except BrokenProcessPool:
+            self.shutdown()
+            raise PasswordHasherBusy(retry_after=1)
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether ``pwhash`` was made with other parameters than the configured ones."""
+        method, _, rest = pwhash.partition("$")
+        salt = rest.partition("$")[0]
+        return method != self.method or len(salt) != self.salt_length
+
+
+def init_password_hasher(app):
+    return PasswordHasher(app.config["PASSWORD_HASH_METHOD"], app.config["PASSWORD_SALT_LENGTH"],
+                          app.config["PASSWORD_HASH_WORKERS"], app.config["PASSWORD_HASH_QUEUE"],
+                          app.config["PASSWORD_HASH_TIMEOUT"], app.config["PASSWORD_HASH_NICE"])
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else None
+
+
+def benchmark(seconds=3.0, storm=8, workers=None):
+    """Measure password verifications per second on one core, then timeline latency on a scratch
+    database while ``storm`` threads log in as fast as they can, hashing inline and through a
+    pool of ``workers`` processes (``PASSWORD_HASH_WORKERS`` by default). Times are in seconds."""
+    import tempfile
+    import time
+    from datetime import datetime, timedelta
+    from app import create_app, db
+    from app.models import User, Post
+    from config import Config
+
+    pwhash = generate_password_hash("benchmark", Config.PASSWORD_HASH_METHOD, Config.PASSWORD_SALT_LENGTH)
+    started, verified = time.perf_counter(), 0
+    while time.perf_counter() - started < seconds:
+        check_password_hash(pwhash, "benchmark")
+        verified += 1
+    report = {"method": Config.PASSWORD_HASH_METHOD, "logins_per_core": verified / (time.perf_counter() - started)}
+
+    def timeline_latencies(client, headers, until):
+        samples = []
+        while time.perf_counter() < until:
+            request_started = time.perf_counter()
+            client.get("/api/v1/timeline", headers=headers)
+            samples.append(time.perf_counter() - request_started)
+        return samples
+
+    def log_in(client, until, counts):
+        while time.perf_counter() < until:
+            status = client.post("/api/v1/tokens", auth=("storm", "benchmark")).status_code
+            counts[status] = counts.get(status, 0) + 1
+
+    with tempfile.TemporaryDirectory() as directory:
+        for pool in (0, workers if workers is not None else Config.PASSWORD_HASH_WORKERS):
+            app = create_app(type("BenchmarkConfig", (Config,), {
+                "TESTING": True, "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(directory, "%d.db" % pool),
+                "SHARD_DATABASE_URLS": [], "ELASTICSEARCH_URL": None, "JOBS_EAGER": True,
+                "TEMPLATE_CACHE_DIR": None, "RATELIMITS": {}, "PASSWORD_HASH_WORKERS": pool}))
+            with app.app_context():
+                db.create_all()
+                reader, author = User(username="reader", email="reader@example.com"), \
+                    User(username="storm", email="storm@example.com")
+                db.session.add_all([reader, author])
+                reader.set_password("benchmark")
+                author.set_password("benchmark")
+                db.session.commit()
+                reader.follow(author)
+                now = datetime.now()
+                db.session.add_all([Post(body="post %d" % i, author=author, timestamp=now - timedelta(minutes=i))
+                                    for i in range(200)])
+                db.session.commit()
+                client = app.test_client()
+                headers = {"Authorization": "Bearer " + client.post(
+                    "/api/v1/tokens", auth=("reader", "benchmark")).json["token"]}
+                idle = timeline_latencies(client, headers, time.perf_counter() + seconds)
+                counts = {}
+                until = time.perf_counter() + seconds
+                threads = [threading.Thread(target=log_in, args=(app.test_client(), until, counts))
+                           for i in range(storm)]
+                for thread in threads:
+                    thread.start()
+                loaded = timeline_latencies(client, headers, until)
+                for thread in threads:
+                    thread.join()
+                app.password_hasher.shutdown()
+                db.session.remove()
+                db.engine.dispose()
+            report["pool" if pool else "inline"] = {
+                "workers": pool,
+                "logins_per_second": counts.get(200, 0) / seconds,
+                "rejected": counts.get(503, 0),
+                "timeline_p50": percentile(idle, 0.5),
+                "timeline_p95": percentile(idle, 0.95),
+                "storm_timeline_p50": percentile(loaded, 0.5),
+                "storm_timeline_p95": percentile(loaded, 0.95),
+            }
+    return report
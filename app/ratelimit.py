@@ -0,0 +1,146 @@
+import mmap
+import multiprocessing
+import struct
+import threading
+from hashlib import blake2b
+from math import ceil
+from time import time
+from flask import current_app, request, session
+from werkzeug.exceptions import TooManyRequests
+from app.models import User
+
+
+def retry_after(current, previous, limit, period, offset):
+    """Seconds until a request fits under ``limit``, or 0 if it fits now.
+
+    The sliding window is approximated from two fixed ones: the count of the current window
+    plus the previous window's count weighted by how much of it still overlaps the last
+    ``period`` seconds, ``offset`` seconds into the current window.
+    """
+    if previous * (1 - offset / period) + current < limit:
+        return 0
+    if current >= limit:
+        # full on its own: wait for the next window, then for this one's weight to drop enough
+        return period - offset + period * (1 - limit / current)
+    return period * (1 - (limit - current) / previous) - offset
+
+
+class MemoryWindows(object):
+    """Per-process counters: ``key -> [window, current, previous, period]``.
+
+    Past ``max_keys`` entries, those that have not been hit for two windows are dropped.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.entries = {}
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def hit(self, key, limit, period, now):
+        window, offset = divmod(now, period)
+        window = int(window)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) >= self.max_keys:
+                    self.prune(now)
+                entry = self.entries[key] = [window, 0, 0, period]
+            elif entry[0] != window:
+                entry[2] = entry[1] if entry[0] == window - 1 else 0
+                entry[1] = 0
+                entry[0] = window
+            wait = retry_after(entry[1], entry[2], limit, period, offset)
+            if not wait:
+                entry[1] += 1
+            return wait
+
+    def prune(self, now):
+        self.entries = {key: entry for key, entry in self.entries.items() if entry[0] >= now // entry[3] - 1}
+        if len(self.entries) >= self.max_keys:
+            self.entries = {}
+
+
+class SharedWindows(object):
+    """Counters in an anonymous shared memory map, shared by the workers forked after it was made.
+
+    Keys hash to one of ``slots`` fixed-size slots of ``(key hash, window, current, previous)``;
+    a key that lands on a slot held by another starts it over, so ``slots`` should comfortably
+    exceed the clients active within a window.
+    """
+    slot = struct.Struct("<QIII")
+
+    def __init__(self, slots=65536):
+        self.slots = slots
+        self.memory = mmap.mmap(-1, slots * self.slot.size)
+        self.lock = multiprocessing.Lock()
+
+    def hit(self, key, limit, period, now):
+        window, offset = divmod(now, period)
+        window = int(window)
+        digest = int.from_bytes(blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+        position = digest % self.slots * self.slot.size
+        with self.lock:
+            tag, last, current, previous = self.slot.unpack_from(self.memory, position)
+            if tag != digest:
+                current = previous = 0
+            elif last != window:
+                previous = current if last == window - 1 else 0
+                current = 0
+            wait = retry_after(current, previous, limit, period, offset)
+            if not wait:
+                current += 1
+            self.slot.pack_into(self.memory, position, digest, window, current, previous)
+        return wait
+
+
+class RateLimiter(object):
+    """Sliding-window limits per endpoint, counted per signed-in user or per client IP.
+
+    ``limits`` maps endpoint names to ``(requests, seconds)``.
+    """
+
+    def __init__(self, limits, windows):
+        self.limits = limits
+        self.windows = windows
+
+    def check(self, endpoint, identity, now=None):
+        """Count a request and return 0, or the seconds to wait if it is over the limit (not counted)."""
+        rule = self.limits.get(endpoint)
+        if rule is None:
+            return 0
+        return self.windows.hit(endpoint + "|" + identity, rule[0], rule[1], time() if now is None else now)
+
+
+def identity():
+    """Whom a request is counted against: the signed-in user, a valid API token, or else the client address."""
+    # flask-login keeps the user id in the session; reading it avoids loading the user here
+    user_id = session.get("_user_id")
+    if user_id:
+        return "user:" + user_id
+    # a bearer token only counts as its own client once it is known to be valid, or forged
+    # tokens would each get a fresh allowance
+    auth = request.authorization
+    if auth is not None and auth.type == "bearer" and auth.token and request.blueprint == "api" and \
+            User.check_token(auth.token) is not None:
+        return "token:" + blake2b(auth.token.encode(), digest_size=16).hexdigest()
+    return "ip:" + str(request.remote_addr)
+
+
+def rate_limit():
+    """``before_request`` hook: answer 429 with ``Retry-After`` to writes over their endpoint's limit."""
+    limiter = current_app.rate_limiter
+    if limiter is None or request.method in ("GET", "HEAD", "OPTIONS") or request.endpoint not in limiter.limits:
+        return
+    wait = limiter.check(request.endpoint, identity())
+    if wait:
+        raise TooManyRequests(retry_after=ceil(wait))
+
+
+def init_rate_limiter(app):
+    if not app.config["RATELIMITS"]:
+        return None
+    if app.config["RATELIMIT_STORAGE"] == "shared":
+        windows = SharedWindows(app.config["RATELIMIT_SHARED_SLOTS"])
+    else:
+        windows = MemoryWindows(app.config["RATELIMIT_MAX_KEYS"])
+    return RateLimiter(app.config["RATELIMITS"], windows)
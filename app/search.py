@@ -1,26 +1,129 @@
+from itertools import islice
 from flask import current_app
+from app.aio import async_elasticsearch
+from app.outbound import upstream, UpstreamError
 
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
+def get_elasticsearch():
+    if "elasticsearch" not in current_app.extensions:
+        client = None
+        if current_app.config["ELASTICSEARCH_URL"]:
+            from elasticsearch import Elasticsearch
+            client = Elasticsearch([current_app.config["ELASTICSEARCH_URL"]],
+                                   request_timeout=current_app.config["ELASTICSEARCH_TIMEOUT"],
+                                   max_retries=current_app.config["ELASTICSEARCH_MAX_RETRIES"],
+                                   retry_on_timeout=False)
+        current_app.extensions["elasticsearch"] = client
+    return current_app.extensions["elasticsearch"]
+
+
+def add_to_index(index, model, strict=False):
+    elasticsearch = get_elasticsearch()
+    if not elasticsearch:
         return
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    try:
+        upstream("elasticsearch").call(elasticsearch.index, index=index, id=model.id, document=payload)
+    except Exception as e:
+        if strict:
+            raise
+        current_app.logger.warning("Could not index %s %s: %r", index, model.id, e)
+
+
+def bulk_add_to_index(index, documents, chunk_size=1000):
+    """Index ``(id, payload)`` pairs with one bulk request per ``chunk_size``. Returns how many were indexed."""
+    elasticsearch = get_elasticsearch()
+    if not elasticsearch:
+        return 0
+    from elasticsearch.helpers import bulk
+    documents = iter(documents)
+    indexed = 0
+    while True:
+        actions = [{"_index": index, "_id": id, "_source": payload}
+                   for id, payload in islice(documents, chunk_size)]
+        if not actions:
+            return indexed
+        try:
+            done, errors = upstream("elasticsearch").call(bulk, elasticsearch, actions, raise_on_error=False)
+        except Exception as e:
+            current_app.logger.warning("Could not bulk index %d %s: %r", len(actions), index, e)
+            continue
+        indexed += done
+
 
+def bulk_remove_from_index(index, ids, chunk_size=1000):
+    """Delete ``ids`` from the index with one bulk request per ``chunk_size``. Returns how many were removed."""
+    elasticsearch = get_elasticsearch()
+    if not elasticsearch:
+        return 0
+    from elasticsearch.helpers import bulk
+    ids = iter(ids)
+    removed = 0
+    while True:
+        actions = [{"_op_type": "delete", "_index": index, "_id": id} for id in islice(ids, chunk_size)]
+        if not actions:
+            return removed
+        try:
+            done, errors = upstream("elasticsearch").call(bulk, elasticsearch, actions, raise_on_error=False)
+        except Exception as e:
+            current_app.logger.warning("Could not bulk remove %d %s: %r", len(actions), index, e)
+            continue
+        removed += done
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+
+def remove_from_index(index, model, strict=False):
+    elasticsearch = get_elasticsearch()
+    if not elasticsearch:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    try:
+        upstream("elasticsearch").call(elasticsearch.delete, index=index, id=model.id)
+    except Exception as e:
+        if strict:
+            raise
+        current_app.logger.warning("Could not remove %s %s from index: %r", index, model.id, e)
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    elasticsearch = get_elasticsearch()
+    if not elasticsearch:
+        return [], 0
+    from elasticsearch.exceptions import NotFoundError
+
+    def search_index():
+        try:
+            return elasticsearch.search(index=index, query={"multi_match": {"query": query, "fields": ["*"]}},
+                                        from_=(page - 1) * per_page, size=per_page)
+        except NotFoundError:
+            return None
+
+    search = upstream("elasticsearch").call(search_index)
+    if search is None:
+        return [], 0
+    ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
+    return ids, search['hits']['total']['value']
+
+
+async def search_index(url, timeout, max_retries, index, query, page, per_page):
+    from elasticsearch import ApiError, NotFoundError, TransportError
+    try:
+        return await async_elasticsearch(url, timeout, max_retries).search(
+            index=index, query={"multi_match": {"query": query, "fields": ["*"]}},
+            from_=(page - 1) * per_page, size=per_page)
+    except NotFoundError:
+        return None
+    except (ApiError, TransportError) as e:
+        raise UpstreamError(e) from e
+
+
+async def query_index_async(index, query, page, per_page):
+    if not current_app.config["ELASTICSEARCH_URL"]:
+        return [], 0
+    search = await upstream("elasticsearch").call_async(
+        search_index(current_app.config["ELASTICSEARCH_URL"], current_app.config["ELASTICSEARCH_TIMEOUT"],
+                     current_app.config["ELASTICSEARCH_MAX_RETRIES"], index, query, page, per_page))
+    if search is None:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index, query={"multi_match": {"query": query, "fields": ["*"]}},
-        from_=(page - 1) * per_page, size=per_page)
     ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
     return ids, search['hits']['total']['value']
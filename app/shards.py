@@ -0,0 +1,263 @@
+import heapq
+from itertools import islice
+from time import time, sleep
+from flask import current_app
+from sqlalchemy import MetaData, Table, Column, Index, Integer, String, DateTime, select, insert, delete, \
+    case, func, text, create_engine
+from app import db
+from app.models import Post, Message, shard_bucket
+from app.pagination import keyset
+
+# posts and messages as stored on every shard: the primary tables without foreign keys into the
+# primary database, and AUTOINCREMENT so each shard can be started at its own id range
+shard_metadata = MetaData()
+
+shard_post = Table(
+    "post", shard_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("body", String(140)),
+    Column("timestamp", DateTime, nullable=False, index=True),
+    Column("user_id", Integer, nullable=False),
+    Column("language", String(5)),
+    Index("ix_post_user_id_timestamp", "user_id", "timestamp", "id"),
+    sqlite_autoincrement=True,
+)
+
+shard_message = Table(
+    "message", shard_metadata,
+    Column("id", Integer, primary_key=True),
+    Column("sender_id", Integer, nullable=False, index=True),
+    Column("recipient_id", Integer, nullable=False, index=True),
+    Column("conversation_id", Integer, nullable=False),
+    Column("body", String(140)),
+    Column("timestamp", DateTime, nullable=False, index=True),
+    Index("ix_message_conversation_id_timestamp", "conversation_id", "timestamp", "id"),
+    sqlite_autoincrement=True,
+)
+
+
+def owner_column(table):
+    """The user a row is placed by: the author of a post, the lower user id of a message's conversation."""
+    if table is shard_post:
+        return table.c.user_id
+    return case((table.c.sender_id < table.c.recipient_id, table.c.sender_id), else_=table.c.recipient_id)
+
+
+class ShardRouter(object):
+    """Places posts and messages on one of the ``SHARD_DATABASE_URLS`` databases by user id.
+
+    ``user_id % SHARD_BUCKETS`` picks a bucket and the ``shard_bucket`` directory in the primary
+    database picks the shard holding it, so ``flask shards rebalance`` can move whole buckets
+    without rehashing everyone. The directory is cached for ``SHARD_DIRECTORY_TTL`` seconds.
+    """
+
+    def __init__(self, app):
+        options = app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {}
+        self.engines = [create_engine(url, **options) for url in app.config["SHARD_DATABASE_URLS"]]
+        self.count = len(self.engines)
+        self.buckets = app.config["SHARD_BUCKETS"]
+        self.id_range = app.config["SHARD_ID_RANGE"]
+        self.ttl = app.config["SHARD_DIRECTORY_TTL"]
+        self.directory = {}
+        self.loaded_at = None
+
+    def engine(self, shard):
+        return self.engines[shard]
+
+    def dispose(self, close=True):
+        for engine in self.engines:
+            engine.dispose(close=close)
+
+    def load(self):
+        self.directory = dict(db.session.execute(select(shard_bucket.c.bucket, shard_bucket.c.shard)).all())
+        self.loaded_at = time()
+
+    def shard_for(self, user_id):
+        if self.loaded_at is None or time() - self.loaded_at >= self.ttl:
+            self.load()
+        bucket = user_id % self.buckets
+        return self.directory.get(bucket, bucket % self.count)
+
+    def bind(self, user_id):
+        return {"bind": self.engine(self.shard_for(user_id))}
+
+    def binds(self, user_ids=None):
+        """Bind arguments for every shard, or only for those holding one of ``user_ids``."""
+        shards = range(self.count) if user_ids is None else sorted({self.shard_for(id) for id in user_ids})
+        return [{"bind": self.engine(shard)} for shard in shards]
+
+    def connection_for(self, session, mapper, instance):
+        """Connection a flush writes ``instance`` with; installed as the session's ``connection_callable``."""
+        if isinstance(instance, Post):
+            return session.connection(bind_arguments=self.bind(instance.user_id))
+        if isinstance(instance, Message):
+            return session.connection(bind_arguments=self.bind(min(instance.sender_id, instance.recipient_id)))
+        return session.connection(bind_arguments={"mapper": mapper})
+
+    def create_all(self, batch_size=1000):
+        """Create the shard tables where missing and start the ids of shard ``n`` at ``n * SHARD_ID_RANGE``
+        (or past the primary's ids, if higher), so ids stay unique across shards and rows keep them when
+        their bucket moves. Posts and messages
+        written to the primary database before sharding was turned on are then copied to the shards
+        holding their buckets (rows already there are skipped). Returns rows copied."""
+        # the rows copied from the primary keep their ids, so every shard's ids start past them too
+        with db.engine.connect() as connection:
+            copied = {table.name: connection.scalar(select(func.max(table.c.id))) or 0
+                      for table in shard_metadata.sorted_tables}
+        for shard in range(self.count):
+            engine = self.engine(shard)
+            shard_metadata.create_all(engine)
+            with engine.begin() as connection:
+                for table in shard_metadata.sorted_tables:
+                    start = max(shard * self.id_range, copied[table.name])
+                    if not start or (connection.scalar(select(func.max(table.c.id))) or 0) >= start:
+                        continue
+                    if engine.dialect.name == "sqlite":
+                        connection.execute(text("DELETE FROM sqlite_sequence WHERE name = :name"), {"name": table.name})
+                        connection.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES (:name, :seq)"),
+                                           {"name": table.name, "seq": start})
+                    elif engine.dialect.name == "postgresql":
+                        connection.execute(text("SELECT setval(pg_get_serial_sequence(:name, 'id'), :seq)"),
+                                           {"name": table.name, "seq": start})
+                    else:
+                        connection.execute(text("ALTER TABLE {} AUTO_INCREMENT = {}".format(table.name, start + 1)))
+        # pin the buckets that have no directory entry yet where they are routed today
+        placed = set(db.session.scalars(select(shard_bucket.c.bucket)))
+        rows = [{"bucket": bucket, "shard": bucket % self.count} for bucket in range(self.buckets) if bucket not in placed]
+        if rows:
+            db.session.execute(insert(shard_bucket), rows)
+        db.session.commit()
+        self.load()
+        return sum(copy_bucket(db.engine, self.engine(self.shard_for(bucket)), bucket, self.buckets, batch_size)
+                   for bucket in range(self.buckets))
+
+    def feed(self, author_ids, page, per_page, before=None):
+        """Page ``page`` of the posts by ``author_ids`` (everyone if None), newest first and after
+        the ``before`` cursor, and whether there is a next page. Each shard holding one of the
+        authors returns its newest posts and the sorted streams are merged."""
+        limit = page * per_page + 1
+        query = select(Post)
+        if author_ids is not None:
+            query = query.where(Post.user_id.in_(author_ids))
+        query = keyset(query, Post.timestamp, Post.id, before, limit - 1)
+        streams = [db.session.scalars(query, bind_arguments=bind).all() for bind in self.binds(author_ids)]
+        posts = list(islice(heapq.merge(*streams, key=lambda post: (post.timestamp, post.id), reverse=True),
+                            (page - 1) * per_page, limit))
+        return posts[:per_page], len(posts) > per_page
+
+
+def routed(user_id):
+    """Bind arguments that send a post or message query about ``user_id`` to its shard."""
+    router = current_app.shards
+    return router.bind(user_id) if router is not None else None
+
+
+def scatter(query, user_ids=None):
+    """Run ``query`` on every shard holding one of ``user_ids`` (all shards by default) and return the
+    results; a single result from the primary database when sharding is off."""
+    router = current_app.shards
+    if router is None:
+        return [db.session.execute(query)]
+    return [db.session.execute(query, bind_arguments=bind) for bind in router.binds(user_ids)]
+
+
+def find(model, id):
+    """``db.session.get`` for a post or message, looked up on every shard when sharding is on."""
+    if current_app.shards is None:
+        return db.session.get(model, id)
+    return next((obj for result in scatter(select(model).where(model.id == id)) for obj in result.scalars()), None)
+
+
+def latest(results):
+    """Combine ``(max id, max timestamp)`` rows from several shards."""
+    rows = [row for result in results for row in result if row[0] is not None]
+    return (max(row[0] for row in rows), max(row[1] for row in rows)) if rows else (None, None)
+
+
+def plan(directory, count, buckets):
+    """Bucket moves ``(bucket, source, target)`` that leave every shard within one bucket of an even
+    share, moving as few buckets as possible."""
+    owned = {shard: [] for shard in range(count)}
+    for bucket in range(buckets):
+        shard = directory.get(bucket, bucket % count)
+        if shard not in owned:
+            raise ValueError("bucket {} is on shard {}, which is not configured".format(bucket, shard))
+        owned[shard].append(bucket)
+    surplus = []
+    # the shards holding the most buckets keep the odd ones
+    by_size = sorted(owned, key=lambda shard: -len(owned[shard]))
+    quota = {shard: buckets // count + (1 if i < buckets % count else 0) for i, shard in enumerate(by_size)}
+    for shard in range(count):
+        while len(owned[shard]) > quota[shard]:
+            surplus.append((owned[shard].pop(), shard))
+    moves = []
+    for shard in range(count):
+        while len(owned[shard]) < quota[shard]:
+            bucket, source = surplus.pop(0)
+            owned[shard].append(bucket)
+            moves.append((bucket, source, shard))
+    return moves
+
+
+def copy_bucket(source, target, bucket, buckets, batch_size):
+    """Copy the rows of ``bucket`` that ``target`` does not have yet. Returns rows copied."""
+    copied = 0
+    for table in shard_metadata.sorted_tables:
+        last_id = 0
+        while True:
+            with source.connect() as connection:
+                rows = connection.execute(select(table).where(owner_column(table) % buckets == bucket,
+                                                              table.c.id > last_id)
+                                          .order_by(table.c.id).limit(batch_size)).mappings().all()
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            with target.begin() as connection:
+                present = set(connection.scalars(select(table.c.id).where(table.c.id.in_([row["id"] for row in rows]))))
+                missing = [dict(row) for row in rows if row["id"] not in present]
+                if missing:
+                    connection.execute(insert(table), missing)
+            copied += len(missing)
+    return copied
+
+
+def move_bucket(router, bucket, source, target, batch_size=1000, wait=None):
+    """Move ``bucket`` from shard ``source`` to ``target`` while both stay online.
+
+    Rows are copied, the directory is switched, then after every process has reloaded it
+    (``SHARD_DIRECTORY_TTL``) the rows written to the source meanwhile are copied too and the
+    source rows are deleted. Returns rows copied.
+    """
+    source_engine, target_engine = router.engine(source), router.engine(target)
+    copied = copy_bucket(source_engine, target_engine, bucket, router.buckets, batch_size)
+    db.session.execute(delete(shard_bucket).where(shard_bucket.c.bucket == bucket))
+    db.session.execute(insert(shard_bucket).values(bucket=bucket, shard=target))
+    db.session.commit()
+    router.load()
+    sleep(router.ttl if wait is None else wait)
+    copied += copy_bucket(source_engine, target_engine, bucket, router.buckets, batch_size)
+    with source_engine.begin() as connection:
+        for table in shard_metadata.sorted_tables:
+            connection.execute(delete(table).where(owner_column(table) % router.buckets == bucket))
+    return copied
+
+
+def rebalance(batch_size=1000, wait=None, dry_run=False, progress=None):
+    """Even out buckets over the configured shards, e.g. after adding a URL to ``SHARD_DATABASE_URLS``.
+    Returns the moves made (or planned with ``dry_run``)."""
+    router = current_app.shards
+    router.load()
+    moves = plan(router.directory, router.count, router.buckets)
+    if dry_run:
+        return moves
+    for bucket, source, target in moves:
+        rows = move_bucket(router, bucket, source, target, batch_size, wait)
+        if progress is not None:
+            progress(bucket, source, target, rows)
+    return moves
+
+
+def init_shards(app):
+    if not app.config["SHARD_DATABASE_URLS"]:
+        return None
+    return ShardRouter(app)
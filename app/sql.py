@@ -0,0 +1,54 @@
+from sqlalchemy import insert, update, and_
+from app import db
+
+
+def upsert(model, values, keys, columns):
+    """Insert ``values`` into ``model``, or update ``columns`` of the row with the same unique ``keys``.
+
+    Compiles to ``INSERT ... ON CONFLICT DO UPDATE`` on SQLite and PostgreSQL and to
+    ``INSERT ... ON DUPLICATE KEY UPDATE`` on MySQL/MariaDB, so it is one statement without
+    a race between looking the row up and writing it. Other databases get an UPDATE,
+    followed by an INSERT when no row matched.
+    """
+    dialect = db.session.get_bind(mapper=model).dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(model).values(values)
+        statement = statement.on_conflict_do_update(index_elements=keys,
+                                                    set_={column: statement.excluded[column] for column in columns})
+        return db.session.execute(statement)
+    if dialect in ("mysql", "mariadb"):
+        from sqlalchemy.dialects.mysql import insert as dialect_insert
+        statement = dialect_insert(model).values(values)
+        statement = statement.on_duplicate_key_update({column: statement.inserted[column] for column in columns})
+        return db.session.execute(statement)
+    table = model.__table__
+    match = and_(*(table.c[key] == values[key] for key in keys))
+    result = db.session.execute(update(table).where(match).values({column: values[column] for column in columns}))
+    if result.rowcount == 0:
+        result = db.session.execute(insert(table).values(values))
+    return result
+
+
+def insert_ignore(table, rows):
+    """Insert ``rows`` into ``table`` with one executemany, skipping rows that hit a unique key.
+
+    ``INSERT ... ON CONFLICT DO NOTHING`` on SQLite and PostgreSQL and ``INSERT IGNORE`` on
+    MySQL/MariaDB; other databases get a plain INSERT, so callers should leave out rows they
+    know to exist.
+    """
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(table).on_conflict_do_nothing()
+    elif dialect in ("mysql", "mariadb"):
+        statement = insert(table).prefix_with("IGNORE")
+    else:
+        statement = insert(table)
+    return db.session.execute(statement, rows)
@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from app import create_app
+from config import Config
+
+
+class ProbeConfig(Config):
+    TESTING = True
+
+
+app = create_app(ProbeConfig)
+created = time.perf_counter()
+response = app.test_client().get("/auth/login")
+done = time.perf_counter()
+print(json.dumps({
+    "status": response.status_code,
+    "create_app": created - start,
+    "first_request": done - created,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+DEFERRED_MODULES = ["aiohttp", "alembic", "elasticsearch", "flask_mail", "flask_migrate", "langdetect", "numpy", "requests", "sendgrid"]
+
+
+def profile_startup(cwd=None, template_cache=True):
+    """Start a fresh interpreter, build the app and serve one request; return timings in seconds.
+
+    ``imports`` maps each top-level package to its total import time (``-X importtime``).
+    With ``template_cache`` off the templates are compiled from source, as before ``flask
+    templates precompile``.
+    """
+    env = dict(os.environ)
+    if not template_cache:
+        env["TEMPLATE_CACHE_DIR"] = ""
+    launched = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", PROBE], cwd=cwd, env=env,
+                            capture_output=True, text=True, check=True)
+    total = time.perf_counter() - launched
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    imports = defaultdict(float)
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        imports[name.strip().split(".")[0]] += int(own) / 1e6
+    report["total"] = total
+    report["imports"] = dict(sorted(imports.items(), key=lambda item: item[1], reverse=True))
+    modules = set(report.pop("modules"))
+    report["eager"] = [name for name in DEFERRED_MODULES if name in modules]
+    return report
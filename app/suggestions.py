@@ -0,0 +1,87 @@
+from time import perf_counter
+import numpy as np
+from sqlalchemy import select, delete, insert, update, or_
+from app import db
+from app.models import User, followers, follow_suggestion
+
+
+def load_graph():
+    """Read ``followers`` into CSR arrays over dense node numbers.
+
+    Returns ``(ids, indptr, indices)`` where ``ids[node]`` is the user id of a node and the
+    followees of ``node`` are ``indices[indptr[node]:indptr[node + 1]]``, sorted.
+    """
+    chunks = []
+    result = db.session.execute(select(followers.c.follower_id, followers.c.followed_id)
+                                .execution_options(yield_per=100000))
+    for partition in result.partitions():
+        chunks.append(np.array(partition, dtype=np.int64).reshape(-1, 2))
+    edges = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.int64)
+    ids, nodes = np.unique(edges.ravel(), return_inverse=True)
+    nodes = nodes.reshape(-1, 2)
+    order = np.lexsort((nodes[:, 1], nodes[:, 0]))
+    src, dst = nodes[order, 0], nodes[order, 1]
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=len(ids)), out=indptr[1:])
+    return ids, indptr, dst
+
+
+def expand(indptr, indices, rows, nodes):
+    """For each ``(row, node)`` pair, emit ``(row, neighbour)`` for every neighbour of ``node``."""
+    starts = indptr[nodes]
+    lengths = indptr[nodes + 1] - starts
+    total = lengths.sum()
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+    return np.repeat(rows, lengths), indices[offsets]
+
+
+def two_hop(indptr, indices, users, top):
+    """Score friends-of-friends for ``users`` (sorted node numbers) and keep the ``top`` per user.
+
+    A candidate's score is the number of the user's followees who follow it; the user and
+    accounts they already follow are excluded. Returns parallel arrays ``(user, candidate, score)``.
+    """
+    n = len(indptr) - 1
+    rows, followees = expand(indptr, indices, users, users)
+    candidate_rows, candidates = expand(indptr, indices, rows, followees)
+    keys = candidate_rows * n + candidates
+    keep = (candidates != candidate_rows) & ~np.isin(keys, rows * n + followees)
+    keys, scores = np.unique(keys[keep], return_counts=True)
+    user, candidate = np.divmod(keys, n)
+    order = np.lexsort((candidate, -scores, user))
+    user, candidate, scores = user[order], candidate[order], scores[order]
+    starts = np.flatnonzero(np.r_[True, user[1:] != user[:-1]])
+    rank = np.arange(len(user)) - np.repeat(starts, np.diff(np.r_[starts, len(user)]))
+    best = rank < top
+    return user[best], candidate[best], scores[best]
+
+
+def refresh(top=10, chunk_size=10000, only_changed=False):
+    """Recompute follow suggestions and store the ``top`` per user in ``follow_suggestion``.
+
+    With ``only_changed``, only users whose ``version`` moved since their last refresh (they
+    followed or unfollowed someone, among other changes) are recomputed. Returns run statistics.
+    """
+    started = perf_counter()
+    ids, indptr, indices = load_graph()
+    query = select(User.id, User.version).order_by(User.id)
+    if only_changed:
+        query = query.where(or_(User.suggestions_version.is_(None), User.suggestions_version != User.version))
+    users = db.session.execute(query).all()
+    stored = 0
+    for i in range(0, len(users), chunk_size):
+        chunk = users[i:i + chunk_size]
+        user_ids = np.array([user.id for user in chunk], dtype=np.int64)
+        nodes = np.searchsorted(ids, user_ids)
+        present = nodes < len(ids)
+        present[present] = ids[nodes[present]] == user_ids[present]
+        user, candidate, scores = two_hop(indptr, indices, nodes[present], top)
+        rows = [{"user_id": int(u), "suggested_id": int(c), "score": int(score)}
+                for u, c, score in zip(ids[user], ids[candidate], scores)]
+        db.session.execute(delete(follow_suggestion).where(follow_suggestion.c.user_id.in_(user_ids.tolist())))
+        if rows:
+            db.session.execute(insert(follow_suggestion), rows)
+        db.session.execute(update(User), [{"id": user.id, "suggestions_version": user.version} for user in chunk])
+        db.session.commit()
+        stored += len(rows)
+    return {"users": len(users), "edges": len(indices), "suggestions": stored, "seconds": perf_counter() - started}
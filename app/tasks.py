@@ -0,0 +1,74 @@
+from flask import current_app
+from app import db
+from app.jobs import job, prune
+from app.models import SearchableMixin, Post
+
+
+@job()
+def index_object(tablename, id):
+    """Bring the search index entry of one row up to date, removing it if the row is gone."""
+    from app.search import add_to_index, remove_from_index
+    from app.shards import find
+    model = next(cls for cls in db.Model.__subclasses__()
+                 if issubclass(cls, SearchableMixin) and cls.__tablename__ == tablename)
+    obj = find(model, id)
+    if obj is None:
+        remove_from_index(tablename, model(id=id), strict=True)
+    else:
+        add_to_index(tablename, obj, strict=True)
+
+
+@job()
+def detect_post_language(post_id):
+    from app.importer import detect_language
+    from app.shards import find
+    post = find(Post, post_id)
+    if post is not None:
+        post.language = detect_language(post.body)
+
+
+@job()
+def backfill_timelines(author_id):
+    from app.timeline import backfill_followers
+    backfill_followers(author_id)
+
+
+@job(backoff=60)
+def deliver_mail(subject, sender, recipients, html_body):
+    from app.email import deliver_sendgrid
+    deliver_sendgrid(subject, sender, recipients, html_body)
+
+
+@job(backoff=60)
+def deliver_smtp_mail(subject, sender, recipients, text_body, html_body):
+    from flask_mail import Message
+    from app.email import get_mail
+    msg = Message(subject, sender=sender, recipients=recipients)
+    msg.body = text_body
+    msg.html = html_body
+    get_mail().send(msg)
+
+
+@job(every=3600)
+def compact_notifications():
+    from app.notifications import compact
+    compact(current_app.config["NOTIFICATION_TTL"])
+
+
+@job(every=60)
+def refresh_hot_ranking():
+    if current_app.hot_ranking is not None:
+        current_app.hot_ranking.refresh()
+
+
+@job(every=24 * 3600)
+def archive_posts():
+    from app.archive import archive, hot_window_start
+    # with shards on, the primary post table only holds the copies left by `flask shards init`
+    if current_app.shards is None:
+        archive(hot_window_start())
+
+
+@job(every=3600)
+def prune_jobs():
+    prune(current_app.config["JOB_RETENTION"])
@@ -0,0 +1,25 @@
+import os
+from time import perf_counter
+from jinja2 import FileSystemBytecodeCache
+
+
+def init_template_cache(app):
+    """Keep compiled templates in ``TEMPLATE_CACHE_DIR`` so new workers load bytecode instead of
+    compiling every template on first use. Jinja checks the source checksum, so edited templates
+    are recompiled."""
+    directory = app.config["TEMPLATE_CACHE_DIR"]
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    return app.jinja_env.bytecode_cache
+
+
+def precompile(app):
+    """Compile every template into the environment (and the bytecode cache, if enabled).
+    Returns ``(templates, seconds)``."""
+    started = perf_counter()
+    names = app.jinja_env.list_templates(extensions=["html", "txt"])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names), perf_counter() - started
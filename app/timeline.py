@@ -0,0 +1,118 @@
+import heapq
+from flask import current_app
+from sqlalchemy import select, insert, delete, literal, func, update
+from app import db
+from app.models import User, Post, followers, timeline
+from app.pagination import keyset
+
+
+def is_light(author_id):
+    """SQL condition that is true while ``author_id`` is below the heavy-author threshold."""
+    return select(User.follower_count).where(User.id == author_id).scalar_subquery() < \
+        current_app.config["TIMELINE_HEAVY_THRESHOLD"]
+
+
+def fan_out(connection, post):
+    """Push ``post`` into the timeline of every follower of a light author."""
+    followers_of_author = select(followers.c.follower_id, literal(post.id), literal(post.user_id),
+                                 literal(post.timestamp)) \
+        .where(followers.c.followed_id == post.user_id, is_light(post.user_id))
+    connection.execute(insert(timeline).from_select(
+        ["user_id", "post_id", "author_id", "timestamp"], followers_of_author))
+
+
+def fan_out_since(post_id):
+    """Push the posts after ``post_id`` by light authors into their followers' timelines, skipping entries
+    that are already there. Used after bulk inserts that bypass the ``after_flush`` fan-out. As with
+    ``backfill``, only posts among an author's newest ``TIMELINE_BACKFILL`` are pushed."""
+    authors = select(Post.user_id).join(User, User.id == Post.user_id) \
+        .where(Post.id > post_id, User.follower_count < current_app.config["TIMELINE_HEAVY_THRESHOLD"]).distinct()
+    ranked = select(Post.id, Post.user_id, Post.timestamp, func.row_number().over(
+        partition_by=Post.user_id, order_by=(Post.timestamp.desc(), Post.id.desc())).label("rank")) \
+        .where(Post.user_id.in_(authors)).subquery()
+    pushed = select(timeline.c.post_id).where(timeline.c.user_id == followers.c.follower_id,
+                                              timeline.c.post_id == ranked.c.id)
+    entries = select(followers.c.follower_id, ranked.c.id, ranked.c.user_id, ranked.c.timestamp) \
+        .join(ranked, ranked.c.user_id == followers.c.followed_id) \
+        .where(ranked.c.id > post_id, ranked.c.rank <= current_app.config["TIMELINE_BACKFILL"], ~pushed.exists())
+    db.session.execute(insert(timeline).from_select(["user_id", "post_id", "author_id", "timestamp"], entries))
+
+
+def backfill(follower, author):
+    """Copy the latest posts of a light ``author`` into ``follower``'s timeline."""
+    recent = select(literal(follower.id), Post.id, Post.user_id, Post.timestamp) \
+        .where(Post.user_id == author.id, is_light(author.id)) \
+        .order_by(Post.timestamp.desc()).limit(current_app.config["TIMELINE_BACKFILL"])
+    db.session.execute(insert(timeline).from_select(["user_id", "post_id", "author_id", "timestamp"], recent))
+
+
+def backfill_followers(author_id):
+    """Copy the latest posts of ``author_id`` into the timeline of every follower, skipping entries that are
+    already there. Run when an author drops back below the heavy threshold: their posts were pulled until then."""
+    recent = select(Post.id, Post.user_id, Post.timestamp) \
+        .where(Post.user_id == author_id, is_light(author_id)) \
+        .order_by(Post.timestamp.desc()).limit(current_app.config["TIMELINE_BACKFILL"]).subquery()
+    pushed = select(timeline.c.post_id).where(timeline.c.user_id == followers.c.follower_id,
+                                              timeline.c.post_id == recent.c.id)
+    entries = select(followers.c.follower_id, recent.c.id, recent.c.user_id, recent.c.timestamp) \
+        .join(recent, recent.c.user_id == followers.c.followed_id) \
+        .where(followers.c.followed_id == author_id, ~pushed.exists())
+    db.session.execute(insert(timeline).from_select(["user_id", "post_id", "author_id", "timestamp"], entries))
+
+
+def remove(follower, author):
+    db.session.execute(delete(timeline).where(timeline.c.user_id == follower.id,
+                                              timeline.c.author_id == author.id))
+
+
+def home_timeline(user, page, per_page, before=None):
+    """Return the posts for ``page`` of ``user``'s home feed and whether there is a next page.
+
+    Posts by light authors come from the pushed timeline; the user's own posts and posts by
+    heavy authors they follow are pulled, and the three sorted streams are heap-merged on
+    ``(timestamp, id)``. With sharding the posts of the user and everyone they follow are
+    gathered from their shards instead. ``before`` starts the feed after a ``(timestamp, id)``
+    cursor.
+    """
+    if current_app.shards is not None:
+        return current_app.shards.feed(user.followed_ids() + [user.id], page, per_page, before)
+    limit = page * per_page
+    pushed = keyset(select(timeline.c.timestamp, timeline.c.post_id).where(timeline.c.user_id == user.id),
+                    timeline.c.timestamp, timeline.c.post_id, before, limit)
+    own = keyset(select(Post.timestamp, Post.id).where(Post.user_id == user.id), Post.timestamp, Post.id, before, limit)
+    heavy_authors = select(User.id).where(User.id.in_(user.followed_ids()),
+                                          User.follower_count >= current_app.config["TIMELINE_HEAVY_THRESHOLD"])
+    pulled = keyset(select(Post.timestamp, Post.id).where(Post.user_id.in_(heavy_authors)),
+                    Post.timestamp, Post.id, before, limit)
+
+    streams = [[tuple(row) for row in db.session.execute(query)] for query in (pushed, own, pulled)]
+    ids = []
+    seen = set()
+    for timestamp, post_id in heapq.merge(*streams, reverse=True):
+        if post_id not in seen:
+            seen.add(post_id)
+            ids.append(post_id)
+    ids = ids[(page - 1) * per_page:limit + 1]
+    posts = {post.id: post for post in db.session.scalars(select(Post).where(Post.id.in_(ids[:per_page])))}
+    return [posts[post_id] for post_id in ids[:per_page] if post_id in posts], len(ids) > per_page
+
+
+def recent_posts(before, limit):
+    """The newest posts by anyone after the ``before`` cursor, and whether there are more."""
+    if current_app.shards is not None:
+        return current_app.shards.feed(None, 1, limit, before)
+    posts = db.session.scalars(keyset(select(Post), Post.timestamp, Post.id, before, limit)).all()
+    return posts[:limit], len(posts) > limit
+
+
+def rebuild():
+    """Recount followers and rebuild every pushed timeline from scratch."""
+    db.session.execute(update(User).values(follower_count=select(func.count()).select_from(followers)
+                                           .where(followers.c.followed_id == User.id).scalar_subquery()))
+    db.session.execute(delete(timeline))
+    light = select(followers.c.follower_id, Post.id, Post.user_id, Post.timestamp) \
+        .join(Post, Post.user_id == followers.c.followed_id) \
+        .join(User, User.id == Post.user_id) \
+        .where(User.follower_count < current_app.config["TIMELINE_HEAVY_THRESHOLD"])
+    db.session.execute(insert(timeline).from_select(["user_id", "post_id", "author_id", "timestamp"], light))
+    db.session.commit()
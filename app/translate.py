@@ -1,9 +1,20 @@
-import requests
+import asyncio
 from flask_babel import _
 from flask import current_app
+from app.aio import http_session
+from app.outbound import upstream, CircuitOpenError, UpstreamError
 
 
-def translate(text, source_lang, dest_lang):
+async def post_json(url, headers, payload, limit):
+    async with http_session("translator", limit).post(url, headers=headers, json=payload) as response:
+        if response.status >= 500:
+            raise UpstreamError(response.status)
+        if response.status != 200:
+            return response.status, None
+        return response.status, await response.json()
+
+
+async def translate(text, source_lang, dest_lang):
     if "MS_TRANSLATOR_KEY" not in current_app.config or not current_app.config[
         'MS_TRANSLATOR_KEY'] or "MS_TRANSLATOR_API_ENDPOINT" not in current_app.config or not current_app.config[
         'MS_TRANSLATOR_API_ENDPOINT']:
@@ -17,8 +28,13 @@ def translate(text, source_lang, dest_lang):
     url = "{}/translate?api-version=3.0&from={}&to={}".format(current_app.config['MS_TRANSLATOR_API_ENDPOINT'],
                                                               source_lang, dest_lang)
 
-    response = requests.post(url=url, headers=auth, json=[{"Text": text}])
+    import aiohttp
+    try:
+        status, data = await upstream("translator").call_async(
+            post_json(url, auth, [{"Text": text}], current_app.config["OUTBOUND_POOL_SIZE"]))
+    except (asyncio.TimeoutError, aiohttp.ClientError, CircuitOpenError, UpstreamError):
+        status = None
 
-    if response.status_code != 200:
+    if status != 200:
         return _('Error: the translation service failed.')
-    return response.json()[0]["translations"][0]["text"]
+    return data[0]["translations"][0]["text"]
@@ -0,0 +1,159 @@
+import heapq
+import os
+import re
+import threading
+from array import array
+from hashlib import blake2b
+from time import time, sleep
+from sqlalchemy import select, insert, delete, func
+from app import db
+from app.models import trending_term
+
+TOKEN_RE = re.compile(r"#?\w{3,}", re.UNICODE)
+STOPWORDS = frozenset("""
+the and for are but not you all any can had her was one our out has him his how man new now old see two way who
+its did get may say she too use that with have this will your from they know want been good much some time very
+when come here just like long make many more only over such take than them well were what about would there their
+los las una unos para por con del que como pero sus este esta esto""".split())
+
+
+def tokenize(text):
+    return [token for token in TOKEN_RE.findall(text.lower()) if token.lstrip("#") not in STOPWORDS]
+
+
+class CountMinSketch(object):
+    def __init__(self, width, depth):
+        self.width = width
+        self.rows = [array("I", bytes(4 * width)) for i in range(depth)]
+
+    def _cells(self, item):
+        # 32 independent bits per row; hash((row, item)) would put items that collide in one
+        # row into the same cell of every row
+        digest = blake2b(item.encode("utf-8"), digest_size=4 * len(self.rows)).digest()
+        for i, row in enumerate(self.rows):
+            yield row, int.from_bytes(digest[4 * i:4 * i + 4], "little") % self.width
+
+    def add(self, item, count=1):
+        estimate = None
+        for row, i in self._cells(item):
+            row[i] += count
+            estimate = row[i] if estimate is None else min(estimate, row[i])
+        return estimate
+
+    def estimate(self, item):
+        return min(row[i] for row, i in self._cells(item))
+
+
+class TopK(object):
+    """The ``k`` items with the highest counts seen so far, using a lazily cleaned min-heap."""
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self.heap = []
+
+    def offer(self, item, count):
+        if item in self.counts:
+            self.counts[item] = count
+            heapq.heappush(self.heap, (count, item))
+        elif len(self.counts) < self.k:
+            self.counts[item] = count
+            heapq.heappush(self.heap, (count, item))
+        elif count > self._min():
+            smallest, evicted = heapq.heappop(self.heap)
+            del self.counts[evicted]
+            self.counts[item] = count
+            heapq.heappush(self.heap, (count, item))
+        if len(self.heap) > 4 * self.k:
+            self.heap = [(count, item) for item, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def _min(self):
+        while self.heap[0][0] != self.counts.get(self.heap[0][1]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0]
+
+    def items(self):
+        return sorted(self.counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+class TrendingTracker(object):
+    """Heavy-hitter term counts for recent posts.
+
+    Each process counts the terms of the posts it commits into a Count-Min Sketch with a top-K
+    heap. Every ``interval`` seconds the local heavy hitters are written to ``trending_term`` in
+    a time bucket, buckets older than ``window`` are pruned, and the merged top terms of all
+    processes are read back into ``snapshot``, which ``/trending`` serves without touching the DB.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config["TRENDING_FLUSH_INTERVAL"]
+        self.window = app.config["TRENDING_WINDOW"]
+        self.k = app.config["TRENDING_TOP"]
+        self.snapshot = []
+        self.snapshot_time = None
+        self._lock = threading.Lock()
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        self.sketch = CountMinSketch(self.app.config["TRENDING_SKETCH_WIDTH"], 4)
+        self.top = TopK(self.k * 10)
+
+    def track(self, text):
+        with self._lock:
+            for token in tokenize(text):
+                self.top.offer(token, self.sketch.add(token))
+        self._ensure_timer()
+
+    def _ensure_timer(self):
+        if self.interval and self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="trending-flush", daemon=True).start()
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    self.app.logger.warning("Could not flush trending terms: %r", e)
+                    db.session.rollback()
+
+    def flush(self, now=None):
+        now = time() if now is None else now
+        with self._lock:
+            counts = self.top.items()
+            self._reset()
+        bucket = int(now // self.interval) * self.interval if self.interval else int(now)
+        if counts:
+            db.session.execute(insert(trending_term),
+                               [{"bucket": bucket, "term": term[:64], "count": count} for term, count in counts])
+        db.session.execute(delete(trending_term).where(trending_term.c.bucket < now - self.window))
+        db.session.commit()
+        self.refresh(now)
+
+    def current(self, now=None):
+        """The merged top terms, re-read from the DB at most once per ``interval``."""
+        now = time() if now is None else now
+        if self.snapshot_time is None or now - self.snapshot_time >= self.interval:
+            self.refresh(now)
+        return self.snapshot
+
+    def refresh(self, now=None):
+        now = time() if now is None else now
+        total = func.sum(trending_term.c.count).label("total")
+        query = select(trending_term.c.term, total) \
+            .where(trending_term.c.bucket >= now - self.window) \
+            .group_by(trending_term.c.term).order_by(total.desc(), trending_term.c.term).limit(self.k)
+        self.snapshot = [{"term": term, "count": int(count)} for term, count in db.session.execute(query)]
+        self.snapshot_time = now
+
+
+def init_trending(app):
+    if not app.config["TRENDING_TOP"]:
+        return None
+    return TrendingTracker(app)
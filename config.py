@@ -16,9 +16,81 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = os.environ.get("ADMINS_EMAIL_ADDRESSES")
     SENDGRID_API_KEY = os.environ.get('SENDGRID_API_KEY')
+    SENDGRID_TIMEOUT = float(os.environ.get('SENDGRID_TIMEOUT') or 10)
     POSTS_PER_PAGE = 3
+    MESSAGES_PER_PAGE = 10
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or 'scrypt:32768:8:1'
+    PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH') or 16)
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS') or 1)
+    PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE') or 8)
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT') or 5)
+    PASSWORD_HASH_NICE = int(os.environ.get('PASSWORD_HASH_NICE') or 10)
+    # (requests, seconds) per signed-in user, or per IP before signing in; only writes are counted
+    RATELIMITS = {
+        'auth.login': (10, 60),
+        'auth.register': (5, 3600),
+        'auth.reset_password_request': (5, 3600),
+        'api.get_token': (10, 60),
+        'api.follow_users': (10, 60),
+        'main.index': (30, 60),
+        'main.send_message': (20, 60),
+        'main.follow': (60, 60),
+    }
+    # "shared" keeps the counters in memory shared by the workers forked from a preloaded gunicorn master
+    RATELIMIT_STORAGE = os.environ.get('RATELIMIT_STORAGE') or 'memory'
+    RATELIMIT_MAX_KEYS = int(os.environ.get('RATELIMIT_MAX_KEYS') or 100000)
+    RATELIMIT_SHARED_SLOTS = int(os.environ.get('RATELIMIT_SHARED_SLOTS') or 65536)
+    # reverse proxies in front of the app; 0 ignores X-Forwarded-For, which clients could forge
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR') or 0)
+    API_PAGE_SIZE = 20
+    API_MAX_PAGE_SIZE = 100
+    API_TOKEN_EXPIRATION = int(os.environ.get('API_TOKEN_EXPIRATION') or 3600)
+    API_MAX_FOLLOWS = 5000
+    POST_HOT_MONTHS = int(os.environ.get('POST_HOT_MONTHS') or 6)
+    SHARD_DATABASE_URLS = [url for url in (os.environ.get('SHARD_DATABASE_URLS') or '').split(',') if url]
+    SHARD_BUCKETS = int(os.environ.get('SHARD_BUCKETS') or 64)
+    SHARD_ID_RANGE = int(os.environ.get('SHARD_ID_RANGE') or 100000000)
+    SHARD_DIRECTORY_TTL = float(os.environ.get('SHARD_DIRECTORY_TTL') or 30)
+    NOTIFICATION_TTL = int(os.environ.get('NOTIFICATION_TTL') or 30 * 24 * 3600)
+    TIMELINE_HEAVY_THRESHOLD = int(os.environ.get('TIMELINE_HEAVY_THRESHOLD') or 10000)
+    TIMELINE_BACKFILL = int(os.environ.get('TIMELINE_BACKFILL') or 200)
+    FOLLOW_GRAPH_SIZE = int(os.environ.get('FOLLOW_GRAPH_SIZE') or 100000)
+    HOT_SIZE = int(os.environ.get('HOT_SIZE') or 1000)
+    HOT_REFRESH_INTERVAL = int(os.environ.get('HOT_REFRESH_INTERVAL') or 60)
+    HOT_DECAY = float(os.environ.get('HOT_DECAY') or 45000)
+    TRENDING_TOP = int(os.environ.get('TRENDING_TOP') or 10)
+    TRENDING_WINDOW = int(os.environ.get('TRENDING_WINDOW') or 3600)
+    TRENDING_FLUSH_INTERVAL = int(os.environ.get('TRENDING_FLUSH_INTERVAL') or 60)
+    TRENDING_SKETCH_WIDTH = int(os.environ.get('TRENDING_SKETCH_WIDTH') or 4096)
     LANGUAGES = ["en", "es"]
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
     MS_TRANSLATOR_API_ENDPOINT = "https://api.cognitive.microsofttranslator.com"
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or 2)
+    ELASTICSEARCH_MAX_RETRIES = int(os.environ.get('ELASTICSEARCH_MAX_RETRIES') or 1)
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 5)
+    OUTBOUND_POOL_SIZE = int(os.environ.get('OUTBOUND_POOL_SIZE') or 100)
+    OUTBOUND_BREAKER_THRESHOLD = int(os.environ.get('OUTBOUND_BREAKER_THRESHOLD') or 5)
+    OUTBOUND_BREAKER_RESET = float(os.environ.get('OUTBOUND_BREAKER_RESET') or 30)
+    # client addresses allowed to read the /status/* metrics
+    STATUS_ADDRESSES = (os.environ.get('STATUS_ADDRESSES') or '127.0.0.1,::1').split(',')
+    JOBS_EAGER = bool(os.environ.get('JOBS_EAGER'))
+    JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS') or 5)
+    JOB_BACKOFF = float(os.environ.get('JOB_BACKOFF') or 30)
+    JOB_TIMEOUT = int(os.environ.get('JOB_TIMEOUT') or 600)
+    JOB_RETENTION = int(os.environ.get('JOB_RETENTION') or 7 * 24 * 3600)
+    JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL') or 1)
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'json'
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE') or 10000)
+    TEMPLATE_CACHE_DIR = os.environ.get('TEMPLATE_CACHE_DIR', os.path.join(basedir, '.template_cache'))
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 4096)
+    QUERY_CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE') or 2048)
+    FRAGMENT_CACHE_REDIS_URL = os.environ.get('FRAGMENT_CACHE_REDIS_URL')
+    FRAGMENT_CACHE_TIMEOUT = int(os.environ.get('FRAGMENT_CACHE_TIMEOUT') or 3600)
+    COMPRESS_MIMETYPES = ['text/html', 'application/json', 'application/msgpack', 'text/css', 'application/javascript']
+    COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE') or 500)
+    COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL') or 6)
+    COMPRESS_BROTLI_QUALITY = int(os.environ.get('COMPRESS_BROTLI_QUALITY') or 4)
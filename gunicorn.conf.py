@@ -0,0 +1,51 @@
+import multiprocessing
+import os
+
+cpu_count = multiprocessing.cpu_count()
+
+bind = os.environ.get('GUNICORN_BIND') or ':5000'
+
+# "sync" suits CPU-bound pages; "gthread" (or "gevent", if installed) lets a worker keep
+# serving while /translate and /search wait on their upstreams.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or 'sync'
+workers = int(os.environ.get('GUNICORN_WORKERS') or cpu_count * 2 + 1)
+threads = int(os.environ.get('GUNICORN_THREADS') or (cpu_count * 2 if worker_class == 'gthread' else 1))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS') or 1000)
+
+# Load the app once in the master so workers share its memory copy-on-write.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() != 'false'
+
+# Recycle workers to bound memory growth; jitter keeps them from restarting together.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS') or 2000)
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER') or max_requests // 10)
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or 30)
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT') or 30)
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE') or 5)
+
+accesslog = '-'
+errorlog = '-'
+
+
+def when_ready(server):
+    """Compile the templates once in the preloaded master; forked workers inherit them."""
+    if not server.cfg.preload_app:
+        return
+    from app.templating import precompile
+    templates, seconds = precompile(server.app.wsgi())
+    server.log.info("Compiled %d templates in %.0f ms", templates, seconds * 1000)
+
+
+def post_fork(server, worker):
+    """Drop connections and threads inherited from the preloaded master."""
+    if not server.cfg.preload_app:
+        return
+    from app import db
+    from app.log import restart_logging
+    app = server.app.wsgi()
+    with app.app_context():
+        db.engine.dispose(close=False)
+    if app.shards is not None:
+        app.shards.dispose(close=False)
+    app.extensions.pop('elasticsearch', None)
+    restart_logging(app)
@@ -0,0 +1,43 @@
+"""post archive
+
+Revision ID: 1b8f2d4a6c37
+Revises: 0a7e3b5c9d14
+Create Date: 2026-10-19 18:40:16.382057
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '1b8f2d4a6c37'
+down_revision = '0a7e3b5c9d14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('post_archive_month',
+                    sa.Column('month', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('rows', sa.Integer(), server_default='0', nullable=False),
+                    sa.Column('archived_at', sa.DateTime(), nullable=True),
+                    sa.PrimaryKeyConstraint('month', name=op.f('pk_post_archive_month'))
+                    )
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id_timestamp', ['user_id', 'timestamp', 'id'], unique=False)
+
+    # monthly partitions are attached by `flask posts archive`; elsewhere they are separate
+    # tables behind a post_archive view that the same command maintains
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute("CREATE TABLE post_archive (id INTEGER NOT NULL, body VARCHAR(140), "
+                   "timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL, user_id INTEGER NOT NULL, language VARCHAR(5)) "
+                   "PARTITION BY RANGE (timestamp)")
+        op.execute("CREATE INDEX ix_post_archive_user_id_timestamp ON post_archive (user_id, timestamp, id)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == "postgresql":
+        op.execute("DROP TABLE post_archive")
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index('ix_post_user_id_timestamp')
+
+    op.drop_table('post_archive_month')
@@ -0,0 +1,27 @@
+"""shard directory
+
+Revision ID: 4c6e8a0b2d59
+Revises: 1b8f2d4a6c37
+Create Date: 2026-10-19 20:05:41.227913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '4c6e8a0b2d59'
+down_revision = '1b8f2d4a6c37'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('shard_bucket',
+                    sa.Column('bucket', sa.Integer(), autoincrement=False, nullable=False),
+                    sa.Column('shard', sa.Integer(), nullable=False),
+                    sa.PrimaryKeyConstraint('bucket', name=op.f('pk_shard_bucket'))
+                    )
+
+
+def downgrade():
+    op.drop_table('shard_bucket')
@@ -0,0 +1,29 @@
+"""api tokens
+
+Revision ID: 7e2b9c4d1f60
+Revises: 4c6e8a0b2d59
+Create Date: 2026-10-19 21:14:03.550129
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '7e2b9c4d1f60'
+down_revision = '4c6e8a0b2d59'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('token', sa.String(length=32), nullable=True))
+        batch_op.add_column(sa.Column('token_expiration', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_token'), ['token'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('user', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_token'))
+        batch_op.drop_column('token_expiration')
+        batch_op.drop_column('token')
@@ -0,0 +1,75 @@
+"""conversations
+
+Revision ID: e5a0c2d7b8f1
+Revises: d3b9f6a2e417
+Create Date: 2026-10-19 16:31:05.227640
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e5a0c2d7b8f1'
+down_revision = 'd3b9f6a2e417'
+branch_labels = None
+depends_on = None
+
+USER1 = "CASE WHEN m.sender_id < m.recipient_id THEN m.sender_id ELSE m.recipient_id END"
+USER2 = "CASE WHEN m.sender_id < m.recipient_id THEN m.recipient_id ELSE m.sender_id END"
+
+
+def upgrade():
+    op.create_table('conversation',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('user1_id', sa.Integer(), nullable=False),
+                    sa.Column('user2_id', sa.Integer(), nullable=False),
+                    sa.Column('last_message_id', sa.Integer(), nullable=True),
+                    sa.Column('last_message_at', sa.DateTime(), nullable=True),
+                    sa.Column('user1_unread', sa.Integer(), server_default='0', nullable=False),
+                    sa.Column('user2_unread', sa.Integer(), server_default='0', nullable=False),
+                    sa.ForeignKeyConstraint(['user1_id'], ['user.id'], name=op.f('fk_conversation_user1_id_user')),
+                    sa.ForeignKeyConstraint(['user2_id'], ['user.id'], name=op.f('fk_conversation_user2_id_user')),
+                    sa.PrimaryKeyConstraint('id', name=op.f('pk_conversation')),
+                    sa.UniqueConstraint('user1_id', 'user2_id', name=op.f('uq_conversation_user1_id'))
+                    )
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.create_index('ix_conversation_user1_id_last_message_at', ['user1_id', 'last_message_at', 'id'],
+                              unique=False)
+        batch_op.create_index('ix_conversation_user2_id_last_message_at', ['user2_id', 'last_message_at', 'id'],
+                              unique=False)
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('conversation_id', sa.Integer(), nullable=True))
+
+    # one conversation per pair of users that exchanged messages
+    op.execute(f"INSERT INTO conversation (user1_id, user2_id, last_message_id, last_message_at) "
+               f"SELECT {USER1}, {USER2}, MAX(m.id), MAX(m.timestamp) FROM message m GROUP BY {USER1}, {USER2}")
+    op.execute(f"UPDATE message SET conversation_id = (SELECT c.id FROM conversation c "
+               f"WHERE c.user1_id = {USER1.replace('m.', 'message.')} "
+               f"AND c.user2_id = {USER2.replace('m.', 'message.')})")
+    # unread is what arrived after the recipient last opened their messages
+    for side in ("user1", "user2"):
+        op.execute(f"UPDATE conversation SET {side}_unread = (SELECT count(*) FROM message m "
+                   f"JOIN \"user\" u ON u.id = m.recipient_id WHERE m.conversation_id = conversation.id "
+                   f"AND m.recipient_id = conversation.{side}_id "
+                   f"AND (u.last_message_read_time IS NULL OR m.timestamp > u.last_message_read_time))")
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.alter_column('conversation_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_foreign_key(batch_op.f('fk_message_conversation_id_conversation'), 'conversation',
+                                    ['conversation_id'], ['id'])
+        batch_op.create_index('ix_message_conversation_id_timestamp', ['conversation_id', 'timestamp', 'id'],
+                              unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_conversation_id_timestamp')
+        batch_op.drop_constraint(batch_op.f('fk_message_conversation_id_conversation'), type_='foreignkey')
+        batch_op.drop_column('conversation_id')
+
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_index('ix_conversation_user2_id_last_message_at')
+        batch_op.drop_index('ix_conversation_user1_id_last_message_at')
+
+    op.drop_table('conversation')
@@ -0,0 +1,33 @@
+"""notification upsert
+
+Revision ID: f19d4c6e2a83
+Revises: e5a0c2d7b8f1
+Create Date: 2026-10-19 17:05:48.610392
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'f19d4c6e2a83'
+down_revision = 'e5a0c2d7b8f1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep only the newest notification of each name per user before making the pair unique
+    op.execute("DELETE FROM notification WHERE id NOT IN "
+               "(SELECT id FROM (SELECT MAX(id) AS id FROM notification GROUP BY user_id, name) AS newest)")
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_unique_constraint(batch_op.f('uq_notification_user_id'), ['user_id', 'name'])
+        batch_op.create_index('ix_notification_user_id_timestamp', ['user_id', 'timestamp', 'name'], unique=False,
+                              postgresql_include=['payload_json'])
+        batch_op.drop_index(batch_op.f('ix_notification_user_id'))
+
+
+def downgrade():
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_notification_user_id'), ['user_id'], unique=False)
+        batch_op.drop_index('ix_notification_user_id_timestamp')
+        batch_op.drop_constraint(batch_op.f('uq_notification_user_id'), type_='unique')
@@ -1,8 +1,42 @@
+import gzip
+import json
+import logging
+import multiprocessing
 import os
+import queue
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
 from datetime import datetime, timezone, timedelta
+from hashlib import blake2b
 import unittest
+from flask import g, render_template, url_for
 from app import create_app, db
-from app.models import User, Post
+from app.cache import LRUCache, FragmentCache, QueryCache
+from app.log import DroppingQueueHandler, JsonFormatter
+from app.outbound import CircuitBreaker, Upstream, UpstreamError
+from app.passwords import PasswordHasher, PasswordHasherBusy
+from app.ratelimit import RateLimiter, MemoryWindows, SharedWindows
+from app.startup import profile_startup
+from app.templating import precompile
+from app.suggestions import refresh
+from app.timeline import home_timeline, rebuild
+from app.trending import CountMinSketch, TopK, tokenize
+from app.models import User, Post, Message, Conversation, Notification, followers, job as job_table, shard_bucket, \
+    timeline
+from app.notifications import compact
+from app.graph import FollowGraph, load_all
+from app.importer import import_posts, import_follows, read_edges
+from app.archive import ArchivedPost, archive, hot_window_start, post_archive, user_posts
+from app.export import export_rows
+from app.shards import plan, rebalance
+from app.jobs import job, work, queue_stats
+from app.pagination import encode_cursor
+from app.tasks import archive_posts, detect_post_language, refresh_hot_ranking
+from sqlalchemy import select, insert, update, func, text, event
+from werkzeug.security import generate_password_hash
 
 from config import Config
 
@@ -10,6 +44,11 @@ from config import Config
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    TRENDING_FLUSH_INTERVAL = 0
+    HOT_REFRESH_INTERVAL = 0
+    TEMPLATE_CACHE_DIR = None
+    JOBS_EAGER = True
+    PASSWORD_HASH_WORKERS = 0
 
 
 class UserModelCase(unittest.TestCase):
@@ -29,6 +68,23 @@ class UserModelCase(unittest.TestCase):
         u.set_password("cat")
         self.assertFalse(u.check_password("dog"))
         self.assertTrue(u.check_password("cat"))
+        self.assertFalse(u.password_needs_rehash())
+
+    def test_rehash_on_login(self):
+        u = User(username="susan", email="susan@aol.com")
+        u.password_hash = generate_password_hash("cat", "pbkdf2:sha256:1000")
+        db.session.add(u)
+        db.session.commit()
+        self.assertTrue(u.password_needs_rehash())
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        client = self.app.test_client()
+        response = client.post("/auth/login", data={"username": "susan", "password": "dog"})
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:1000$"))
+        response = client.post("/auth/login", data={"username": "susan", "password": "cat"})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(u.password_hash.startswith("scrypt:32768:8:1$"))
+        self.assertFalse(u.password_needs_rehash())
+        self.assertTrue(u.check_password("cat"))
 
     def test_avatar(self):
         u = User(username="john", email="john@example.com")
@@ -100,5 +156,1388 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class TimelineCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(type("TimelineConfig", (TestConfig,), {"TIMELINE_HEAVY_THRESHOLD": 2}))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_hybrid_matches_pull(self):
+        users = [User(username=name, email=name + "@example.com") for name in ("john", "susan", "mary", "david")]
+        db.session.add_all(users)
+        db.session.commit()
+        john, susan, mary, david = users
+        john.follow(susan)
+        john.follow(mary)
+        susan.follow(mary)
+        david.follow(susan)
+        db.session.commit()
+        self.assertEqual(susan.follower_count, 2)
+        self.assertEqual(mary.follower_count, 2)
+
+        now = datetime.now(timezone.utc)
+        for i in range(12):
+            db.session.add(Post(body="post %d" % i, author=users[i % 4], timestamp=now + timedelta(seconds=i)))
+        db.session.commit()
+        john.follow(david)
+        db.session.commit()
+
+        for user in users:
+            expected = db.session.scalars(user.following_posts()).all()
+            feed = []
+            page = 1
+            while True:
+                posts, has_next = home_timeline(user, page, 5)
+                feed.extend(posts)
+                if not has_next:
+                    break
+                page += 1
+            self.assertEqual(feed, expected)
+
+        john.unfollow(david)
+        db.session.commit()
+        posts, has_next = home_timeline(john, 1, 20)
+        self.assertNotIn(david, [post.author for post in posts])
+        self.assertEqual(posts, db.session.scalars(john.following_posts()).all())
+
+        rebuild()
+        for user in users:
+            posts, has_next = home_timeline(user, 1, 20)
+            self.assertEqual(posts, db.session.scalars(user.following_posts()).all())
+
+        susan.unfollow(mary)
+        db.session.commit()
+        self.assertEqual(mary.follower_count, 1)
+        pushed = db.session.scalars(select(timeline.c.post_id).where(timeline.c.user_id == john.id,
+                                                                     timeline.c.author_id == mary.id)).all()
+        self.assertEqual(sorted(pushed), sorted(post.id for post in db.session.scalars(mary.posts.select())))
+
+
+class FollowGraphCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username="user%d" % i, email="user%d@example.com" % i) for i in range(4)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_follow_updates_cached_entry(self):
+        u0, u1, u2, u3 = self.users
+        u0.follow(u2)
+        db.session.commit()
+        self.assertTrue(u0.is_following(u2))
+        self.assertEqual(list(self.app.follow_graph.followees(u0)), [u2.id])
+        u0.follow(u1)
+        u0.follow(u3)
+        db.session.commit()
+        self.assertEqual(list(self.app.follow_graph.entries.get(u0.id)[1]), [u1.id, u2.id, u3.id])
+        self.assertEqual(self.app.follow_graph.entries.get(u0.id)[0], u0.version)
+        u0.unfollow(u2)
+        db.session.commit()
+        self.assertFalse(u0.is_following(u2))
+        self.assertEqual(u0.followed_ids(), [u1.id, u3.id])
+
+    def test_change_from_other_process_reloads(self):
+        u0, u1 = self.users[:2]
+        self.assertFalse(u0.is_following(u1))
+        db.session.execute(followers.insert().values(follower_id=u0.id, followed_id=u1.id))
+        db.session.execute(update(User).where(User.id == u0.id).values(version=User.version + 1))
+        db.session.commit()
+        self.assertTrue(u0.is_following(u1))
+
+    def test_stats(self):
+        u0, u1, u2, u3 = self.users
+        u0.follow(u1)
+        u0.follow(u2)
+        u1.follow(u2)
+        db.session.commit()
+        report = load_all(FollowGraph(10)).stats()
+        self.assertEqual(report["users"], 2)
+        self.assertEqual(report["edges"], 3)
+        self.assertGreater(report["bytes_per_million_edges"], 0)
+
+
+class SuggestionsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username="user%d" % i, email="user%d@example.com" % i) for i in range(6)]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def follow(self, *edges):
+        for a, b in edges:
+            self.users[a].follow(self.users[b])
+        db.session.commit()
+
+    def test_friends_of_friends(self):
+        u = self.users
+        self.follow((0, 1), (0, 2), (1, 3), (2, 3), (2, 4), (1, 0), (2, 1))
+        report = refresh(top=5)
+        self.assertEqual(report["users"], 6)
+        self.assertEqual(u[0].follow_suggestions(), [u[3], u[4]])
+        self.assertEqual(u[1].follow_suggestions(), [u[2]])
+        self.assertEqual(u[5].follow_suggestions(), [])
+
+    def test_incremental_refresh(self):
+        u = self.users
+        self.follow((0, 1), (1, 2))
+        refresh()
+        self.assertEqual(u[0].follow_suggestions(), [u[2]])
+        self.follow((1, 3), (4, 1))
+        report = refresh(only_changed=True)
+        self.assertEqual(report["users"], 3)
+        self.assertEqual(u[0].follow_suggestions(), [u[2]])
+        self.assertEqual(u[4].follow_suggestions(), [u[2], u[3]])
+        self.assertEqual(refresh(only_changed=True)["users"], 0)
+
+
+class TrendingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="susan", email="susan@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize("The #Flask release is out, flask rocks"), ["#flask", "release", "flask", "rocks"])
+
+    def test_sketch_and_top_k(self):
+        sketch = CountMinSketch(64, 4)
+        top = TopK(2)
+        for term in ["a"] * 5 + ["b"] * 3 + ["c"] * 4 + ["d"]:
+            top.offer(term, sketch.add(term))
+        self.assertGreaterEqual(sketch.estimate("a"), 5)
+        self.assertEqual(top.items(), [("a", 5), ("c", 4)])
+
+    def test_posts_feed_trending(self):
+        tracker = self.app.trending
+        for body in ["flask is great", "#python and flask", "python flask"]:
+            db.session.add(Post(body=body, author=self.user))
+            db.session.commit()
+        tracker.flush(now=1000)
+        self.assertEqual(tracker.snapshot[0], {"term": "flask", "count": 3})
+        db.session.add(Post(body="python", author=self.user))
+        db.session.commit()
+        tracker.flush(now=1100)
+        self.assertEqual(tracker.snapshot[:2], [{"term": "flask", "count": 3}, {"term": "python", "count": 2}])
+        tracker.flush(now=1000 + self.app.config["TRENDING_WINDOW"] + 1)
+        self.assertEqual(tracker.snapshot, [{"term": "python", "count": 1}])
+
+    def test_trending_endpoint(self):
+        db.session.add(Post(body="#release day", author=self.user))
+        db.session.commit()
+        self.app.trending.flush()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(self.user.id)
+            session["_fresh"] = True
+        self.assertEqual(client.get("/trending").get_json()[0], {"term": "#release", "count": 1})
+        self.assertIn(b"Trending now", client.get("/explore").data)
+
+
+class HotRankingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(type("HotConfig", (TestConfig,), {"HOT_SIZE": 3, "HOT_DECAY": 3600}))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.popular = User(username="popular", email="popular@example.com", follower_count=999)
+        self.quiet = User(username="quiet", email="quiet@example.com")
+        db.session.add_all([self.popular, self.quiet])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_post(self, body, author, hours_ago):
+        post = Post(body=body, author=author, timestamp=datetime.now(timezone.utc) - timedelta(hours=hours_ago))
+        db.session.add(post)
+        db.session.commit()
+        return post
+
+    def test_falls_back_to_chronological(self):
+        self.assertIsNone(self.app.hot_ranking.page(1, 10))
+
+    def test_ranking_is_incremental_and_bounded(self):
+        ranking = self.app.hot_ranking
+        old_popular = self.add_post("old but popular", self.popular, 2)
+        quiet = self.add_post("quiet", self.quiet, 1)
+        self.assertEqual(ranking.refresh(), 2)
+        self.assertEqual(ranking.current(), [old_popular.id, quiet.id])
+        newest = self.add_post("newest", self.quiet, 0)
+        older = self.add_post("older", self.quiet, 5)
+        self.assertEqual(ranking.refresh(), 2)
+        self.assertEqual(ranking.current(), [old_popular.id, newest.id, quiet.id])
+        posts, has_next = ranking.page(1, 2)
+        self.assertEqual(posts, [old_popular, newest])
+        self.assertTrue(has_next)
+        self.assertEqual(ranking.page(2, 2), ([quiet], False))
+        db.session.delete(newest)
+        db.session.commit()
+        self.assertEqual(ranking.page(1, 3)[0], [old_popular, quiet])
+
+    def test_explore_continues_with_unranked_posts(self):
+        for i, (author, hours_ago) in enumerate([(self.popular, 2), (self.quiet, 1), (self.quiet, 0),
+                                                 (self.quiet, 1.5), (self.quiet, 5), (self.quiet, 6)]):
+            self.add_post("post %d" % i, author, hours_ago)
+        refresh_hot_ranking()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(self.quiet.id)
+            session["_fresh"] = True
+
+        def bodies(response):
+            return [body for body in ("post %d" % i for i in range(6)) if body.encode() in response.data]
+
+        response = client.get("/explore")
+        self.assertEqual(bodies(response), ["post 0", "post 1", "post 2"])
+        with self.app.test_request_context():
+            unranked = url_for("main.explore", unranked=1)
+        self.assertIn(unranked.encode(), response.data)
+        self.assertEqual(client.get("/explore?page=4").headers["Location"], unranked)
+        # post 3 is newer than the oldest ranked post but did not make the ranking
+        self.assertEqual(bodies(client.get(unranked)), ["post 3", "post 4", "post 5"])
+
+
+class ArchiveCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        db.session.add(self.john)
+        # two posts in each of January to April 2024
+        db.session.add_all([Post(body="post %d" % i, author=self.john,
+                                 timestamp=datetime(2024, 1 + i // 2, 10 + i % 2)) for i in range(8)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        for table in db.session.execute(text(
+                "SELECT type, name FROM sqlite_master WHERE name LIKE 'post_archive%'")).all():
+            db.session.execute(text("DROP {} IF EXISTS {}".format(*table)))
+        db.session.commit()
+        self.app_context.pop()
+
+    def test_hot_window_start(self):
+        self.assertEqual(hot_window_start(datetime(2024, 8, 15)), datetime(2024, 2, 1))
+        self.assertEqual(hot_window_start(datetime(2024, 3, 1)), datetime(2023, 9, 1))
+
+    def test_archive_moves_old_months(self):
+        self.assertEqual(archive(datetime(2024, 3, 20), batch_size=1), {202401: 2, 202402: 2})
+        self.assertEqual(archive(datetime(2024, 3, 20)), {})
+        self.assertEqual(db.session.scalars(select(Post.body).order_by(Post.timestamp)).all(),
+                         ["post 4", "post 5", "post 6", "post 7"])
+        self.assertEqual(db.session.scalar(select(func.count()).select_from(post_archive)), 4)
+
+    def test_user_posts_page_into_archive(self):
+        archive(datetime(2024, 3, 1))
+        pages, before = [], None
+        while True:
+            posts, has_next = user_posts(self.john, before, limit=3)
+            pages.append([post.body for post in posts])
+            if not has_next:
+                break
+            before = (posts[-1].timestamp, posts[-1].id)
+        self.assertEqual(pages, [["post 7", "post 6", "post 5"], ["post 4", "post 3", "post 2"],
+                                 ["post 1", "post 0"]])
+        self.assertIsInstance(user_posts(self.john, before)[0][0], ArchivedPost)
+
+    def test_export_includes_archive(self):
+        archive(datetime(2024, 2, 1))
+        rows = list(export_rows(self.john))
+        self.assertEqual([row["body"] for row in rows], ["post %d" % i for i in range(8)])
+        self.assertEqual(rows[1]["cursor"].split(",")[0], "archive")
+        self.assertEqual([row["body"] for row in export_rows(self.john, rows[0]["cursor"])],
+                         ["post %d" % i for i in range(1, 8)])
+        self.assertEqual([row["body"] for row in export_rows(self.john, rows[2]["cursor"])],
+                         ["post %d" % i for i in range(3, 8)])
+
+
+class ExportCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        self.susan = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.john, self.susan])
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body="post %d" % i, author=self.john, timestamp=now + timedelta(seconds=i))
+                            for i in range(3)])
+        db.session.flush()
+        conversation = Conversation.between(self.john, self.susan)
+        conversation.add_message(Message(body="hi susan", author=self.john, recipient=self.susan, timestamp=now))
+        conversation.add_message(Message(body="hi john", author=self.susan, recipient=self.john, timestamp=now))
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(self.john.id)
+            session["_fresh"] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_ndjson_export_resumes_from_cursor(self):
+        response = self.client.get("/user/john/export")
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual([(row["type"], row["body"]) for row in rows],
+                         [("post", "post 0"), ("post", "post 1"), ("post", "post 2"),
+                          ("message", "hi susan"), ("message", "hi john")])
+        self.assertEqual((rows[4]["sender"], rows[4]["recipient"]), ("susan", "john"))
+        for i in (1, 2, 3):
+            resumed = self.client.get("/user/john/export", query_string={"after": rows[i]["cursor"]})
+            self.assertEqual([json.loads(line) for line in resumed.data.decode().splitlines()], rows[i + 1:])
+        self.assertEqual(self.client.get("/user/john/export?after=nonsense").status_code, 400)
+
+    def test_gzipped_csv_export(self):
+        response = self.client.get("/user/john/export?format=csv&gzip=1")
+        self.assertEqual(response.mimetype, "application/gzip")
+        self.assertIn("john.csv.gz", response.headers["Content-Disposition"])
+        lines = gzip.decompress(response.data).decode().splitlines()
+        self.assertEqual(lines[0], "type,id,timestamp,sender,recipient,language,body,cursor")
+        self.assertEqual(len(lines), 6)
+
+    def test_only_own_export(self):
+        self.assertEqual(self.client.get("/user/susan/export").status_code, 403)
+
+
+class ConversationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(type("ConversationConfig", (TestConfig,), {"MESSAGES_PER_PAGE": 2}))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [User(username=name, email=name + "@example.com") for name in ("john", "susan", "mary")]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def send(self, sender, recipient, body, minutes):
+        conversation = Conversation.between(sender, recipient)
+        message = Message(author=sender, recipient=recipient, body=body,
+                          timestamp=datetime(2024, 1, 1) + timedelta(minutes=minutes))
+        conversation.add_message(message)
+        db.session.commit()
+        return message
+
+    def test_inbox_and_thread(self):
+        john, susan, mary = self.users
+        self.send(john, susan, "hi susan", 1)
+        self.send(susan, john, "hi john", 2)
+        self.send(mary, john, "hello", 3)
+        last = self.send(john, susan, "how are you?", 4)
+        self.assertIs(Conversation.between(susan, john), Conversation.between(john, susan))
+        self.assertEqual(db.session.scalar(select(func.count()).select_from(Conversation)), 2)
+        self.assertEqual(susan.unread_message_count(), 2)
+        self.assertEqual(john.unread_message_count(), 2)
+
+        conversations, has_next = john.inbox(limit=1)
+        self.assertEqual([c.other(john) for c in conversations], [susan])
+        self.assertTrue(has_next)
+        cursor = (conversations[0].last_message_at, conversations[0].id)
+        self.assertEqual([c.other(john) for c in john.inbox(before=cursor, limit=1)[0]], [mary])
+        self.assertEqual([(c.other(mary), c.unread(mary)) for c in mary.inbox()[0]], [(john, 0)])
+        self.send(mary, mary, "note to self", 5)
+        self.assertEqual([c.other(mary) for c in mary.inbox()[0]], [mary, john])
+
+        conversation = Conversation.between(john, susan)
+        messages, has_next = conversation.thread(limit=2)
+        self.assertEqual([m.body for m in messages], ["how are you?", "hi john"])
+        self.assertTrue(has_next)
+        older, has_next = conversation.thread(before=(messages[-1].timestamp, messages[-1].id), limit=2)
+        self.assertEqual([m.body for m in older], ["hi susan"])
+        self.assertFalse(has_next)
+        self.assertEqual(conversation.last_message_id, last.id)
+
+    def test_reading_a_thread_clears_unread(self):
+        john, susan, mary = self.users
+        for i in range(3):
+            self.send(susan, john, "message %d" % i, i)
+        self.send(mary, john, "hello", 5)
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(john.id)
+            session["_fresh"] = True
+        inbox = client.get("/messages").data
+        self.assertLess(inbox.index(b"mary"), inbox.index(b"susan"))
+        page = client.get("/messages/susan")
+        self.assertIn(b"message 2", page.data)
+        self.assertNotIn(b"message 0", page.data)
+        self.assertIn(b"before=", page.data)
+        self.assertEqual(john.unread_message_count(), 1)
+        self.assertEqual(client.get("/messages/susan?before=bad").status_code, 400)
+        self.assertEqual(client.get("/messages/mary").status_code, 200)
+        self.assertEqual(client.get("/messages/john").status_code, 200)
+        self.assertEqual(john.unread_message_count(), 0)
+
+
+class ApiCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        self.susan = User(username="susan", email="susan@example.com")
+        self.john.set_password("cat")
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def token(self):
+        response = self.client.post("/api/v1/tokens", auth=("john", "cat"))
+        self.assertEqual(response.status_code, 200)
+        return {"Authorization": "Bearer " + response.json["token"]}
+
+    def test_token_auth(self):
+        self.assertEqual(self.client.post("/api/v1/tokens", auth=("john", "dog")).status_code, 401)
+        response = self.client.get("/api/v1/timeline")
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.headers["WWW-Authenticate"], "Bearer")
+        headers = self.token()
+        self.assertEqual(self.token(), headers)
+        self.assertEqual(self.client.get("/api/v1/users/susan", headers=headers).json["username"], "susan")
+        self.assertNotIn("Set-Cookie", self.client.get("/api/v1/timeline", headers=headers).headers)
+        self.assertEqual(self.client.get("/api/v1/users/nobody", headers=headers).json["error"], "Not Found")
+        self.assertEqual(self.client.delete("/api/v1/tokens", headers=headers).status_code, 204)
+        self.assertEqual(self.client.get("/api/v1/timeline", headers=headers).status_code, 401)
+
+    def test_timeline_pages_and_fields(self):
+        self.john.follow(self.susan)
+        now = datetime(2024, 1, 1)
+        db.session.add_all([Post(body="post %d" % i, author=self.susan if i % 2 else self.john,
+                                 timestamp=now + timedelta(minutes=i)) for i in range(5)])
+        db.session.commit()
+        headers = self.token()
+        page = self.client.get("/api/v1/timeline?limit=3", headers=headers).json
+        self.assertEqual([post["body"] for post in page["items"]], ["post 4", "post 3", "post 2"])
+        self.assertEqual(page["items"][1]["author"]["username"], "susan")
+        self.assertEqual(page["items"][0]["timestamp"], "2024-01-01T00:04:00+00:00")
+        page = self.client.get("/api/v1/timeline", query_string={"before": page["next"], "limit": 3,
+                                                                 "fields": "id,body,author.username"},
+                               headers=headers).json
+        self.assertEqual(page["items"][0], {"id": page["items"][0]["id"], "body": "post 1",
+                                            "author": {"username": "susan"}})
+        self.assertIsNone(page["next"])
+        self.assertEqual(self.client.get("/api/v1/timeline?fields=author", headers=headers).json["items"][0],
+                         {"author": {"id": self.john.id, "username": "john", "avatar": self.john.avatar(36)}})
+        self.assertEqual(self.client.get("/api/v1/timeline?fields=password", headers=headers).status_code, 400)
+        self.assertEqual(self.client.get("/api/v1/timeline?before=bad", headers=headers).status_code, 400)
+        posts = self.client.get("/api/v1/users/susan/posts?fields=body", headers=headers).json
+        self.assertEqual(posts["items"], [{"body": "post 3"}, {"body": "post 1"}])
+        explore = self.client.get("/api/v1/explore?limit=4&fields=body", headers=headers).json
+        self.assertEqual(len(explore["items"]), 4)
+        self.assertIsNotNone(explore["next"])
+
+    def test_messages(self):
+        conversation = Conversation.between(self.susan, self.john)
+        conversation.add_message(Message(author=self.susan, recipient=self.john, body="hi john"))
+        db.session.commit()
+        headers = self.token()
+        inbox = self.client.get("/api/v1/messages", headers=headers).json["items"]
+        self.assertEqual((inbox[0]["user"]["username"], inbox[0]["unread"], inbox[0]["last_message"]["body"]),
+                         ("susan", 1, "hi john"))
+        thread = self.client.get("/api/v1/messages/susan?fields=body,sender.username", headers=headers).json
+        self.assertEqual(thread, {"items": [{"body": "hi john", "sender": {"username": "susan"}}], "next": None})
+        self.assertEqual(self.john.unread_message_count(), 0)
+
+    def test_inbox_queries_do_not_grow_with_conversations(self):
+        headers = self.token()
+
+        def inbox_statements():
+            statements = []
+            listener = lambda *args: statements.append(args[2])
+            event.listen(db.engine, "before_cursor_execute", listener)
+            try:
+                items = self.client.get("/api/v1/messages", headers=headers).json["items"]
+            finally:
+                event.remove(db.engine, "before_cursor_execute", listener)
+            return len(items), len(statements)
+
+        senders = [User(username="sender%d" % i, email="sender%d@example.com" % i) for i in range(3)]
+        db.session.add_all(senders)
+        db.session.commit()
+        Conversation.between(senders[0], self.john).add_message(Message(author=senders[0], recipient=self.john,
+                                                                        body="hi"))
+        db.session.commit()
+        conversations, statements = inbox_statements()
+        for sender in senders[1:]:
+            Conversation.between(sender, self.john).add_message(Message(author=sender, recipient=self.john,
+                                                                        body="hi"))
+        db.session.commit()
+        self.assertEqual(inbox_statements(), (conversations + 2, statements))
+
+    def test_batch_follow(self):
+        headers = self.token()
+        response = self.client.post("/api/v1/follows", json={"usernames": ["susan", "john", "nobody"]},
+                                    headers=headers)
+        self.assertEqual(response.json, {"followed": 1, "unknown": ["nobody"]})
+        self.assertTrue(self.john.is_following(self.susan))
+        self.assertEqual(self.susan.follower_count, 1)
+        response = self.client.post("/api/v1/follows", json={"usernames": "susan"}, headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+
+class NotificationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_add_notification_upserts(self):
+        self.user.add_notification("unread_message_count", 1)
+        self.user.add_notification("unread_message_count", 2)
+        self.user.add_notification("task_progress", {"done": 50})
+        db.session.commit()
+        rows = db.session.execute(select(Notification.name, Notification.payload_json)
+                                  .order_by(Notification.name)).all()
+        self.assertEqual(rows, [("task_progress", '{"done": 50}'), ("unread_message_count", "2")])
+
+    def test_compact_deletes_expired_in_batches(self):
+        db.session.add_all([Notification(name="n%d" % i, user=self.user, payload_json="0", timestamp=time.time() - i)
+                            for i in range(10)])
+        db.session.commit()
+        self.assertEqual(compact(ttl=4.5, batch_size=2, pause=0), 5)
+        self.assertEqual(db.session.scalars(select(Notification.name).order_by(Notification.name)).all(),
+                         ["n0", "n1", "n2", "n3", "n4"])
+
+
+calls = []
+
+
+@job(max_attempts=2, backoff=60)
+def record_call(value):
+    calls.append(value)
+    if value == "fail":
+        raise ValueError(value)
+
+
+@job(every=60)
+def periodic_call():
+    calls.append("periodic")
+
+
+class JobQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(type("QueueConfig", (TestConfig,), {"JOBS_EAGER": False}))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        calls.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def status(self, id):
+        return db.session.execute(select(job_table.c.status, job_table.c.attempts, job_table.c.run_at)
+                                  .where(job_table.c.id == id)).one()
+
+    def test_jobs_run_after_commit(self):
+        id = record_call.delay("hello")
+        db.session.commit()
+        self.assertEqual(self.status(id).status, "queued")
+        work(burst=True)
+        self.assertIn("hello", calls)
+        self.assertEqual(self.status(id).status, "done")
+        self.assertEqual(queue_stats()["queued"], 0)
+
+    def test_failed_jobs_are_retried_with_backoff(self):
+        id = record_call.delay("fail")
+        db.session.commit()
+        with self.assertLogs(self.app.logger, "ERROR"):
+            work(burst=True)
+        status, attempts, run_at = self.status(id)
+        self.assertEqual((status, attempts), ("queued", 1))
+        self.assertGreater(run_at, datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=50))
+        self.assertEqual(queue_stats()["due"], 0)
+        db.session.execute(update(job_table).values(run_at=datetime(2000, 1, 1)))
+        db.session.commit()
+        self.assertEqual(queue_stats()["due"], 1)
+        with self.assertLogs(self.app.logger, "ERROR"):
+            work(burst=True)
+        self.assertEqual(self.status(id)[:2], ("failed", 2))
+        self.assertEqual(calls.count("fail"), 2)
+
+    def test_periodic_jobs_run_once_per_period(self):
+        work(burst=True)
+        work(burst=True)
+        self.assertEqual(calls.count("periodic"), 1)
+
+    def test_post_language_is_detected_by_the_worker(self):
+        user = User(username="john", email="john@example.com")
+        db.session.add(user)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(user.id)
+            session["_fresh"] = True
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        client.post("/index", data={"post": "Hola amigos, ¿cómo están ustedes hoy?"})
+        post = db.session.scalar(select(Post))
+        self.assertIsNone(post.language)
+        work(burst=True)
+        db.session.refresh(post)
+        self.assertEqual(post.language, "es")
+
+    def test_only_indexed_fields_are_reindexed(self):
+        self.app.config["ELASTICSEARCH_URL"] = "http://localhost:9200"
+        index_jobs = select(func.count()).select_from(job_table).where(job_table.c.name == "app.tasks.index_object")
+        post = Post(body="Hola amigos, ¿cómo están ustedes hoy?", author=User(username="john", email="j@example.com"))
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(db.session.scalar(index_jobs), 1)
+        detect_post_language(post.id)
+        db.session.commit()
+        self.assertEqual(post.language, "es")
+        self.assertEqual(db.session.scalar(index_jobs), 1)
+        post.body = "Hello everybody"
+        db.session.commit()
+        self.assertEqual(db.session.scalar(index_jobs), 2)
+
+
+class ShardCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        urls = ["sqlite:///" + os.path.join(self.directory.name, "shard%d.db" % i) for i in range(2)]
+        config = type("ShardConfig", (TestConfig,), {"SHARD_DATABASE_URLS": urls, "SHARD_BUCKETS": 4,
+                                                     "SHARD_ID_RANGE": 1000, "SHARD_DIRECTORY_TTL": 0})
+        self.app = create_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.router = self.app.shards
+        self.router.create_all()
+        # ids 1 to 4 fall in buckets 1, 2, 3 and 0
+        self.users = [User(username=name, email=name + "@example.com") for name in ("john", "susan", "mary", "david")]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.router.dispose()
+        self.app_context.pop()
+        self.directory.cleanup()
+
+    def rows(self, shard, table="post"):
+        with self.router.engine(shard).connect() as connection:
+            return connection.execute(text("SELECT id, body FROM %s ORDER BY id" % table)).all()
+
+    def test_writes_go_to_the_owning_shard(self):
+        john, susan = self.users[:2]
+        now = datetime.now(timezone.utc)
+        db.session.add_all([Post(body="john %d" % i, author=john, timestamp=now + timedelta(seconds=i))
+                            for i in range(2)] + [Post(body="susan", author=susan, timestamp=now)])
+        Conversation.between(john, susan).add_message(Message(body="hi", author=susan, recipient=john))
+        db.session.commit()
+        self.assertEqual(db.session.scalar(select(func.count(Post.id))), 0)
+        self.assertEqual(self.rows(0), [(1, "susan")])
+        self.assertEqual(self.rows(1), [(1001, "john 0"), (1002, "john 1")])
+        self.assertEqual(self.rows(1, "message"), [(1001, "hi")])
+        posts, has_next = user_posts(john)
+        self.assertEqual([post.body for post in posts], ["john 1", "john 0"])
+        self.assertEqual([m.body for m in Conversation.between(john, susan).thread()[0]], ["hi"])
+        self.assertEqual(Post.from_ids([1002, 1]), [posts[0], db.session.get(Post, 1)])
+
+    def test_init_copies_primary_rows(self):
+        john, susan, mary = self.users[:3]
+        with db.engine.begin() as connection:
+            connection.execute(insert(Post), [{"body": user.username, "user_id": user.id,
+                                               "timestamp": datetime(2024, 1, 1)} for user in (john, susan, mary)])
+        self.assertEqual(self.router.create_all(), 3)
+        self.assertEqual(self.rows(0), [(2, "susan")])
+        self.assertEqual(self.rows(1), [(1, "john"), (3, "mary")])
+        self.assertEqual([post.body for post in user_posts(john)[0]], ["john"])
+        self.assertEqual(self.router.create_all(), 0)
+        # new posts on shard 0 must not reuse the ids copied to shard 1
+        db.session.add_all([Post(body="susan again", author=susan), Post(body="john again", author=john)])
+        db.session.commit()
+        self.assertEqual(self.rows(0), [(2, "susan"), (4, "susan again")])
+        self.assertEqual(self.rows(1), [(1, "john"), (3, "mary"), (1001, "john again")])
+        self.assertEqual([post.body for post in Post.from_ids([3, 4])], ["mary", "susan again"])
+        archive_posts()
+        self.assertEqual(db.session.scalar(select(func.count()).select_from(Post.__table__)), 3)
+
+    def test_feed_merges_shards(self):
+        now = datetime.now(timezone.utc)
+        for i, author in enumerate(self.users * 2):
+            db.session.add(Post(body="post %d" % i, author=author, timestamp=now + timedelta(seconds=i)))
+        self.users[0].follow(self.users[1])
+        db.session.commit()
+        posts, has_next = home_timeline(self.users[0], 1, 3)
+        self.assertEqual([post.body for post in posts], ["post 5", "post 4", "post 1"])
+        self.assertTrue(has_next)
+        posts, has_next = self.router.feed(None, 2, 3)
+        self.assertEqual([post.body for post in posts], ["post 4", "post 3", "post 2"])
+        self.assertTrue(has_next)
+
+    def test_rebalance_moves_buckets(self):
+        db.session.execute(update(shard_bucket).values(shard=0))
+        db.session.commit()
+        db.session.add_all([Post(body=user.username, user_id=user.id) for user in self.users])
+        db.session.commit()
+        self.assertEqual(len(self.rows(0)), 4)
+        self.router.load()
+        self.assertEqual(plan(self.router.directory, 2, 4), [(3, 0, 1), (2, 0, 1)])
+        rebalance(wait=0)
+        self.assertEqual(self.rows(0), [(1, "john"), (4, "david")])
+        self.assertEqual(self.rows(1), [(2, "susan"), (3, "mary")])
+        self.assertEqual([post.body for post in user_posts(self.users[2])[0]], ["mary"])
+        self.assertEqual(rebalance(wait=0), [])
+
+
+class ImportCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        self.susan = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.susan.follow(self.john)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_import_posts(self):
+        lines = [
+            json.dumps({"username": "john", "body": "first", "timestamp": "2020-01-01T10:00:00", "language": "en"}),
+            json.dumps({"type": "post", "sender": "susan", "body": "second", "language": "en"}),
+            json.dumps({"type": "message", "sender": "susan", "recipient": "john", "body": "not a post"}),
+            json.dumps({"username": "nobody", "body": "unknown author"}),
+            json.dumps({"username": "john", "body": "x" * 141}),
+            "not json",
+            "",
+            json.dumps({"username": "john", "body": "third", "language": "es"}),
+        ]
+        batches = []
+        stats = import_posts(lines, batch_size=2, detect=False, progress=batches.append)
+        self.assertEqual((stats["rows"], stats["imported"], stats["skipped"]), (6, 3, 3))
+        self.assertEqual(len(batches), 3)
+        posts = db.session.scalars(select(Post).order_by(Post.id)).all()
+        self.assertEqual([(p.author, p.body, p.language) for p in posts],
+                         [(self.john, "first", "en"), (self.susan, "second", "en"), (self.john, "third", "es")])
+        self.assertEqual(posts[0].timestamp, datetime(2020, 1, 1, 10))
+        feed, has_next = home_timeline(self.susan, 1, 10)
+        self.assertEqual(feed, [posts[2], posts[1], posts[0]])
+        import_posts([json.dumps({"username": "john", "body": "fourth", "language": "en"})], detect=False)
+        feed, has_next = home_timeline(self.susan, 1, 10)
+        self.assertEqual(len(feed), 4)
+
+    def test_import_pushes_at_most_the_backfill(self):
+        self.app.config["TIMELINE_BACKFILL"] = 2
+        import_posts([json.dumps({"username": "john", "body": "post %d" % i, "language": "en",
+                                  "timestamp": "2020-01-0%dT10:00:00" % (i + 1)}) for i in range(5)], detect=False)
+        pushed = db.session.scalars(select(timeline.c.timestamp).where(timeline.c.user_id == self.susan.id)
+                                    .order_by(timeline.c.timestamp)).all()
+        self.assertEqual(pushed, [datetime(2020, 1, 4, 10), datetime(2020, 1, 5, 10)])
+
+    def test_import_follows(self):
+        mary = User(username="mary", email="mary@example.com")
+        db.session.add(mary)
+        db.session.add_all([Post(body="john %d" % i, author=self.john) for i in range(3)] +
+                           [Post(body="mary", author=mary)])
+        db.session.commit()
+        version = self.john.version
+        lines = ["# follower followed", "john susan", "john,mary", "susan john", "mary john", "mary mary",
+                 "mary nobody", "one two three", "", "mary susan"]
+        stats = import_follows(read_edges(lines), batch_size=3)
+        self.assertEqual((stats["rows"], stats["followed"], stats["existing"], stats["skipped"]), (8, 4, 1, 3))
+        self.assertEqual(sorted(self.john.followed_ids()), [self.susan.id, mary.id])
+        self.assertEqual([u.follower_count for u in (self.john, self.susan, mary)], [2, 2, 1])
+        # bumped once per batch that touched john, not once per follow
+        self.assertEqual(self.john.version, version + 2)
+        self.assertEqual([p.body for p in home_timeline(mary, 1, 10)[0]], ["mary", "john 2", "john 1", "john 0"])
+        self.assertEqual([p.body for p in home_timeline(self.john, 1, 10)[0]], ["mary", "john 2", "john 1", "john 0"])
+        stats = import_follows(read_edges(["john", "susan"], follower="mary"))
+        self.assertEqual((stats["followed"], stats["existing"]), (0, 2))
+        self.assertEqual(mary.follower_count, 1)
+
+
+class QueryCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.john = User(username="john", email="john@example.com")
+        self.susan = User(username="susan", email="susan@example.com")
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.cache = self.app.query_cache
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def about(self, username, ttl=60):
+        query = select(User.about_me).where(User.username == username).execution_options(query_cache=ttl)
+        return db.session.scalar(query)
+
+    def test_commit_invalidates_tables_read(self):
+        self.assertIsNone(self.about("john"))
+        self.assertIsNone(self.about("john"))
+        self.assertEqual((self.cache.counts["misses"], self.cache.counts["hits"]), (1, 1))
+        db.session.add(Post(body="hello", author=self.susan))
+        db.session.commit()
+        self.about("john")
+        self.assertEqual(self.cache.counts["hits"], 2)
+        self.john.about_me = "hi"
+        db.session.commit()
+        self.assertEqual(self.about("john"), "hi")
+        self.assertEqual(self.cache.counts["misses"], 2)
+
+    def test_uncommitted_writes_bypass_the_cache(self):
+        self.about("john")
+        self.john.about_me = "draft"
+        db.session.flush()
+        self.assertEqual(self.about("john"), "draft")
+        self.assertEqual(self.cache.counts["bypassed"], 1)
+        db.session.rollback()
+        self.assertIsNone(self.about("john"))
+        self.assertEqual(self.cache.counts["hits"], 1)
+
+    def test_orm_entities_and_follow_counts(self):
+        query = select(User).where(User.username == "susan").execution_options(query_cache=60)
+        self.assertIs(db.session.scalar(query), self.susan)
+        db.session.expunge_all()
+        susan = db.session.scalar(query)
+        self.assertEqual((susan.username, self.cache.counts["hits"]), ("susan", 1))
+        john = db.session.scalar(select(User).where(User.username == "john"))
+        self.assertEqual(susan.followers_count(), 0)
+        john.follow(susan)
+        db.session.commit()
+        self.assertEqual(susan.followers_count(), 1)
+
+    def test_last_seen_keeps_user_entries(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(self.susan.id)
+            session["_fresh"] = True
+        for i in range(3):
+            self.assertEqual(client.get("/user/john/popup").status_code, 200)
+        misses = self.cache.counts["misses"]
+        client.get("/user/john/popup")
+        self.assertEqual(self.cache.counts["misses"], misses)
+        self.assertIsNotNone(db.session.scalar(select(User.last_seen).where(User.id == self.susan.id)))
+
+    def test_ttl_and_lru(self):
+        self.about("john", ttl=0.01)
+        time.sleep(0.02)
+        self.about("john")
+        self.assertEqual(self.cache.counts["misses"], 2)
+        self.app.query_cache = cache = QueryCache(maxsize=2)
+        for username in ("john", "susan", "john", "nobody"):
+            self.about(username)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+
+class FragmentCacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def render_post(self, post):
+        with self.app.test_request_context():
+            g.locale = "en"
+            return render_template("_post.html", post=post)
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(len(cache), 2)
+
+    def test_post_fragment_is_cached(self):
+        u = User(username="john", email="john@example.com")
+        p = Post(body="hello", author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        html = self.render_post(p)
+        self.assertIn("hello", html)
+        self.assertEqual(len(self.app.fragment_cache.local), 1)
+        self.assertEqual(self.render_post(p), html)
+        self.assertEqual(len(self.app.fragment_cache.local), 1)
+        key = self.app.fragment_cache.local._data.popitem()[0]
+        self.assertEqual(key[:3], ("post", p.id, u.id))
+
+    def test_invalidate_shared_backend(self):
+        cache = FragmentCache(shared=LRUCache())
+        cache.set(("post", 1, 2, 1, "en"), "<p>old</p>")
+        cache.set(("post", 10, 2, 1, "en"), "<p>other</p>")
+        cache.invalidate("post", 1)
+        self.assertIsNone(cache.get(("post", 1, 2, 1, "en")))
+        self.assertIsNone(cache.shared.get(("post", 1, 2, 1, "en")))
+        self.assertEqual(cache.get(("post", 10, 2, 1, "en")), "<p>other</p>")
+
+    def test_popup_is_not_keyed_on_last_seen(self):
+        john = User(username="john", email="john@example.com", last_seen=datetime(2024, 1, 1, 12, 0, 5))
+        susan = User(username="susan", email="susan@example.com")
+        db.session.add_all([john, susan])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(susan.id)
+            session["_fresh"] = True
+        etag = client.get("/user/john/popup").headers["ETag"]
+        john.last_seen = datetime(2024, 1, 1, 12, 0, 40)
+        db.session.commit()
+        self.assertEqual(client.get("/user/john/popup", headers={"If-None-Match": etag}).status_code, 304)
+        john.last_seen = datetime(2024, 1, 1, 12, 1, 0)
+        db.session.commit()
+        response = client.get("/user/john/popup", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"2024-01-01T12:01:00", response.data)
+        self.assertEqual(len(self.app.fragment_cache.local), 2)
+
+    def test_profile_change_invalidates_post_fragment(self):
+        u = User(username="john", email="john@example.com")
+        p = Post(body="hello", author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.assertIn("john", self.render_post(p))
+        u.username = "johnny"
+        db.session.commit()
+        self.assertEqual(u.version, 2)
+        self.assertIn("johnny", self.render_post(p))
+
+    def test_follow_bumps_version(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.version, 2)
+        self.assertEqual(u2.version, 2)
+        u1.last_seen = datetime.now(timezone.utc)
+        db.session.commit()
+        self.assertEqual(u1.version, 2)
+
+
+class ConditionalGetCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(self.user.id)
+            session["_fresh"] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_explore_not_modified(self):
+        response = self.client.get("/explore")
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers["ETag"]
+        response = self.client.get("/explore", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], etag)
+
+        db.session.add(Post(body="hello", author=self.user))
+        db.session.commit()
+        response = self.client.get("/explore", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+    def test_notifications_last_modified(self):
+        self.user.add_notification("unread_message_count", 1)
+        db.session.commit()
+        response = self.client.get("/notifications")
+        self.assertIsNotNone(response.last_modified)
+        response = self.client.get("/notifications", headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(response.status_code, 304)
+
+    def test_gzip(self):
+        response = self.client.get("/explore", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertIn(b"Microblog", gzip.decompress(response.data))
+
+
+class SlowUpstreamHandler(BaseHTTPRequestHandler):
+    delay = 1.0
+    status = 200
+    hits = 0
+
+    def do_POST(self):
+        SlowUpstreamHandler.hits += 1
+        time.sleep(self.delay)
+        body = json.dumps([{"translations": [{"text": "hola"}]}]).encode("utf-8")
+        self.send_response(self.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class AsyncViewCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), SlowUpstreamHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.app = create_app(type("TranslatorConfig", (TestConfig,), {
+            "MS_TRANSLATOR_KEY": "key",
+            "MS_TRANSLATOR_API_ENDPOINT": "http://127.0.0.1:%d" % self.server.server_port,
+            "TRANSLATOR_TIMEOUT": 0.3,
+            "OUTBOUND_BREAKER_THRESHOLD": 2,
+        }))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as session:
+            session["_user_id"] = str(self.user.id)
+            session["_fresh"] = True
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def translate(self):
+        return self.client.post("/translate", json={
+            "text": "hello", "source_language": "en", "dest_language": "es"}).get_json()["text"]
+
+    def test_translate(self):
+        SlowUpstreamHandler.delay = 0
+        SlowUpstreamHandler.status = 200
+        self.assertEqual(self.translate(), "hola")
+
+    def test_translate_deadline(self):
+        SlowUpstreamHandler.delay = 1.0
+        SlowUpstreamHandler.status = 200
+        start = time.perf_counter()
+        self.assertEqual(self.translate(), "Error: the translation service failed.")
+        self.assertLess(time.perf_counter() - start, 0.9)
+
+    def test_translate_circuit_breaker(self):
+        SlowUpstreamHandler.delay = 0
+        SlowUpstreamHandler.status = 503
+        SlowUpstreamHandler.hits = 0
+        for i in range(4):
+            self.assertEqual(self.translate(), "Error: the translation service failed.")
+        self.assertEqual(SlowUpstreamHandler.hits, 2)
+        stats = self.client.get("/status/outbound").get_json()["translator"]
+        self.assertEqual(stats["state"], "open")
+        self.assertEqual(stats["failures"], 2)
+        self.assertEqual(stats["rejected"], 2)
+        self.assertEqual(self.client.get("/status/outbound", environ_base={
+            "REMOTE_ADDR": "203.0.113.7"}).status_code, 404)
+        self.assertEqual(self.client.get("/status/jobs", environ_base={
+            "REMOTE_ADDR": "203.0.113.7"}).status_code, 404)
+        self.assertEqual(self.client.get("/status/query-cache", environ_base={
+            "REMOTE_ADDR": "203.0.113.7"}).status_code, 404)
+
+    def test_search_without_elasticsearch(self):
+        response = self.client.get("/search?q=hello")
+        self.assertEqual(response.status_code, 200)
+
+
+class CircuitBreakerCase(unittest.TestCase):
+    def test_open_and_half_open(self):
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.05)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "closed")
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+
+    def test_client_errors_do_not_trip(self):
+        from elasticsearch import BadRequestError, ApiError, ConnectionError
+        from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+
+        def api_error(cls, status):
+            meta = ApiResponseMeta(status, "1.1", HttpHeaders(), 0.0, NodeConfig("http", "localhost", 9200))
+            return cls("error", meta, {})
+
+        def fail(error):
+            raise error
+
+        search = Upstream("elasticsearch", 1, threshold=2, reset_timeout=60)
+        for error in (api_error(BadRequestError, 400), api_error(BadRequestError, 400)):
+            with self.assertRaises(BadRequestError):
+                search.call(fail, error)
+        self.assertEqual(search.breaker.state, "closed")
+        wrapped = UpstreamError()
+        wrapped.__cause__ = api_error(ApiError, 503)
+        for error in (wrapped, ConnectionError("refused")):
+            with self.assertRaises(Exception):
+                search.call(fail, error)
+        self.assertEqual(search.breaker.state, "open")
+
+
+class PasswordHasherCase(unittest.TestCase):
+    def test_pool(self):
+        hasher = PasswordHasher("pbkdf2:sha256:1000", workers=1, max_pending=1)
+        try:
+            pwhash = hasher.hash("cat")
+            self.assertTrue(hasher.verify(pwhash, "cat"))
+            self.assertFalse(hasher.verify(pwhash, "dog"))
+            self.assertFalse(hasher.needs_rehash(pwhash))
+            self.assertTrue(hasher.needs_rehash(generate_password_hash("cat", "pbkdf2:sha256:1000", 8)))
+            hasher.pending.acquire()
+            with self.assertRaises(PasswordHasherBusy) as busy:
+                hasher.hash("cat")
+            self.assertEqual(busy.exception.code, 503)
+            self.assertIn("Retry-After", dict(busy.exception.get_headers()))
+        finally:
+            hasher.shutdown()
+
+    def test_timed_out_hash_keeps_its_permit(self):
+        hasher = PasswordHasher("pbkdf2:sha256:1000", workers=1, max_pending=1, timeout=5)
+        try:
+            hasher.hash("warm up")
+            hasher.timeout = 0.1
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.run(time.sleep, 1)
+            self.assertFalse(hasher.pending.acquire(blocking=False))
+            time.sleep(1.5)
+            hasher.timeout = 5
+            self.assertTrue(hasher.verify(hasher.hash("cat"), "cat"))
+        finally:
+            hasher.shutdown()
+
+
+def hit_shared(windows, count):
+    for i in range(count):
+        windows.hit("main.follow|ip:127.0.0.1", 100, 60, 120)
+
+
+class RateLimitCase(unittest.TestCase):
+    def check_sliding_window(self, windows):
+        limiter = RateLimiter({"main.follow": (3, 60)}, windows)
+        self.assertEqual([limiter.check("main.follow", "user:1", 60 + i) for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(limiter.check("main.follow", "user:1", 63), 57)
+        self.assertEqual(limiter.check("main.follow", "user:2", 63), 0)
+        self.assertEqual(limiter.check("main.send_message", "user:1", 63), 0)
+        # half way into the next window the previous one counts for 1.5 of 3
+        self.assertEqual([limiter.check("main.follow", "user:1", 150) for i in range(2)], [0, 0])
+        self.assertAlmostEqual(limiter.check("main.follow", "user:1", 150), 10)
+        self.assertEqual(limiter.check("main.follow", "user:1", 161), 0)
+        self.assertEqual(limiter.check("main.follow", "user:1", 300), 0)
+
+    def test_memory_windows(self):
+        self.check_sliding_window(MemoryWindows())
+        windows = MemoryWindows(max_keys=2)
+        for i in range(3):
+            windows.hit("main.follow|user:%d" % i, 3, 60, 60)
+        # nothing stale yet, so the table starts over
+        self.assertEqual(list(windows.entries), ["main.follow|user:2"])
+        windows.hit("main.follow|user:3", 3, 60, 300)
+        windows.hit("main.follow|user:4", 3, 60, 300)
+        self.assertEqual(list(windows.entries), ["main.follow|user:3", "main.follow|user:4"])
+
+    def test_shared_windows(self):
+        windows = SharedWindows(slots=1024)
+        self.check_sliding_window(windows)
+        process = multiprocessing.get_context("fork").Process(target=hit_shared, args=(windows, 5))
+        process.start()
+        process.join()
+        hit_shared(windows, 5)
+        position = windows.slot.size * (int.from_bytes(blake2b(b"main.follow|ip:127.0.0.1", digest_size=8).digest(),
+                                                        "little") % 1024)
+        self.assertEqual(windows.slot.unpack_from(windows.memory, position)[2], 10)
+
+    def test_too_many_requests(self):
+        app = create_app(type("LimitConfig", (TestConfig,), {"RATELIMITS": {"auth.login": (2, 60)},
+                                                             "WTF_CSRF_ENABLED": False}))
+        with app.app_context():
+            db.create_all()
+            client = app.test_client()
+            for i in range(2):
+                self.assertEqual(client.post("/auth/login", data={"username": "x", "password": "y"}).status_code, 302)
+            self.assertEqual(client.get("/auth/login").status_code, 200)
+            response = client.post("/auth/login", data={"username": "x", "password": "y"})
+            self.assertEqual(response.status_code, 429)
+            self.assertGreater(int(response.headers["Retry-After"]), 0)
+            db.session.remove()
+            db.drop_all()
+
+    def test_api_calls_are_limited_per_token(self):
+        app = create_app(type("LimitConfig", (TestConfig,), {
+            "RATELIMITS": {"api.follow_users": (1, 60), "auth.login": (1, 60)}, "PROXY_FIX_X_FOR": 1}))
+        with app.app_context():
+            db.create_all()
+            client = app.test_client()
+            tokens = []
+            for name in ("john", "susan"):
+                user = User(username=name, email=name + "@example.com")
+                db.session.add(user)
+                db.session.commit()
+                tokens.append(user.get_token())
+            db.session.commit()
+
+            def follow(token, address):
+                return client.post("/api/v1/follows", json={"usernames": []}, headers={
+                    "Authorization": "Bearer " + token, "X-Forwarded-For": address}).status_code
+
+            self.assertEqual(follow(tokens[0], "203.0.113.1"), 200)
+            self.assertEqual(follow(tokens[1], "203.0.113.1"), 200)
+            self.assertEqual(follow(tokens[0], "203.0.113.2"), 429)
+            # signed out, each client behind the proxy has its own allowance
+            for address, status in (("203.0.113.3", 200), ("203.0.113.3", 429), ("203.0.113.4", 200)):
+                self.assertEqual(client.post("/auth/login", headers={"X-Forwarded-For": address}).status_code, status)
+            # made-up tokens are counted against the address they come from
+            self.assertEqual(follow("forged-1", "203.0.113.5"), 401)
+            self.assertEqual(follow("forged-2", "203.0.113.5"), 429)
+            self.assertEqual(client.post("/auth/login", headers={
+                "Authorization": "Bearer forged-3", "X-Forwarded-For": "203.0.113.4"}).status_code, 429)
+            db.session.remove()
+            db.drop_all()
+
+
+class QueueLoggingCase(unittest.TestCase):
+    def test_full_queue_drops_records(self):
+        log_queue = queue.Queue(maxsize=2)
+        handler = DroppingQueueHandler(log_queue)
+        logger = logging.getLogger("tests.queue_logging")
+        logger.propagate = False
+        logger.addHandler(handler)
+        for i in range(5):
+            logger.error("error %d", i)
+        self.assertEqual(log_queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+        log_queue.get_nowait()
+        log_queue.get_nowait()
+        logger.error("recovered")
+        self.assertEqual(log_queue.get_nowait().getMessage(), "Log queue full, dropped 3 records")
+        self.assertEqual(log_queue.get_nowait().getMessage(), "recovered")
+        logger.removeHandler(handler)
+
+    def test_json_formatter(self):
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            record = logging.getLogger("tests").makeRecord(
+                "tests", logging.ERROR, __file__, 1, "failed %s", ("here",), sys.exc_info())
+        record = DroppingQueueHandler(queue.Queue()).prepare(record)
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry["message"], "failed here")
+        self.assertEqual(entry["level"], "ERROR")
+        self.assertIn("ValueError: boom", entry["exc_info"])
+
+
+class StartupCase(unittest.TestCase):
+    STARTUP_BUDGET = 5.0
+
+    def test_startup_budget(self):
+        report = profile_startup(cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(report["status"], 200)
+        self.assertEqual(report["eager"], [])
+        self.assertLess(report["total"], self.STARTUP_BUDGET)
+
+    def test_precompiled_templates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            app = create_app(type("CacheConfig", (TestConfig,), {"TEMPLATE_CACHE_DIR": directory}))
+            self.assertFalse(app.jinja_env.auto_reload)
+            count, seconds = precompile(app)
+            self.assertEqual(count, len(os.listdir(directory)))
+            self.assertIn("base.html", app.jinja_env.list_templates())
+            cold = create_app(type("CacheConfig", (TestConfig,), {"TEMPLATE_CACHE_DIR": directory}))
+            self.assertEqual(cold.jinja_env.get_template("_post.html").name, "_post.html")
+            self.assertEqual(count, len(os.listdir(directory)))
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)